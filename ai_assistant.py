@@ -113,7 +113,11 @@ class AIAssistant:
         # 初始化关键管理器
         self.api_manager = APIManager()
         self.paper_downloader = PaperDownloader("downloaded_papers")
-        self.knowledge_manager = KnowledgeManager()
+        # 启动时只加载知识库元数据，检索索引在后台加载
+        self.knowledge_manager = KnowledgeManager(lazy=True)
+        # 在后台监视知识库目录并批量更新索引，查询时不再扫描文件系统
+        self.knowledge_manager.start_watcher(
+            on_batch=lambda file_ids: self.root.after(0, self.refresh_knowledge_list))
         
         # 创建Tab控件
         self.tab_control = ttk.Notebook(root)
@@ -247,8 +251,8 @@ class AIAssistant:
         buttons_frame.pack(fill="x", padx=5, pady=5)
         
         # 添加文件按钮
-        add_button = ttk.Button(buttons_frame, text="添加文件", command=self.upload_to_knowledge_base)
-        add_button.pack(side="left", padx=5, pady=5)
+        self.add_knowledge_button = ttk.Button(buttons_frame, text="添加文件", command=self.upload_to_knowledge_base)
+        self.add_knowledge_button.pack(side="left", padx=5, pady=5)
         
         # 删除文件按钮
         self.delete_button = ttk.Button(buttons_frame, text="删除文件", command=self.delete_from_knowledge_base, state="disabled")
@@ -258,6 +262,16 @@ class AIAssistant:
         refresh_button = ttk.Button(buttons_frame, text="刷新列表", command=self.refresh_knowledge_list)
         refresh_button.pack(side="right", padx=5, pady=5)
         
+        # 知识库状态（批量添加进度等）
+        self.knowledge_status_label = ttk.Label(left_frame, text="")
+        self.knowledge_status_label.pack(anchor="w", padx=10, pady=2)
+        
+        # 检索索引在后台加载，加载完成前显示提示
+        if not self.knowledge_manager.is_loaded():
+            self.knowledge_status_label.config(text="正在建立索引…")
+            self.knowledge_manager.start_loading(
+                on_ready=lambda: self.root.after(0, self._on_knowledge_index_ready))
+        
         # 右侧：文件详情和预览
         right_frame = ttk.Frame(main_frame)
         right_frame.pack(side="right", fill="both", expand=True, padx=5, pady=5)
@@ -1545,8 +1559,9 @@ class AIAssistant:
         knowledge_context = ""
         
         if use_knowledge:
-            # 从知识库获取相关上下文
-            knowledge_context = self.knowledge_manager.get_knowledge_context(message)
+            # 从知识库获取相关上下文，长度不超过所选模型的上下文预算
+            token_budget = self.api_manager.get_context_token_budget(api_type)
+            knowledge_context = self.knowledge_manager.get_knowledge_context(message, token_budget=token_budget)
             if knowledge_context:
                 # 将知识库上下文加入到提示中
                 message = knowledge_context + "\n\n基于以上知识库信息，请回答: " + message
@@ -1577,19 +1592,49 @@ class AIAssistant:
                                                      ("PDF文件", "*.pdf"),
                                                      ("Word文件", "*.docx"),
                                                      ("所有文件", "*.*")])
-        if files:
-            # 创建知识库目录
-            os.makedirs("knowledge_base", exist_ok=True)
-            
-            for file in files:
-                # 拷贝文件到知识库
-                import shutil
-                filename = os.path.basename(file)
-                destination = os.path.join("knowledge_base", filename)
-                shutil.copy2(file, destination)
-            
-            messagebox.showinfo("上传成功", f"已上传 {len(files)} 个文件到知识库")
-            self.refresh_knowledge_list()
+        if not files:
+            return
+        
+        # 添加到当前选中的分区，选中"全部"时添加到"其他"
+        category = self.selected_category.get()
+        if category == "全部":
+            category = "其他"
+        
+        self.add_knowledge_button.config(state="disabled")
+        self.knowledge_status_label.config(text=f"正在添加 {len(files)} 个文件到知识库: {category}...")
+        
+        def on_progress(done, total, result):
+            name = os.path.basename(result["source"])
+            self.root.after(0, lambda: self.knowledge_status_label.config(
+                text=f"正在添加到知识库: {done}/{total} {name}"))
+        
+        def add_files():
+            # 批量复制、提取并索引，全部完成后只提交一次索引
+            results = self.knowledge_manager.add_files(list(files), category, progress_callback=on_progress)
+            self.root.after(0, lambda: self._on_knowledge_upload_done(results, category))
+        
+        threading.Thread(target=add_files, daemon=True).start()
+    
+    def _on_knowledge_index_ready(self):
+        """知识库检索索引加载完成后清除提示并刷新列表（加载时可能迁移或补齐了文件记录）"""
+        if self.knowledge_status_label.cget("text") == "正在建立索引…":
+            self.knowledge_status_label.config(text="")
+        self.refresh_knowledge_list()
+    
+    def _on_knowledge_upload_done(self, results, category):
+        """批量添加文件完成后刷新列表并汇报结果"""
+        self.add_knowledge_button.config(state="normal")
+        succeeded = [result for result in results if result["success"]]
+        failed = [result for result in results if not result["success"]]
+        self.knowledge_status_label.config(text=f"已添加 {len(succeeded)} 个文件到知识库: {category}")
+        self.refresh_knowledge_list()
+        
+        if failed:
+            details = "\n".join(f"{os.path.basename(result['source'])}: {result['error']}" for result in failed)
+            messagebox.showwarning("部分文件添加失败",
+                                   f"已添加 {len(succeeded)} 个文件，{len(failed)} 个文件添加失败:\n{details}")
+        else:
+            messagebox.showinfo("上传成功", f"已上传 {len(succeeded)} 个文件到知识库")
     
     def manage_knowledge_base(self):
         if not os.path.exists("knowledge_base"):
@@ -1800,8 +1845,9 @@ class AIAssistant:
             }
         }
         
-        # 更新API管理器中的设置
-        self.api_manager.settings.update(settings)
+        # 更新API管理器中的设置，保留界面上没有的设置项（如 context_tokens）
+        for key, value in settings.items():
+            self.api_manager.settings.setdefault(key, {}).update(value)
         self.api_manager.save_settings()
         
         messagebox.showinfo("成功", "设置已保存")
@@ -3,6 +3,33 @@ import json
 import requests
 import importlib.util
 
+# 下拉菜单中的API类型对应的设置项
+API_SETTINGS_KEYS = {
+    "OpenAI": "openai",
+    "Azure OpenAI": "azure",
+    "本地模型": "local",
+    "DeepSeek": "deepseek"
+}
+
+# 各模型送入对话的知识库上下文的默认token预算，未列出的模型使用所属API类型的默认值
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 1500,
+    "gpt-4-turbo": 4000,
+    "gpt-4o": 4000,
+    "gpt-4o-mini": 4000,
+    "gpt-3.5-turbo": 1500,
+    "deepseek-chat": 3000,
+    "deepseek-reasoner": 3000
+}
+
+API_CONTEXT_TOKENS = {
+    "openai": 1500,
+    "azure": 1500,
+    "local": 800,
+    "deepseek": 3000,
+    "other": 1000
+}
+
 class APIManager:
     def __init__(self):
         self.settings = self.load_settings()
@@ -32,6 +59,27 @@ class APIManager:
         
         return settings
     
+    def get_context_token_budget(self, api_type):
+        """获取送入对话的知识库上下文的token预算
+        
+        设置项中的 context_tokens 优先，其次按模型名称，最后使用API类型的默认值。
+        
+        Args:
+            api_type: 下拉菜单中的API类型，自定义API使用 "other" 设置项
+            
+        Returns:
+            int: token预算
+        """
+        key = API_SETTINGS_KEYS.get(api_type, "other")
+        settings = self.settings.get(key, {})
+        try:
+            if settings.get("context_tokens"):
+                return int(settings["context_tokens"])
+        except (TypeError, ValueError):
+            print(f"{key} 的 context_tokens 设置无效: {settings.get('context_tokens')}")
+        model = settings.get("model") or settings.get("deployment") or ""
+        return MODEL_CONTEXT_TOKENS.get(model.lower(), API_CONTEXT_TOKENS[key])
+    
     def save_settings(self):
         """保存API设置"""
         os.makedirs("config", exist_ok=True)
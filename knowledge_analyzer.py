@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import re
+import zlib
+
+try:
+    import jieba
+    JIEBA_AVAILABLE = True
+except ImportError:
+    jieba = None
+    JIEBA_AVAILABLE = False
+
+
+# 中日韩文字（汉字、扩展A、兼容汉字、假名、韩文音节）
+CJK_RANGES = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af"
+
+# 连续的中日韩文字，或连续的其他文字/数字（与旧版分词一致，下划线属于词的一部分）
+TOKEN_PATTERN = re.compile(f"([{CJK_RANGES}]+)|([^\\W{CJK_RANGES}]+)")
+
+ENGLISH_STOPWORDS = frozenset("""
+    an and are as at be been but by can did do does for from had has have he her his how if in into is it its
+    me my no not of on or our she so such than that the their them then there these they this those to was we
+    were what when where which while who whom why will with you your
+""".split())
+
+CHINESE_STOPWORDS = frozenset("""
+    的 了 和 与 及 或 是 在 也 就 都 而 着 被 把 对 从 为 以 于 之 其 这 那 个 有 我 你 他 她 它
+    我们 你们 他们 一个 这个 那个 这些 那些 以及 因为 所以 但是 如果 没有 可以 什么 如何 怎么 进行 通过
+""".split())
+
+DEFAULT_STOPWORDS = ENGLISH_STOPWORDS | CHINESE_STOPWORDS
+
+CJK_CHAR_PATTERN = re.compile(f"[{CJK_RANGES}]")
+
+
+def estimate_tokens(text):
+    """粗略估计文本的token数，不依赖具体模型的分词表
+
+    常见模型的分词表中一个汉字（假名、韩文）约为一个token，其他文字约四个字符一个token，
+    估计值略偏大，按此控制长度不会超出预算。
+    """
+    if not text:
+        return 0
+    cjk = len(CJK_CHAR_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def shingles(tokens, size=2):
+    """由相邻的 size 个词元组成的片段集合，用于估计文本的相似度；词元少于 size 个时为全部词元"""
+    if len(tokens) < size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def jaccard(a, b):
+    """两个集合的Jaccard相似度"""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class LowercaseFilter:
+    """将拉丁字母转为小写"""
+
+    signature = "lower"
+
+    def __call__(self, token):
+        return token.lower()
+
+
+class StopwordFilter:
+    """去掉停用词"""
+
+    def __init__(self, stopwords=None):
+        """初始化停用词过滤器
+
+        Args:
+            stopwords: 停用词集合，默认为常用的中英文停用词
+        """
+        self.stopwords = frozenset(DEFAULT_STOPWORDS if stopwords is None else stopwords)
+
+    @property
+    def signature(self):
+        """停用词表的标识"""
+        return "stop-%08x" % zlib.crc32(" ".join(sorted(self.stopwords)).encode("utf-8"))
+
+    def __call__(self, token):
+        return None if token in self.stopwords else token
+
+
+def s_stem(token):
+    """英文复数的轻量词干提取（Harman S-stemmer），只处理 -ies、-es、-s 结尾"""
+    if token.endswith("ies") and not token.endswith(("eies", "aies")):
+        return token[:-3] + "y"
+    if token.endswith("es") and not token.endswith(("aes", "ees", "oes")):
+        return token[:-1]
+    if token.endswith("s") and not token.endswith(("us", "ss")):
+        return token[:-1]
+    return token
+
+
+class StemFilter:
+    """英文词干提取，安装了NLTK时使用Porter算法，否则只去掉复数词尾"""
+
+    def __init__(self, algorithm="porter"):
+        """初始化词干过滤器
+
+        Args:
+            algorithm: "porter"（需要NLTK，未安装时退回 "s"）或 "s"
+        """
+        self._stem = s_stem
+        self.algorithm = "s"
+        if algorithm == "porter":
+            try:
+                from nltk.stem import PorterStemmer
+                self._stem = PorterStemmer().stem
+                self.algorithm = "porter"
+            except ImportError:
+                print("未安装NLTK，词干提取只去掉英文复数词尾")
+
+    @property
+    def signature(self):
+        """词干算法的标识"""
+        return "stem-" + self.algorithm
+
+    def __call__(self, token):
+        # 只处理拉丁字母组成的词，中文和数字保持不变
+        if token.isascii() and token.isalpha():
+            return self._stem(token)
+        return token
+
+
+class Analyzer:
+    """检索文本分析器，入库和查询使用同一个分析器
+
+    先将文本切分为词元：中日韩文字按相邻两字切分（bigram）或用jieba分词，
+    其他文字按连续的字母数字切分并去掉单个字符；然后依次经过过滤链（默认为转小写、去停用词，
+    可加词干提取），过滤器返回None的词元被丢弃。
+    词元的位置为其在结果中的序号，相邻两字切分的词元依次相邻，中文短语按位置连续匹配即可。
+    """
+
+    def __init__(self, cjk="bigram", filters=None, min_length=2):
+        """初始化分析器
+
+        Args:
+            cjk: 中日韩文字的切分方式，"bigram" 或 "jieba"（未安装jieba时退回 "bigram"）
+            filters: 词元过滤器列表，每个过滤器接受一个词元，返回处理后的词元或None；
+                     默认为 [LowercaseFilter(), StopwordFilter()]
+            min_length: 非中日韩词元的最小长度
+        """
+        if cjk == "jieba" and not JIEBA_AVAILABLE:
+            print("未安装jieba，中文按相邻两字切分")
+            cjk = "bigram"
+        self.cjk = cjk
+        self.filters = [LowercaseFilter(), StopwordFilter()] if filters is None else list(filters)
+        self.min_length = min_length
+
+    @property
+    def signature(self):
+        """分析方式的标识，变化后已建立的索引需要重建"""
+        parts = ["analyzer-v1", self.cjk, str(self.min_length)]
+        for token_filter in self.filters:
+            parts.append(getattr(token_filter, "signature", None) or getattr(token_filter, "__name__", "filter"))
+        return "/".join(parts)
+
+    def _cjk_tokens(self, text, offset):
+        """切分一段连续的中日韩文字，产生 (词元, 起始位置, 结束位置)"""
+        if self.cjk == "jieba":
+            for word, start, end in jieba.tokenize(text):
+                if word.strip():
+                    yield word, offset + start, offset + end
+            return
+        if len(text) == 1:
+            yield text, offset, offset + 1
+            return
+        for i in range(len(text) - 1):
+            yield text[i:i + 2], offset + i, offset + i + 2
+
+    def analyze_spans(self, text):
+        """分析文本
+
+        Returns:
+            list: [(词元, 起始位置, 结束位置), ...]，位置为词元在原文中的字符范围
+        """
+        tokens = []
+        for match in TOKEN_PATTERN.finditer(text or ""):
+            if match.group(1):
+                candidates = self._cjk_tokens(match.group(1), match.start())
+            elif len(match.group(2)) >= self.min_length:
+                candidates = [(match.group(2), match.start(), match.end())]
+            else:
+                continue
+            for token, start, end in candidates:
+                for token_filter in self.filters:
+                    token = token_filter(token)
+                    if not token:
+                        break
+                else:
+                    tokens.append((token, start, end))
+        return tokens
+
+    def analyze(self, text):
+        """分析文本，返回词元列表（保留顺序和重复）"""
+        return [token for token, _, _ in self.analyze_spans(text)]
+
+
+def create_analyzer(config=None):
+    """根据配置创建分析器
+
+    Args:
+        config: 如 {"cjk": "bigram", "stopwords": True, "stem": False}：
+                cjk 为中日韩文字的切分方式（"bigram" 或 "jieba"）；
+                stopwords 为 True（默认停用词表）、False（不去停用词）或停用词列表；
+                stem 为 False、True（Porter，需要NLTK）或 "s"（只去掉复数词尾）
+
+    Returns:
+        Analyzer 实例
+    """
+    config = config or {}
+    filters = [LowercaseFilter()]
+    stopwords = config.get("stopwords", True)
+    if stopwords:
+        filters.append(StopwordFilter(None if stopwords is True else stopwords))
+    stem = config.get("stem", False)
+    if stem:
+        filters.append(StemFilter("porter" if stem is True else stem))
+    return Analyzer(config.get("cjk", "bigram"), filters, config.get("min_length", 2))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import re
+
+class TextChunker:
+    """将文档切分为长度有限、相邻片段之间有少量重叠的检索片段
+
+    PyPDF2提取的文本很少有空行，按空行分段时整篇论文常常只有一个"段落"。
+    这里以行和句子为单位拼接片段：片段不超过 chunk_size 个字符，
+    下一个片段以上一个片段末尾不超过 overlap 个字符的完整行（或句子）开头，
+    避免相关内容恰好被切在两个片段之间。
+    切分结果只取决于文本和参数，同一文档每次切分得到相同的片段序号。
+    """
+
+    # 句末标点，超长的行按句子继续拆分
+    SENTENCE_END = re.compile(r'(?<=[。！？；])|(?<=[.!?;])\s+')
+
+    def __init__(self, chunk_size=600, overlap=120):
+        """初始化切分器
+
+        Args:
+            chunk_size: 片段的最大字符数
+            overlap: 相邻片段之间重叠的最大字符数
+        """
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def signature(self):
+        """切分参数的标识，参数变化后已保存的片段需要重新切分"""
+        return f"{self.chunk_size}/{self.overlap}"
+
+    def _split_long(self, text):
+        """将超过片段长度的行按句子拆分，仍然过长时在空白处（没有空白时直接）截断"""
+        if len(text) <= self.chunk_size:
+            return [text]
+
+        pieces = []
+        for sentence in self.SENTENCE_END.split(text):
+            sentence = sentence.strip()
+            while len(sentence) > self.chunk_size:
+                cut = sentence.rfind(" ", self.chunk_size // 2, self.chunk_size)
+                if cut <= 0:
+                    cut = self.chunk_size
+                pieces.append(sentence[:cut].strip())
+                sentence = sentence[cut:].strip()
+            if sentence:
+                pieces.append(sentence)
+        return pieces
+
+    def _units(self, paragraphs):
+        """将段落拆分为 (分隔符, 文本) 单元，分隔符为该单元与前一单元之间的连接文本"""
+        sep = None
+        for _, para in paragraphs:
+            if not para.strip():
+                continue
+            sep = "" if sep is None else "\n\n"
+            for line in para.split("\n"):
+                if not line.strip():
+                    continue
+                for piece in self._split_long(line.strip()):
+                    yield sep, piece
+                    sep = " "
+                sep = "\n"
+
+    @staticmethod
+    def _join(units):
+        """拼接单元，第一个单元的分隔符被忽略"""
+        return "".join((sep if i else "") + text for i, (sep, text) in enumerate(units))
+
+    def chunks(self, paragraphs):
+        """逐个产生检索片段
+
+        Args:
+            paragraphs: (段落序号, 段落文本) 的可迭代对象，如 ContentStore.iter_paragraphs 的结果
+
+        Yields:
+            tuple: (片段文本, 重叠长度)，片段文本的前"重叠长度"个字符与上一个片段重复
+        """
+        window = []
+        size = 0
+        # window 中第一个不属于上一个片段的单元
+        new_start = 0
+
+        for sep, text in self._units(paragraphs):
+            if window and size + len(sep) + len(text) > self.chunk_size:
+                if new_start < len(window):
+                    yield self._emit(window, new_start)
+                    # 保留末尾不超过 overlap 的完整单元作为下一个片段的开头
+                    kept = []
+                    kept_size = 0
+                    for unit in reversed(window):
+                        if kept_size + len(unit[1]) > self.overlap:
+                            break
+                        kept.insert(0, unit)
+                        kept_size += len(unit[1]) + len(unit[0])
+                    window = kept
+                    new_start = len(window)
+                # 重叠部分加上新单元仍然过长时，舍弃最前面的重叠单元
+                while window and len(self._join(window)) + len(sep) + len(text) > self.chunk_size:
+                    window.pop(0)
+                    new_start -= 1
+                size = len(self._join(window))
+
+            window.append((sep, text))
+            size += (len(sep) if len(window) > 1 else 0) + len(text)
+
+        if new_start < len(window):
+            yield self._emit(window, new_start)
+
+    def _emit(self, window, new_start):
+        """生成片段文本和重叠长度"""
+        overlap_length = len(self._join(window[:new_start]))
+        if 0 < new_start < len(window):
+            overlap_length += len(window[new_start][0])
+        return self._join(window), overlap_length
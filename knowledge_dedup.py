@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import base64
+import random
+import zlib
+from array import array
+
+from knowledge_analyzer import shingles
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+MASK64 = (1 << 64) - 1
+
+
+class MinHasher:
+    """MinHash签名
+
+    文档由相邻 shingle_size 个词元组成的片段集合表示，每个片段先哈希为32位整数，
+    再用 num_perm 个乘移位哈希函数 ((a * h + b) mod 2^64) >> 32 各取最小值作为签名。
+    两个文档签名中相同位置取值相等的比例即为其片段集合Jaccard相似度的估计。
+    安装了NumPy时按块向量化计算，否则逐个哈希函数计算。
+    """
+
+    # NumPy计算时每块处理的片段数，限制临时矩阵的大小
+    BLOCK_SIZE = 4096
+
+    def __init__(self, num_perm=128, shingle_size=3, seed=1):
+        """初始化MinHash
+
+        Args:
+            num_perm: 哈希函数个数（签名长度）
+            shingle_size: 每个片段包含的词元数
+            seed: 生成哈希函数参数的随机种子
+        """
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = random.Random(seed)
+        self.a = [rng.getrandbits(64) | 1 for _ in range(num_perm)]
+        self.b = [rng.getrandbits(64) for _ in range(num_perm)]
+
+    @property
+    def signature(self):
+        """签名方式的标识"""
+        return f"minhash-v1/{self.num_perm}/{self.shingle_size}/{self.seed}"
+
+    def minhash(self, tokens):
+        """计算词元序列的MinHash签名
+
+        Returns:
+            array: 长度为 num_perm 的无符号32位整数数组，没有词元时返回None
+        """
+        hashes = {zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(tokens, self.shingle_size)}
+        if not hashes:
+            return None
+        if np is None:
+            values = [min(((a * h + b) & MASK64) >> 32 for h in hashes) for a, b in zip(self.a, self.b)]
+            return array("I", values)
+
+        a = np.array(self.a, dtype=np.uint64)[:, None]
+        b = np.array(self.b, dtype=np.uint64)[:, None]
+        hashes = np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+        values = np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        for start in range(0, len(hashes), self.BLOCK_SIZE):
+            block = hashes[None, start:start + self.BLOCK_SIZE]
+            # uint64乘法和加法按2^64取模
+            np.minimum(values, ((a * block + b) >> np.uint64(32)).min(axis=1), out=values)
+        return array("I", values.astype(np.uint32).tolist())
+
+
+class DuplicateIndex:
+    """近似重复文档索引（MinHash + LSH）
+
+    签名按 bands 段切分，每段的取值作为一个桶的键；两个文档只要有一段完全相同就成为候选，
+    再用签名估计的Jaccard相似度确认。查找只需访问 bands 个桶，不必与全部文档比较。
+    每段 num_perm / bands 行，相似度为 s 的两个文档成为候选的概率为 1 - (1 - s^行数)^段数，
+    默认16段×8行时相似度0.8以上的文档几乎都会成为候选，0.5以下的很少成为候选。
+    签名保存在 store_dir 下的JSON文件中，桶在加载时根据签名重建。
+    """
+
+    VERSION = 1
+
+    def __init__(self, store_dir, hasher, signature="", threshold=0.8, bands=16):
+        """初始化近似重复索引
+
+        Args:
+            store_dir: 存储目录
+            hasher: MinHasher 实例
+            signature: 分词方式等影响签名的标识，与已保存的不一致时清空重建
+            threshold: 认定为近似重复的最低相似度
+            bands: LSH分段数，须能整除签名长度
+        """
+        if hasher.num_perm % bands:
+            raise ValueError(f"签名长度 {hasher.num_perm} 不能被分段数 {bands} 整除")
+        self.store_dir = store_dir
+        self.index_file = os.path.join(store_dir, "minhash.json")
+        self.hasher = hasher
+        self.signature = f"{hasher.signature}/{signature}"
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = hasher.num_perm // bands
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        # 文件ID -> 签名
+        self.signatures = {}
+        # (段序号, 段取值) -> 文件ID集合
+        self.buckets = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """加载签名并重建桶，版本或签名方式不符时从空索引开始"""
+        self.clear()
+        self.dirty = False
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != self.VERSION or data.get("signature") != self.signature:
+                self.dirty = True
+                return
+            for file_id, encoded in data.get("files", {}).items():
+                values = array("I")
+                values.frombytes(base64.b64decode(encoded))
+                self.add(file_id, values)
+            self.dirty = False
+        except Exception as e:
+            print(f"加载近似重复索引时出错: {e}")
+            self.clear()
+
+    def save(self):
+        """保存签名，没有修改时不写盘"""
+        if not self.dirty:
+            return
+        data = {
+            "version": self.VERSION,
+            "signature": self.signature,
+            "files": {
+                file_id: base64.b64encode(values.tobytes()).decode("ascii")
+                for file_id, values in self.signatures.items()
+            }
+        }
+        try:
+            tmp_path = self.index_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, self.index_file)
+            self.dirty = False
+        except Exception as e:
+            print(f"保存近似重复索引时出错: {e}")
+
+    def clear(self):
+        """清空索引"""
+        self.signatures = {}
+        self.buckets = {}
+        self.dirty = True
+
+    def has_file(self, file_id):
+        """检查文件是否已有签名"""
+        return file_id in self.signatures
+
+    def file_ids(self):
+        """获取已有签名的所有文件ID"""
+        return list(self.signatures.keys())
+
+    def _band_keys(self, values):
+        """签名各段对应的桶键"""
+        for band in range(self.bands):
+            yield band, values[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def add(self, file_id, values):
+        """加入文件的签名，已存在的签名会被替换
+
+        Args:
+            file_id: 文件ID
+            values: MinHasher.minhash 返回的签名
+        """
+        self.remove(file_id)
+        self.signatures[file_id] = values
+        for key in self._band_keys(values):
+            self.buckets.setdefault(key, set()).add(file_id)
+        self.dirty = True
+
+    def remove(self, file_id):
+        """删除文件的签名
+
+        Returns:
+            bool: 文件是否有签名
+        """
+        values = self.signatures.pop(file_id, None)
+        if values is None:
+            return False
+        for key in self._band_keys(values):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(file_id)
+                if not bucket:
+                    del self.buckets[key]
+        self.dirty = True
+        return True
+
+    def similarity(self, a, b):
+        """由签名估计的Jaccard相似度"""
+        return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+    def query(self, values, exclude=None):
+        """查找与签名近似重复的文件
+
+        Args:
+            values: MinHasher.minhash 返回的签名
+            exclude: 不参与比较的文件ID
+
+        Returns:
+            list: [(文件ID, 估计相似度), ...]，相似度不低于 threshold，按相似度从高到低、文件ID升序排列
+        """
+        candidates = set()
+        for key in self._band_keys(values):
+            candidates.update(self.buckets.get(key, ()))
+        candidates.discard(exclude)
+
+        matches = []
+        for file_id in candidates:
+            score = self.similarity(values, self.signatures[file_id])
+            if score >= self.threshold:
+                matches.append((file_id, score))
+        matches.sort(key=lambda item: (-item[1], item[0]))
+        return matches
@@ -0,0 +1,1238 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import math
+import mmap
+import heapq
+import struct
+from array import array
+
+# 参与排序的字段
+FIELDS = ("title", "summary", "body")
+
+# 倒排记录中各字段词频所用的键
+FIELD_KEYS = {"title": "t", "summary": "s", "body": "b"}
+
+
+def _write_varint(buffer, value):
+    """将非负整数按7位一组的变长编码追加到 bytearray"""
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varints(data):
+    """将变长编码的字节串解码为整数列表"""
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        if byte & 0x80:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+        else:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
+    return values
+
+
+class InvertedIndex:
+    """知识库倒排索引
+
+    在文件入库时建立 词项 -> 倒排记录 的映射，查询时只需读取查询词对应的倒排记录，
+    不必再对所有文档重新分段、分词。
+
+    倒排记录格式（lookup 返回的结构）：
+        {"t": 标题词频, "s": 摘要词频, "b": 正文词频, "c": [[片段序号, 词频], ...]}
+    片段由 TextChunker 在入库时切分，片段序号与 ContentStore 中保存的片段一致。
+    同时保存词项在各片段标记序列中的位置，按需用 get_positions 读取，用于短语查询、邻近度打分和摘要截取。
+
+    磁盘上使用带版本号的二进制格式（见 save），加载时以只读方式内存映射，
+    只解析文件ID和各表的位置，倒排记录在查询时按词项解码，不会把全部倒排记录读成Python对象。
+    加载后新增的文件保存在内存中的增量部分，删除已保存的文件只做标记，保存时合并为新文件。
+    同时保存每个文件各字段的长度和每个片段的长度，用于BM25的长度归一化。
+    """
+
+    MAGIC = b"KBIX"
+    VERSION = 5
+
+    # 文件头：魔数、版本、文件数（含已删除）、词项数、有效文件的各字段长度总和、片段数、片段长度总和，
+    # 以及各数据段的起始位置
+    SECTIONS = ("doc_offsets", "doc_blob", "doc_flags", "doc_lengths", "chunk_offsets", "chunk_lengths",
+                "term_offsets", "term_blob", "postings_offsets", "term_df", "postings",
+                "positions_offsets", "positions", "end")
+    HEADER = struct.Struct("<4sIII" + "Q" * 5 + "Q" * len(SECTIONS))
+
+    def __init__(self, index_file):
+        """初始化倒排索引
+
+        Args:
+            index_file: 倒排索引文件路径
+        """
+        self.index_file = index_file
+        self._mmap = None
+        self._file = None
+        self._views = []
+        self.load()
+
+    def load(self):
+        """从磁盘加载倒排索引，文件损坏或版本不符时从空索引开始"""
+        self.clear()
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            self._open_base()
+        except Exception as e:
+            print(f"加载倒排索引时出错: {e}")
+            self.clear()
+
+    def _open_base(self):
+        """内存映射索引文件，读取文件头、文件ID和各表"""
+        self._file = open(self.index_file, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.HEADER.unpack_from(self._mmap, 0)
+        magic, version, doc_count, term_count = header[:4]
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("倒排索引格式或版本不符")
+        title_total, summary_total, body_total, chunk_count, chunk_total = header[4:9]
+        sections = dict(zip(self.SECTIONS, header[9:]))
+        if sections["end"] != len(self._mmap):
+            raise ValueError("倒排索引文件不完整")
+
+        self._base_doc_count = doc_count
+        self._term_count = term_count
+        self.field_totals = {"title": title_total, "summary": summary_total, "body": body_total}
+        self.chunk_count = chunk_count
+        self.chunk_total = chunk_total
+
+        self._doc_lengths = self._table(sections["doc_lengths"], doc_count * 3, "I")
+        self._chunk_offsets = self._table(sections["chunk_offsets"], doc_count + 1, "Q")
+        self._chunk_lengths = self._table(sections["chunk_lengths"], self._chunk_offsets[doc_count], "I")
+        # 已删除的文件保留在文件中，只标记为删除
+        doc_flags = self._table(sections["doc_flags"], doc_count, "B")
+        self._deleted = {slot for slot in range(doc_count) if doc_flags[slot]}
+        self._term_offsets = self._table(sections["term_offsets"], term_count + 1, "Q")
+        self._postings_offsets = self._table(sections["postings_offsets"], term_count + 1, "Q")
+        self._term_df = self._table(sections["term_df"], term_count, "I")
+        self._term_blob = sections["term_blob"]
+        self._postings_start = sections["postings"]
+        self._positions_offsets = self._table(sections["positions_offsets"], term_count + 1, "Q")
+        self._positions_start = sections["positions"]
+
+        # 文件ID需要全部读出，用于判断文件是否存在和返回查询结果
+        doc_offsets = self._table(sections["doc_offsets"], doc_count + 1, "Q")
+        doc_blob = self._mmap[sections["doc_blob"]:sections["doc_blob"] + (doc_offsets[doc_count] if doc_count else 0)]
+        self._base_ids = [
+            doc_blob[doc_offsets[slot]:doc_offsets[slot + 1]].decode("utf-8") for slot in range(doc_count)
+        ]
+        self._base_slots = {
+            file_id: slot for slot, file_id in enumerate(self._base_ids) if slot not in self._deleted
+        }
+
+    def _table(self, offset, count, typecode):
+        """取文件中的定长整数表；小端平台上直接映射为内存视图，不复制数据"""
+        size = count * array(typecode).itemsize
+        if sys.byteorder == "little":
+            view = memoryview(self._mmap)[offset:offset + size].cast(typecode)
+            self._views.append(view)
+            return view
+        table = array(typecode)
+        table.frombytes(self._mmap[offset:offset + size])
+        table.byteswap()
+        return table
+
+    def _close_base(self):
+        """释放内存映射（Windows上被映射的文件不能被替换）"""
+        for view in self._views:
+            view.release()
+        self._views = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def clear(self):
+        """清空倒排索引"""
+        self._close_base()
+        # 已保存部分（内存映射）
+        self._base_doc_count = 0
+        self._term_count = 0
+        self._base_ids = []
+        self._base_slots = {}
+        self._deleted = set()
+        self._doc_lengths = array("I")
+        self._chunk_offsets = array("Q", [0])
+        self._chunk_lengths = array("I")
+        self._term_offsets = array("Q", [0])
+        self._postings_offsets = array("Q", [0])
+        self._term_df = array("I")
+        self._term_blob = 0
+        self._postings_start = 0
+        self._positions_offsets = array("Q", [0])
+        self._positions_start = 0
+        # 加载后新增的部分：postings[词项][文件ID] = 倒排记录（"p" 中为各片段内的词项位置）
+        self.postings = {}
+        # 文件ID -> 该文件出现过的词项，用于删除文件时快速清理倒排记录
+        self.doc_terms = {}
+        # 文件ID -> {"title": 长度, "summary": 长度, "body": 长度}
+        self.doc_lengths = {}
+        # 文件ID -> [片段长度, ...]
+        self.chunk_lengths = {}
+        # 各字段长度总和，用于计算平均长度
+        self.field_totals = {field: 0 for field in FIELDS}
+        # 片段总数和片段长度总和，用于计算片段平均长度
+        self.chunk_count = 0
+        self.chunk_total = 0
+        # 最近解码的倒排记录，索引变化时清空
+        self._decoded = {}
+
+    def _base_slot(self, file_id):
+        """文件在已保存部分中的序号，不存在或已删除时返回None"""
+        slot = self._base_slots.get(file_id)
+        if slot is None or slot in self._deleted:
+            return None
+        return slot
+
+    def has_document(self, file_id):
+        """检查文件是否已建立倒排索引"""
+        return file_id in self.doc_terms or self._base_slot(file_id) is not None
+
+    def document_ids(self):
+        """获取已建立倒排索引的所有文件ID"""
+        ids = [file_id for slot, file_id in enumerate(self._base_ids) if slot not in self._deleted]
+        return ids + list(self.doc_terms.keys())
+
+    @property
+    def document_count(self):
+        """已建立倒排索引的文件数"""
+        return self._base_doc_count - len(self._deleted) + len(self.doc_terms)
+
+    def get_doc_lengths(self, file_id):
+        """文件各字段的长度 {"title": 长度, "summary": 长度, "body": 长度}"""
+        if file_id in self.doc_lengths:
+            return self.doc_lengths[file_id]
+        slot = self._base_slot(file_id)
+        if slot is None:
+            return {}
+        return dict(zip(FIELDS, self._doc_lengths[slot * 3:slot * 3 + 3]))
+
+    def get_chunk_lengths(self, file_id):
+        """文件各片段的长度列表"""
+        if file_id in self.chunk_lengths:
+            return self.chunk_lengths[file_id]
+        slot = self._base_slot(file_id)
+        if slot is None:
+            return []
+        return self._chunk_lengths[self._chunk_offsets[slot]:self._chunk_offsets[slot + 1]].tolist()
+
+    def document_frequency(self, term):
+        """包含词项的文件数"""
+        return len(self.term_postings(term))
+
+    def average_length(self, field):
+        """字段的平均长度"""
+        if not self.document_count:
+            return 0
+        return self.field_totals[field] / self.document_count
+
+    def average_chunk_length(self):
+        """片段的平均长度"""
+        if not self.chunk_count:
+            return 0
+        return self.chunk_total / self.chunk_count
+
+    def add_document(self, file_id, title_tokens, summary_tokens, body_tokens, chunk_tokens):
+        """为文件建立倒排记录，已存在的记录会被替换
+
+        Args:
+            file_id: 文件ID，格式为"分区/文件名"
+            title_tokens: 标题的标记列表（保留重复词）
+            summary_tokens: 摘要的标记列表（保留重复词）
+            body_tokens: 正文的标记列表（不含片段之间重叠的部分）
+            chunk_tokens: 按片段序号排列的各片段标记列表
+
+        Returns:
+            int: 该文件包含的不同词项数
+        """
+        entries = {}
+
+        for token in title_tokens:
+            entry = entries.setdefault(token, {})
+            entry["t"] = entry.get("t", 0) + 1
+
+        for token in summary_tokens:
+            entry = entries.setdefault(token, {})
+            entry["s"] = entry.get("s", 0) + 1
+
+        for token in body_tokens:
+            entry = entries.setdefault(token, {})
+            entry["b"] = entry.get("b", 0) + 1
+
+        for chunk_no, tokens in enumerate(chunk_tokens):
+            chunk_positions = {}
+            for position, token in enumerate(tokens):
+                chunk_positions.setdefault(token, []).append(position)
+            for token, positions in chunk_positions.items():
+                entry = entries.setdefault(token, {})
+                entry.setdefault("c", []).append([chunk_no, len(positions)])
+                entry.setdefault("p", []).append(positions)
+
+        lengths = {
+            "title": len(title_tokens),
+            "summary": len(summary_tokens),
+            "body": len(body_tokens)
+        }
+        self.put_document(file_id, entries, lengths, [len(tokens) for tokens in chunk_tokens])
+        return len(entries)
+
+    def put_document(self, file_id, entries, lengths, chunk_lengths):
+        """写入文件已统计好的倒排记录，已存在的记录会被替换
+
+        Args:
+            file_id: 文件ID
+            entries: {词项: 倒排记录}，"p" 为与 "c" 一一对应的片段内词项位置
+            lengths: {"title": 长度, "summary": 长度, "body": 长度}
+            chunk_lengths: 按片段序号排列的片段长度
+        """
+        self.remove_document(file_id)
+        self._decoded = {}
+
+        for token, entry in entries.items():
+            self.postings.setdefault(token, {})[file_id] = entry
+
+        self.doc_terms[file_id] = list(entries.keys())
+        self.doc_lengths[file_id] = lengths
+        for field in FIELDS:
+            self.field_totals[field] += lengths.get(field, 0)
+
+        self.chunk_lengths[file_id] = list(chunk_lengths)
+        self.chunk_count += len(chunk_lengths)
+        self.chunk_total += sum(chunk_lengths)
+
+    def remove_document(self, file_id):
+        """删除文件的倒排记录
+
+        Args:
+            file_id: 文件ID
+
+        Returns:
+            bool: 文件是否存在于倒排索引中
+        """
+        slot = self._base_slot(file_id)
+        if slot is not None:
+            # 已保存的文件只做删除标记，保存时才真正移除
+            lengths = self.get_doc_lengths(file_id)
+            chunk_lengths = self.get_chunk_lengths(file_id)
+            self._deleted.add(slot)
+        else:
+            terms = self.doc_terms.pop(file_id, None)
+            if terms is None:
+                return False
+
+            for token in terms:
+                term_postings = self.postings.get(token)
+                if not term_postings:
+                    continue
+                term_postings.pop(file_id, None)
+                if not term_postings:
+                    del self.postings[token]
+
+            lengths = self.doc_lengths.pop(file_id, {})
+            chunk_lengths = self.chunk_lengths.pop(file_id, [])
+
+        self._decoded = {}
+        for field in FIELDS:
+            self.field_totals[field] -= lengths.get(field, 0)
+        self.chunk_count -= len(chunk_lengths)
+        self.chunk_total -= sum(chunk_lengths)
+        return True
+
+    def _find_term(self, term):
+        """在已保存部分按字节序二分查找词项，返回词项序号，不存在时返回None"""
+        key = term.encode("utf-8")
+        offsets = self._term_offsets
+        start = self._term_blob
+        lo, hi = 0, self._term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._mmap[start + offsets[mid]:start + offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._term_count and self._mmap[start + offsets[lo]:start + offsets[lo + 1]] == key:
+            return lo
+        return None
+
+    def _decode_postings(self, term_slot):
+        """解码已保存部分中一个词项的倒排记录
+
+        Returns:
+            list: [(文件序号, 倒排记录), ...]，按文件序号升序排列
+        """
+        start = self._postings_start + self._postings_offsets[term_slot]
+        end = self._postings_start + self._postings_offsets[term_slot + 1]
+        values = _read_varints(self._mmap[start:end])
+        # 各文件的词项位置在位置段中依次存放，倒排记录中只保存其字节数
+        position_offset = self._positions_start + self._positions_offsets[term_slot]
+
+        results = []
+        slot = 0
+        i = 0
+        while i < len(values):
+            slot += values[i]
+            entry = {}
+            for key, tf in zip("tsb", values[i + 1:i + 4]):
+                if tf:
+                    entry[key] = tf
+            chunk_total = values[i + 4]
+            i += 5
+            if chunk_total:
+                chunks = []
+                chunk_no = 0
+                for _ in range(chunk_total):
+                    chunk_no += values[i]
+                    chunks.append([chunk_no, values[i + 1]])
+                    i += 2
+                entry["c"] = chunks
+            entry["o"] = (position_offset, position_offset + values[i])
+            position_offset += values[i]
+            i += 1
+            results.append((slot, entry))
+        return results
+
+    def get_positions(self, entry):
+        """读取倒排记录中词项在各片段内的位置
+
+        Args:
+            entry: term_postings 或 lookup 返回的倒排记录
+
+        Returns:
+            list: [[位置, ...], ...]，与 entry["c"] 中的片段一一对应，位置为片段标记序列中的序号
+        """
+        if "p" in entry:
+            return entry["p"]
+        start, end = entry.get("o", (0, 0))
+        values = _read_varints(self._mmap[start:end]) if end > start else []
+        positions = []
+        i = 0
+        for _, tf in entry.get("c", []):
+            position = 0
+            chunk_positions = []
+            for delta in values[i:i + tf]:
+                position += delta
+                chunk_positions.append(position)
+            positions.append(chunk_positions)
+            i += tf
+        return positions
+
+    def chunk_positions(self, file_id, tokens, chunk_nos=None):
+        """文件各片段中任一给定词项出现的位置
+
+        Args:
+            file_id: 文件ID
+            tokens: 词项列表
+            chunk_nos: 只返回这些片段，为None时返回全部
+
+        Returns:
+            dict: 片段序号 -> 升序排列的位置列表
+        """
+        wanted = None if chunk_nos is None else set(chunk_nos)
+        result = {}
+        for token in tokens:
+            entry = self.term_postings(token).get(file_id)
+            if entry is None:
+                continue
+            for (chunk_no, _), positions in zip(entry.get("c", []), self.get_positions(entry)):
+                if wanted is None or chunk_no in wanted:
+                    result.setdefault(chunk_no, []).extend(positions)
+        for positions in result.values():
+            positions.sort()
+        return result
+
+    def phrase_matches(self, phrase_tokens, file_ids=None):
+        """查找短语（按顺序连续出现的标记序列）出现的片段
+
+        按文档频率从低到高对各词项的倒排记录求交集，只为同时含有全部词项的片段解码位置，
+        不必扫描文档。短语只在片段内匹配，片段之间的重叠部分保证跨行的短语也能完整出现在某个片段中。
+
+        Args:
+            phrase_tokens: 短语的标记列表（保留顺序和重复）
+            file_ids: 限定的文件ID集合，为None时不限制
+
+        Returns:
+            dict: 文件ID -> {片段序号: [短语起始位置, ...]}
+        """
+        if not phrase_tokens:
+            return {}
+        distinct = sorted(set(phrase_tokens), key=lambda token: len(self.term_postings(token)))
+        postings = [self.term_postings(token) for token in distinct]
+
+        matches = {}
+        for file_id, entry in postings[0].items():
+            if file_ids is not None and file_id not in file_ids:
+                continue
+            entries = [entry] + [term_postings.get(file_id) for term_postings in postings[1:]]
+            if None in entries:
+                continue
+            chunk_sets = [{chunk_no for chunk_no, _ in item.get("c", [])} for item in entries]
+            common = chunk_sets[0].intersection(*chunk_sets[1:])
+            if not common:
+                continue
+
+            positions = {}
+            for token, item in zip(distinct, entries):
+                positions[token] = {
+                    chunk_no: chunk_positions
+                    for (chunk_no, _), chunk_positions in zip(item.get("c", []), self.get_positions(item))
+                    if chunk_no in common
+                }
+            for chunk_no in sorted(common):
+                starts = set(positions[phrase_tokens[0]][chunk_no])
+                for offset, token in enumerate(phrase_tokens[1:], 1):
+                    starts &= {position - offset for position in positions[token][chunk_no]}
+                    if not starts:
+                        break
+                if starts:
+                    matches.setdefault(file_id, {})[chunk_no] = sorted(starts)
+        return matches
+
+    def term_postings(self, term):
+        """读取词项的全部倒排记录（已保存部分和新增部分合并，不含已删除的文件）
+
+        Returns:
+            dict: 文件ID -> 倒排记录，调用方不应修改
+        """
+        merged = self._decoded.get(term)
+        if merged is not None:
+            return merged
+
+        merged = {}
+        term_slot = self._find_term(term) if self._term_count else None
+        if term_slot is not None:
+            for slot, entry in self._decode_postings(term_slot):
+                if slot not in self._deleted:
+                    merged[self._base_ids[slot]] = entry
+        merged.update(self.postings.get(term, {}))
+
+        # 只缓存少量最近查询的词项
+        if len(self._decoded) >= 256:
+            self._decoded = {}
+        self._decoded[term] = merged
+        return merged
+
+    def lookup(self, query_tokens, file_ids=None):
+        """读取查询词的倒排记录，并按文件归组
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            file_ids: 限定的文件ID集合，为None时不限制
+
+        Returns:
+            dict: 文件ID -> {词项: 倒排记录}
+        """
+        matches = {}
+        for token in query_tokens:
+            for file_id, entry in self.term_postings(token).items():
+                if file_ids is not None and file_id not in file_ids:
+                    continue
+                matches.setdefault(file_id, {})[token] = entry
+        return matches
+
+    def _iter_base_terms(self):
+        """按字节序逐个产生已保存部分的 (词项字节串, 词项序号)"""
+        offsets = self._term_offsets
+        start = self._term_blob
+        for term_slot in range(self._term_count):
+            yield self._mmap[start + offsets[term_slot]:start + offsets[term_slot + 1]], term_slot
+
+    def save(self):
+        """将已保存部分与新增部分合并，写入新的二进制索引文件
+
+        文件为小端字节序，各数据段按8字节对齐，可直接内存映射：
+            文件头 | 文件ID偏移表 | 文件ID字符串 | 删除标记 | 字段长度表 | 片段偏移表 | 片段长度表
+                   | 词项偏移表 | 词项字符串（按UTF-8字节序排列） | 倒排记录偏移表 | 文档频率表 | 倒排记录
+                   | 位置偏移表 | 词项位置
+        每个词项的倒排记录按文件序号升序排列，文件序号和片段序号均做差分，所有整数使用变长编码。
+        倒排记录末尾是该文件的词项位置所占的字节数；位置按倒排记录和片段的顺序依次存放，
+        片段内的位置做差分，只在需要位置时才解码。
+        文档频率表包含已删除文件，实际的文档频率在查询时由解码后的倒排记录得出。
+        """
+        tmp_path = self.index_file + ".tmp"
+        try:
+            self._write(tmp_path)
+            # 先释放内存映射再替换文件，替换后重新映射新文件
+            self._close_base()
+            os.replace(tmp_path, self.index_file)
+            self.load()
+        except Exception as e:
+            print(f"保存倒排索引时出错: {e}")
+
+    def _write(self, path):
+        """合并全部倒排记录并写入文件"""
+        # 已删除的文件不超过四分之一时保留其位置（只做删除标记），已保存部分的文件序号不变，
+        # 不涉及新增文件的词项可直接复制编码后的倒排记录；否则重新编号并重写全部倒排记录
+        compact = len(self._deleted) * 4 > self._base_doc_count
+        if compact:
+            base_slots = [slot for slot in range(self._base_doc_count) if slot not in self._deleted]
+        else:
+            base_slots = list(range(self._base_doc_count))
+        new_slots = {old: new for new, old in enumerate(base_slots)}
+        overlay_slots = {file_id: len(base_slots) + i for i, file_id in enumerate(self.doc_terms)}
+
+        doc_offsets = array("Q", [0])
+        doc_blob = bytearray()
+        doc_flags = array("B")
+        doc_lengths = array("I")
+        chunk_offsets = array("Q", [0])
+        chunk_lengths = array("I")
+        totals = [0, 0, 0, 0, 0]
+        for slot in base_slots:
+            doc_blob += self._base_ids[slot].encode("utf-8")
+            doc_offsets.append(len(doc_blob))
+            lengths = self._doc_lengths[slot * 3:slot * 3 + 3].tolist()
+            chunks = self._chunk_lengths[self._chunk_offsets[slot]:self._chunk_offsets[slot + 1]].tolist()
+            doc_flags.append(1 if slot in self._deleted else 0)
+            doc_lengths.extend(lengths)
+            chunk_lengths.extend(chunks)
+            chunk_offsets.append(len(chunk_lengths))
+            if slot not in self._deleted:
+                totals = [a + b for a, b in zip(totals, lengths + [len(chunks), sum(chunks)])]
+        for file_id in self.doc_terms:
+            doc_blob += file_id.encode("utf-8")
+            doc_offsets.append(len(doc_blob))
+            lengths = [self.doc_lengths[file_id].get(field, 0) for field in FIELDS]
+            chunks = self.chunk_lengths.get(file_id, [])
+            doc_flags.append(0)
+            doc_lengths.extend(lengths)
+            chunk_lengths.extend(chunks)
+            chunk_offsets.append(len(chunk_lengths))
+            totals = [a + b for a, b in zip(totals, lengths + [len(chunks), sum(chunks)])]
+
+        term_offsets = array("Q", [0])
+        term_blob = bytearray()
+        postings_offsets = array("Q", [0])
+        term_df = array("I")
+        postings = bytearray()
+        positions_offsets = array("Q", [0])
+        positions = bytearray()
+
+        # 已保存部分和新增部分的词项都按字节序排列，归并后逐个词项合并倒排记录
+        overlay_terms = sorted(((term.encode("utf-8"), None) for term in self.postings), key=lambda item: item[0])
+        merged_terms = heapq.merge(self._iter_base_terms(), overlay_terms, key=lambda item: item[0])
+        for key, group in self._group_terms(merged_terms):
+            if not compact and group[0] is not None and len(group) == 1:
+                term_slot = group[0]
+                start = self._postings_start + self._postings_offsets[term_slot]
+                postings += self._mmap[start:self._postings_start + self._postings_offsets[term_slot + 1]]
+                start = self._positions_start + self._positions_offsets[term_slot]
+                positions += self._mmap[start:self._positions_start + self._positions_offsets[term_slot + 1]]
+                term_blob += key
+                term_offsets.append(len(term_blob))
+                postings_offsets.append(len(postings))
+                positions_offsets.append(len(positions))
+                term_df.append(self._term_df[term_slot])
+                continue
+
+            entries = []
+            for term_slot in group:
+                if term_slot is None:
+                    term = key.decode("utf-8")
+                    entries.extend((overlay_slots[file_id], entry) for file_id, entry in self.postings[term].items())
+                else:
+                    entries.extend(
+                        (new_slots[slot], entry) for slot, entry in self._decode_postings(term_slot)
+                        if slot in new_slots
+                    )
+            if not entries:
+                continue
+            entries.sort(key=lambda item: item[0])
+
+            previous = 0
+            for slot, entry in entries:
+                _write_varint(postings, slot - previous)
+                previous = slot
+                for field_key in "tsb":
+                    _write_varint(postings, entry.get(field_key, 0))
+                chunks = entry.get("c", [])
+                _write_varint(postings, len(chunks))
+                previous_chunk = 0
+                for chunk_no, tf in chunks:
+                    _write_varint(postings, chunk_no - previous_chunk)
+                    _write_varint(postings, tf)
+                    previous_chunk = chunk_no
+
+                size = len(positions)
+                for chunk_positions in self.get_positions(entry):
+                    previous_position = 0
+                    for position in chunk_positions:
+                        _write_varint(positions, position - previous_position)
+                        previous_position = position
+                _write_varint(postings, len(positions) - size)
+
+            term_blob += key
+            term_offsets.append(len(term_blob))
+            postings_offsets.append(len(postings))
+            positions_offsets.append(len(positions))
+            term_df.append(len(entries))
+
+        sections = [doc_offsets, doc_blob, doc_flags, doc_lengths, chunk_offsets, chunk_lengths,
+                    term_offsets, term_blob, postings_offsets, term_df, postings, positions_offsets, positions]
+        offsets = []
+        position = self.HEADER.size
+        for data in sections:
+            position += -position % 8
+            offsets.append(position)
+            position += len(data) * (data.itemsize if isinstance(data, array) else 1)
+        offsets.append(position)
+
+        header = self.HEADER.pack(
+            self.MAGIC, self.VERSION, len(doc_flags), len(term_df), *totals, *offsets
+        )
+        with open(path, "wb") as f:
+            f.write(header)
+            for offset, data in zip(offsets, sections):
+                f.write(b"\0" * (offset - f.tell()))
+                if isinstance(data, array):
+                    if sys.byteorder != "little":
+                        data = array(data.typecode, data)
+                        data.byteswap()
+                    data.tofile(f)
+                else:
+                    f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _group_terms(merged_terms):
+        """将按字节序合并后的 (词项字节串, 词项序号) 按词项归组"""
+        current = None
+        group = []
+        for key, term_slot in merged_terms:
+            if key != current:
+                if group:
+                    yield current, group
+                current = key
+                group = []
+            group.append(term_slot)
+        if group:
+            yield current, group
+
+
+class ShardedIndex:
+    """按分区划分的倒排索引
+
+    每个分区一个 InvertedIndex 分片（<分区>.bin），文件按文件ID中的分区名称归入分片。
+    按分区筛选的检索只读取相关分片；保存时只重写发生变化的分片，向一个分区添加文件不会重写其他分区。
+    目录中同时记录建立索引时的分词方式，与当前分词方式不一致的分片直接丢弃，由调用方重建。
+    """
+
+    SUFFIX = ".bin"
+
+    def __init__(self, shard_dir, legacy_files=(), signature=""):
+        """初始化分片索引
+
+        Args:
+            shard_dir: 分片文件所在目录
+            legacy_files: 旧版整体倒排索引文件，其中没有词项位置，直接删除，由调用方根据已保存的片段重建
+            signature: 分词方式的标识（如 Analyzer.signature）
+        """
+        self.shard_dir = shard_dir
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.signature = signature
+        self.signature_file = os.path.join(self.shard_dir, "signature")
+        self._saved_signature = None
+        if os.path.exists(self.signature_file):
+            with open(self.signature_file, "r", encoding="utf-8") as f:
+                self._saved_signature = f.read()
+        # 分区名称 -> InvertedIndex
+        self.shards = {}
+        # 自上次保存后发生变化的分区
+        self.dirty = set()
+        for filename in sorted(os.listdir(self.shard_dir)):
+            if not filename.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.shard_dir, filename)
+            if self._saved_signature != self.signature:
+                os.remove(path)
+                continue
+            self.shards[filename[:-len(self.SUFFIX)]] = InvertedIndex(path)
+        for path in legacy_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def category_of(file_id):
+        """文件ID中的分区名称"""
+        return file_id.split("/", 1)[0]
+
+    def shard(self, category):
+        """获取分区的分片，不存在时创建"""
+        index = self.shards.get(category)
+        if index is None:
+            index = InvertedIndex(os.path.join(self.shard_dir, category + self.SUFFIX))
+            self.shards[category] = index
+        return index
+
+    def shards_for(self, categories=None):
+        """获取要检索的分片
+
+        Args:
+            categories: 分区名称列表，为None时返回全部分片
+
+        Returns:
+            list: [(分区名称, InvertedIndex), ...]，只包含有文件的分片
+        """
+        names = self.shards.keys() if categories is None else categories
+        return [
+            (name, self.shards[name]) for name in names
+            if name in self.shards and self.shards[name].document_count
+        ]
+
+    def has_document(self, file_id):
+        """检查文件是否已建立倒排索引"""
+        index = self.shards.get(self.category_of(file_id))
+        return index is not None and index.has_document(file_id)
+
+    def document_ids(self):
+        """获取已建立倒排索引的所有文件ID"""
+        return [file_id for index in self.shards.values() for file_id in index.document_ids()]
+
+    @property
+    def document_count(self):
+        """已建立倒排索引的文件数"""
+        return sum(index.document_count for index in self.shards.values())
+
+    def add_document(self, file_id, title_tokens, summary_tokens, body_tokens, chunk_tokens):
+        """为文件建立倒排记录，参数同 InvertedIndex.add_document"""
+        category = self.category_of(file_id)
+        self.dirty.add(category)
+        return self.shard(category).add_document(file_id, title_tokens, summary_tokens, body_tokens, chunk_tokens)
+
+    def chunk_positions(self, file_id, tokens, chunk_nos=None):
+        """文件各片段中任一给定词项出现的位置，参数同 InvertedIndex.chunk_positions"""
+        index = self.shards.get(self.category_of(file_id))
+        if index is None:
+            return {}
+        return index.chunk_positions(file_id, tokens, chunk_nos)
+
+    def remove_document(self, file_id):
+        """删除文件的倒排记录
+
+        Returns:
+            bool: 文件是否存在于倒排索引中
+        """
+        category = self.category_of(file_id)
+        index = self.shards.get(category)
+        if index is None or not index.remove_document(file_id):
+            return False
+        self.dirty.add(category)
+        return True
+
+    def save(self):
+        """只保存发生变化的分片，分片全部写入后再记录分词方式"""
+        for category in sorted(self.dirty):
+            if category in self.shards:
+                self.shards[category].save()
+        self.dirty = set()
+        if self._saved_signature != self.signature:
+            try:
+                tmp_path = self.signature_file + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(self.signature)
+                os.replace(tmp_path, self.signature_file)
+                self._saved_signature = self.signature
+            except Exception as e:
+                print(f"保存分词方式标识时出错: {e}")
+
+
+class CollectionStats:
+    """多个分片合并后的BM25统计量（文件数、文档频率、平均长度）
+
+    与 InvertedIndex 提供相同的统计接口，可作为 BM25FScorer 的 stats 参数，
+    使各分片的分数按同一组统计量计算，可以直接合并比较。
+    """
+
+    def __init__(self, indexes, frequencies):
+        """初始化统计量
+
+        Args:
+            indexes: InvertedIndex 列表
+            frequencies: 与 indexes 对应的 {词项: 文档频率} 列表
+        """
+        self.document_count = sum(index.document_count for index in indexes)
+        self.field_totals = {field: sum(index.field_totals[field] for index in indexes) for field in FIELDS}
+        self.chunk_count = sum(index.chunk_count for index in indexes)
+        self.chunk_total = sum(index.chunk_total for index in indexes)
+        self.frequencies = {}
+        for term_frequencies in frequencies:
+            for term, df in term_frequencies.items():
+                self.frequencies[term] = self.frequencies.get(term, 0) + df
+
+    def document_frequency(self, term):
+        """包含词项的文件数"""
+        return self.frequencies.get(term, 0)
+
+    def average_length(self, field):
+        """字段的平均长度"""
+        if not self.document_count:
+            return 0
+        return self.field_totals[field] / self.document_count
+
+    def average_chunk_length(self):
+        """片段的平均长度"""
+        if not self.chunk_count:
+            return 0
+        return self.chunk_total / self.chunk_count
+
+
+class BM25FScorer:
+    """基于倒排索引的BM25F排序
+
+    各字段的词频先按字段长度归一化并乘以字段权重，合并为一个伪词频后再做饱和，
+    最后乘以词项的IDF。文档频率和字段长度均在入库时预先计算。
+    命中文件中的各片段另按片段长度做BM25打分，用于挑选最相关的段落。
+    多个查询词在片段中相距很近时另加邻近度得分，文件取其最高的片段邻近度得分。
+    """
+
+    def __init__(self, index, field_weights=None, k1=1.2, b=0.75, stats=None,
+                 proximity_weight=0.0, proximity_window=5):
+        """初始化排序器
+
+        Args:
+            index: InvertedIndex 实例
+            field_weights: 字段权重，如 {"title": 2.0, "summary": 1.5, "body": 1.0}
+            k1: 词频饱和参数
+            b: 长度归一化参数
+            stats: 计算IDF和平均长度所用的统计量（如多个分片合并的 CollectionStats），默认为 index 自身
+            proximity_weight: 邻近度得分的权重，为0时不计算邻近度
+            proximity_window: 相距不超过该标记数的两个查询词才计入邻近度
+        """
+        self.index = index
+        self.stats = stats or index
+        self.field_weights = field_weights or {"title": 2.0, "summary": 1.5, "body": 1.0}
+        self.k1 = k1
+        self.b = b
+        self.proximity_weight = proximity_weight
+        self.proximity_window = proximity_window
+
+    def idf(self, term):
+        """计算词项的IDF（BM25平滑形式，始终为正）"""
+        n = self.stats.document_count
+        df = self.stats.document_frequency(term)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def _length_norm(self, length, avg_length):
+        """BM25长度归一化因子"""
+        if avg_length <= 0:
+            return 1.0
+        return 1 - self.b + self.b * length / avg_length
+
+    def _field_norm(self, field, length):
+        """字段长度归一化因子"""
+        return self._length_norm(length, self.stats.average_length(field))
+
+    def _term_score(self, entry, norms, idf):
+        """文件在一个词项上的BM25F得分"""
+        pseudo_tf = 0.0
+        for field in FIELDS:
+            tf = entry.get(FIELD_KEYS[field], 0)
+            if tf:
+                pseudo_tf += self.field_weights.get(field, 1.0) * tf / norms[field]
+        if pseudo_tf <= 0:
+            return 0.0
+        return idf * pseudo_tf / (self.k1 + pseudo_tf)
+
+    def _doc_norms(self, file_id):
+        """文件各字段的长度归一化因子"""
+        lengths = self.index.get_doc_lengths(file_id)
+        return {field: self._field_norm(field, lengths.get(field, 0)) for field in FIELDS}
+
+    def _proximity(self, entries, idfs):
+        """各片段中查询词之间的邻近度得分（BM25TP）
+
+        片段中相距 d（不超过 proximity_window）个标记的两个不同查询词各自累积 1/d²，
+        每个词项的累积量按BM25的方式饱和后乘以IDF，因此每个词项贡献的邻近度得分小于其IDF。
+
+        Args:
+            entries: {词项: 倒排记录}，同一文件中命中的查询词
+            idfs: 词项 -> IDF
+
+        Returns:
+            dict: 片段序号 -> 未乘权重的邻近度得分，只包含得分大于0的片段
+        """
+        if not self.proximity_weight or len(entries) < 2:
+            return {}
+        occurrences = {}
+        for token, entry in entries.items():
+            for (chunk_no, _), positions in zip(entry.get("c", []), self.index.get_positions(entry)):
+                occurrences.setdefault(chunk_no, []).extend((position, token) for position in positions)
+
+        proximity = {}
+        for chunk_no, items in occurrences.items():
+            items.sort()
+            accumulated = {}
+            for i, (position, token) in enumerate(items):
+                for other_position, other_token in items[i + 1:]:
+                    distance = other_position - position
+                    if distance > self.proximity_window:
+                        break
+                    if other_token != token:
+                        weight = 1.0 / (distance * distance)
+                        accumulated[token] = accumulated.get(token, 0.0) + weight
+                        accumulated[other_token] = accumulated.get(other_token, 0.0) + weight
+            if accumulated:
+                proximity[chunk_no] = sum(
+                    idfs[token] * value / (self.k1 + value) for token, value in accumulated.items()
+                )
+        return proximity
+
+    def _chunk_scores(self, file_id, entries, idfs, avg_chunk_length, proximity=None):
+        """片段级BM25，用于挑选最相关的上下文片段
+
+        Args:
+            proximity: _proximity 的结果，按 proximity_weight 加到片段分数上
+
+        Returns:
+            dict: 片段序号 -> 片段分数
+        """
+        chunk_lengths = self.index.get_chunk_lengths(file_id)
+        chunk_scores = {}
+        for token, entry in entries.items():
+            for chunk_no, tf in entry.get("c", []):
+                length = chunk_lengths[chunk_no] if chunk_no < len(chunk_lengths) else 0
+                norm = self._length_norm(length, avg_chunk_length)
+                chunk_score = idfs[token] * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+                chunk_scores[chunk_no] = chunk_scores.get(chunk_no, 0.0) + chunk_score
+        for chunk_no, value in (proximity or {}).items():
+            chunk_scores[chunk_no] += self.proximity_weight * value
+        return chunk_scores
+
+    def _doc_proximity(self, proximity):
+        """文件的邻近度得分：最高的片段邻近度得分乘以权重"""
+        return self.proximity_weight * max(proximity.values()) if proximity else 0.0
+
+    @staticmethod
+    def _ranked_chunks(chunk_scores):
+        """片段按分数从高到低排列，同分时按片段序号"""
+        return sorted(chunk_scores.items(), key=lambda x: (-x[1], x[0]))
+
+    def _phrase_chunks(self, phrases, file_ids=None):
+        """查找包含全部短语的文件
+
+        Args:
+            phrases: 短语列表，每个短语为标记列表
+            file_ids: 限定的文件ID集合，为None时不限制
+
+        Returns:
+            dict: 文件ID -> 同时包含全部短语的片段序号集合（文件中的短语分布在不同片段时为空集合），
+                  没有短语时返回None
+        """
+        if not phrases:
+            return None
+        allowed = None
+        for phrase in phrases:
+            matches = self.index.phrase_matches(phrase, file_ids if allowed is None else allowed)
+            if allowed is None:
+                allowed = {file_id: set(chunks) for file_id, chunks in matches.items()}
+            else:
+                allowed = {
+                    file_id: chunks & set(matches[file_id]) for file_id, chunks in allowed.items()
+                    if file_id in matches
+                }
+            if not allowed:
+                break
+        return allowed
+
+    def score(self, query_tokens, file_ids=None, phrases=None):
+        """为包含查询词的所有文件打分
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            file_ids: 限定的文件ID集合，为None时不限制
+            phrases: 文件必须包含的短语列表，每个短语为标记列表
+
+        Returns:
+            dict: 文件ID -> {"score": BM25F分数, "chunks": [(片段序号, 片段分数), ...]}
+                  片段按分数从高到低排列
+        """
+        allowed = self._phrase_chunks(phrases, file_ids)
+        if allowed is not None:
+            file_ids = allowed
+        idfs = {token: self.idf(token) for token in query_tokens}
+        matches = self.index.lookup(query_tokens, file_ids)
+        avg_chunk_length = self.stats.average_chunk_length()
+
+        scores = {}
+        for file_id, entries in matches.items():
+            norms = self._doc_norms(file_id)
+            score = sum(self._term_score(entry, norms, idfs[token]) for token, entry in entries.items())
+            if score > 0:
+                proximity = self._proximity(entries, idfs)
+                score += self._doc_proximity(proximity)
+                chunk_scores = self._chunk_scores(file_id, entries, idfs, avg_chunk_length, proximity)
+                scores[file_id] = {"score": score, "chunks": self._ranked_chunks(chunk_scores)}
+        return scores
+
+    def _bounded_terms(self, query_tokens, file_ids=None):
+        """按得分上界从高到低排列查询词，供 MaxScore 剪枝使用
+
+        文件在一个词项上的BM25F得分 idf * tf / (k1 + tf) 小于 idf，以 idf 作为该词项的得分上界。
+
+        Returns:
+            tuple: (按上界排列的词项列表, 词项 -> 倒排记录, 词项 -> IDF, 剩余上界)
+                   剩余上界[i] 为第i个及之后（上界更低的）词项的上界之和
+        """
+        idfs = {token: self.idf(token) for token in query_tokens}
+        terms = sorted(query_tokens, key=lambda token: -idfs[token])
+        postings = {}
+        for token in terms:
+            term_postings = self.index.term_postings(token)
+            if file_ids is not None:
+                term_postings = {file_id: entry for file_id, entry in term_postings.items() if file_id in file_ids}
+            postings[token] = term_postings
+        remaining = [0.0] * (len(terms) + 1)
+        for i in range(len(terms) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + idfs[terms[i]]
+        return terms, postings, idfs, remaining
+
+    def _proximity_factor(self, query_tokens):
+        """邻近度使词项得分上界增加的倍数：每个词项贡献的邻近度得分小于 proximity_weight * idf"""
+        return self.proximity_weight if len(query_tokens) > 1 else 0.0
+
+    def top_documents(self, query_tokens, k, order=None, file_ids=None, phrases=None):
+        """取BM25F分数最高的k个文件（MaxScore动态剪枝）
+
+        按得分上界从高到低依次遍历各查询词的倒排记录，每个文件只在第一次出现时计算一次。
+        第一次出现在第i个词项的文件不含更靠前的词项，其分数不超过剩余上界[i]；
+        剩余上界已低于当前第k名的分数时，之后的文件都不可能进入前k名，直接结束。
+        计算单个文件时，已得分数加上剩余词项的上界低于第k名时也提前放弃，
+        只有可能进入前k名的文件才读取词项位置计算邻近度。
+        结果与对全部文件打分后排序取前k个相同，只为最终结果计算片段分数。
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            k: 返回的文件数
+            order: 文件ID -> 顺序号，同分时顺序号小的在前，不在其中的排在最后
+            file_ids: 限定的文件ID集合，为None时不限制
+            phrases: 文件必须包含的短语列表，每个短语为标记列表
+
+        Returns:
+            list: [(文件ID, 分数, [(片段序号, 片段分数), ...]), ...]，按分数从高到低排列
+        """
+        if k <= 0:
+            return []
+        order = order or {}
+        allowed = self._phrase_chunks(phrases, file_ids)
+        if allowed is not None:
+            file_ids = allowed
+        terms, postings, idfs, remaining = self._bounded_terms(query_tokens, file_ids)
+        factor = 1.0 + self._proximity_factor(query_tokens)
+
+        # 小顶堆，堆顶为当前第k名：(分数, -顺序号, 文件ID)
+        heap = []
+        seen = set()
+        for i, token in enumerate(terms):
+            if len(heap) == k and remaining[i] * factor < heap[0][0]:
+                break
+            for file_id in postings[token]:
+                if file_id in seen:
+                    continue
+                seen.add(file_id)
+                threshold = heap[0][0] if len(heap) == k else 0.0
+
+                norms = self._doc_norms(file_id)
+                # 已计算词项的得分加上其邻近度得分的上界
+                partial = 0.0
+                term_scores = {}
+                for j in range(i, len(terms)):
+                    if partial + remaining[j] * factor < threshold:
+                        term_scores = None
+                        break
+                    entry = postings[terms[j]].get(file_id)
+                    if entry is not None:
+                        term_scores[terms[j]] = self._term_score(entry, norms, idfs[terms[j]])
+                        partial += term_scores[terms[j]] + (factor - 1.0) * idfs[terms[j]]
+                if not term_scores:
+                    continue
+                # 按查询词顺序累加，与 score 的结果完全一致
+                score = sum(term_scores[t] for t in query_tokens if t in term_scores)
+                if score <= 0:
+                    continue
+                if len(term_scores) > 1 and self.proximity_weight:
+                    if score + self.proximity_weight * sum(idfs[t] for t in term_scores) < threshold:
+                        continue
+                    entries = {t: postings[t][file_id] for t in query_tokens if t in term_scores}
+                    score += self._doc_proximity(self._proximity(entries, idfs))
+
+                item = (score, -order.get(file_id, len(order)), file_id)
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        avg_chunk_length = self.stats.average_chunk_length()
+        results = []
+        for score, _, file_id in sorted(heap, reverse=True):
+            entries = {t: postings[t][file_id] for t in query_tokens if file_id in postings[t]}
+            proximity = self._proximity(entries, idfs)
+            chunk_scores = self._chunk_scores(file_id, entries, idfs, avg_chunk_length, proximity)
+            results.append((file_id, score, self._ranked_chunks(chunk_scores)))
+        return results
+
+    def top_chunks(self, query_tokens, k, order=None, file_ids=None, phrases=None):
+        """取片段级BM25分数最高的k个片段（MaxScore动态剪枝）
+
+        片段在一个词项上的得分 idf * tf * (k1 + 1) / (tf + k1 * norm) 小于 idf * (k1 + 1)，
+        加上邻近度得分后小于 idf * (k1 + 1 + proximity_weight)。
+        与 top_documents 相同，按词项上界从高到低遍历文件，文件中所有片段分数的上界
+        已低于当前第k个片段的分数时结束。
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            k: 返回的片段数
+            order: 文件ID -> 顺序号，同分时顺序号小的文件在前，不在其中的排在最后
+            file_ids: 限定的文件ID集合，为None时不限制
+            phrases: 片段必须包含的短语列表，每个短语为标记列表
+
+        Returns:
+            list: [(文件ID, 片段序号, 分数), ...]，按分数从高到低排列，同分时按文件顺序和片段序号
+        """
+        if k <= 0:
+            return []
+        order = order or {}
+        allowed = self._phrase_chunks(phrases, file_ids)
+        if allowed is not None:
+            file_ids = {file_id for file_id, chunks in allowed.items() if chunks}
+        terms, postings, idfs, remaining = self._bounded_terms(query_tokens, file_ids)
+        avg_chunk_length = self.stats.average_chunk_length()
+        factor = self.k1 + 1 + self._proximity_factor(query_tokens)
+
+        # 小顶堆，堆顶为当前第k个片段：(分数, -顺序号, -片段序号, 文件ID)
+        heap = []
+        seen = set()
+        for i, token in enumerate(terms):
+            if len(heap) == k and remaining[i] * factor < heap[0][0]:
+                break
+            for file_id in postings[token]:
+                if file_id in seen:
+                    continue
+                seen.add(file_id)
+
+                entries = {t: postings[t][file_id] for t in query_tokens if file_id in postings[t]}
+                proximity = self._proximity(entries, idfs)
+                chunk_scores = self._chunk_scores(file_id, entries, idfs, avg_chunk_length, proximity)
+                position = -order.get(file_id, len(order))
+                for chunk_no, score in chunk_scores.items():
+                    if allowed is not None and chunk_no not in allowed[file_id]:
+                        continue
+                    item = (score, position, -chunk_no, file_id)
+                    if len(heap) < k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+
+        return [(file_id, -neg_chunk_no, score) for score, _, neg_chunk_no, file_id in sorted(heap, reverse=True)]
@@ -2,14 +2,116 @@
 import os
 import re
 import json
+import heapq
 import shutil
+import posixpath
+import threading
+import time
 from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from knowledge_analyzer import create_analyzer, estimate_tokens, jaccard, shingles
+from knowledge_chunker import TextChunker
+from knowledge_dedup import MinHasher, DuplicateIndex
+from knowledge_index import ShardedIndex, CollectionStats, BM25FScorer
+from knowledge_vectors import VECTORS_AVAILABLE, VectorStore, create_embedder
+from knowledge_store import (ContentStore, ExtractionCache, FileManifest, IndexJournal,
+                             file_sha256, link_or_copy, write_text_stream)
+from knowledge_sqlite import SQLiteKnowledgeStore
+from knowledge_watcher import KnowledgeWatcher
+
+# 提取逻辑的版本，修改提取方式后递增，使旧的提取缓存失效
+EXTRACTOR_VERSION = 1
+
+# 提取失败时产生的提示文本前缀，这类结果不写入提取缓存
+EXTRACT_ERROR_PREFIXES = ("无法提取", "提取文本时出错")
+
+
+def iter_file_text(file_path, file_ext):
+    """从不同类型的文件中逐段提取文本
+
+    PDF按页、Word按段落、纯文本按块产生文本片段，调用方可以边读边处理，
+    不必在内存中拼接整篇文档。
+    """
+    try:
+        # 纯文本文件
+        if file_ext in [".txt", ".md", ".csv"]:
+            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+                for block in iter(lambda: f.read(64 * 1024), ""):
+                    yield block
+        
+        # PDF文件
+        elif file_ext == ".pdf":
+            try:
+                import PyPDF2
+            except ImportError:
+                yield "无法提取PDF文本，请安装PyPDF2库"
+                return
+            with open(file_path, "rb") as f:
+                reader = PyPDF2.PdfReader(f)
+                for page in reader.pages:
+                    yield (page.extract_text() or "") + "\n"
+        
+        # Word文档
+        elif file_ext in [".docx", ".doc"]:
+            try:
+                import docx
+            except ImportError:
+                yield "无法提取Word文档文本，请安装python-docx库"
+                return
+            doc = docx.Document(file_path)
+            for para in doc.paragraphs:
+                yield para.text + "\n"
+        
+        # 其他文件类型
+        else:
+            yield f"不支持的文件类型: {file_ext}"
+    except Exception as e:
+        yield f"提取文本时出错: {str(e)}"
+
+
+def extract_file_text(file_path, file_ext):
+    """从不同类型的文件中提取全部文本"""
+    return "".join(iter_file_text(file_path, file_ext))
+
+
+def extract_to_file(file_path, file_ext, dest_path):
+    """将文件文本逐段写入 dest_path，定义在模块级别以便在进程池中并行调用
+
+    Returns:
+        tuple: (词数, 开头文本)
+    """
+    return write_text_stream(iter_file_text(file_path, file_ext), dest_path)
+
 
 class KnowledgeManager:
-    def __init__(self):
-        """初始化知识库管理器"""
+    def __init__(self, backend="json", embedding=None, lazy=False, analyzer=None):
+        """初始化知识库管理器
+
+        Args:
+            backend: 存储后端，"json" 使用 index.json，"sqlite" 使用SQLite/FTS5数据库
+            embedding: 向量检索配置（见 knowledge_vectors.create_embedder），默认使用本地哈希向量化
+            lazy: 是否只加载文件元数据；倒排索引、向量等检索结构在首次检索或修改时
+                  （或调用 start_loading 后在后台线程中）加载
+            analyzer: 文本分析配置（见 knowledge_analyzer.create_analyzer），默认中文按相邻两字切分、去停用词
+        """
         self.knowledge_base_dir = "knowledge_base"
         self.index_file = os.path.join(self.knowledge_base_dir, "index.json")
+        self.journal_file = os.path.join(self.knowledge_base_dir, "index.journal")
+        self.db_file = os.path.join(self.knowledge_base_dir, "knowledge.db")
+        # 倒排索引按分区分片，每个分区一个文件
+        self.search_index_dir = os.path.join(self.knowledge_base_dir, ".search_index")
+        # 旧版的整体倒排索引（二进制及JSON格式），其中没有词项位置，加载时删除并根据已保存的片段重建
+        self.legacy_search_index_files = (
+            os.path.join(self.knowledge_base_dir, "search_index.bin"),
+            os.path.join(self.knowledge_base_dir, "search_index.json")
+        )
+        self.content_dir = os.path.join(self.knowledge_base_dir, ".content")
+        self.manifest_file = os.path.join(self.knowledge_base_dir, "manifest.json")
+        self.extract_cache_dir = os.path.join(self.knowledge_base_dir, ".extract_cache")
+        self.vectors_dir = os.path.join(self.knowledge_base_dir, ".vectors")
+        self.dedup_dir = os.path.join(self.knowledge_base_dir, ".dedup")
         
         # 确保知识库目录存在
         os.makedirs(self.knowledge_base_dir, exist_ok=True)
@@ -22,20 +124,233 @@ class KnowledgeManager:
             category_dir = os.path.join(self.knowledge_base_dir, category)
             os.makedirs(category_dir, exist_ok=True)
         
-        # 初始化索引
-        self.index = self.load_index()
+        # 排序参数：字段权重及BM25参数
+        self.field_weights = {"title": 2.0, "summary": 1.5, "body": 1.0}
+        self.bm25_k1 = 1.2
+        self.bm25_b = 0.75
+        # 查询词在片段中相距不超过 proximity_window 个词时加邻近度得分
+        self.proximity_weight = 0.5
+        self.proximity_window = 5
+        # 文件检索结果中每个匹配段落截取的摘要长度（字符）
+        self.snippet_length = 300
+        
+        # 结果分数低于最高分该比例时不再返回，用于减少送入对话的无关内容
+        self.min_score_ratio = 0.0
+        self.context_min_score_ratio = 0.3
+        
+        # 送入对话的知识库上下文的token预算（可按模型指定），预算内按分数从高到低放入片段
+        self.context_token_budget = 1500
+        # 挑选上下文片段时检索的候选片段数
+        self.context_candidates = 20
+        # 候选片段按最大边际相关（MMR）重新排序：越小越倾向于放入与已选片段不同的内容，为1时只按分数排序
+        self.mmr_lambda = 0.7
+        
+        # 对话上下文的检索方式："lexical"、"vector" 或 "hybrid"（两者并行检索后按倒数排名融合）
+        self.context_search_mode = "hybrid"
+        # 混合检索时每种检索取的候选片段数，越大召回越高、耗时越长
+        self.hybrid_candidates = 20
+        # 倒数排名融合的平滑常数及各检索结果的权重
+        self.rrf_k = 60
+        self.hybrid_weights = {"lexical": 1.0, "vector": 1.0}
+        # 向量检索只返回余弦相似度高于该值的片段，与查询无关的片段不参与融合
+        self.vector_min_similarity = 0.0
+        # 最近一次片段检索各阶段的耗时（毫秒）
+        self.last_search_timings = {}
+        self._search_executor = None
+        # 未按分区筛选时，各分区分片在线程池中并行检索
+        self.shard_search_workers = 4
+        self._shard_executor = None
+        
+        # 片段检索结果的LRU缓存；索引每次变化时代数加一，缓存随之失效
+        self.index_generation = 0
+        self.query_cache_size = 128
+        self._query_cache = OrderedDict()
+        self._query_cache_generation = 0
+        
+        # 文档全文单独存储，索引中只保留元数据
+        self.content_store = ContentStore(self.content_dir)
+        
+        # 入库时将全文切分为长度有限、相互重叠的检索片段
+        self.chunker = TextChunker(chunk_size=600, overlap=120)
+        
+        # 入库和查询使用同一个文本分析器；分析方式变化后倒排索引和全文检索表随之重建
+        self.analyzer = create_analyzer(analyzer)
+        
+        # 向量检索：检索片段在入库时向量化，需要NumPy；向量存储随检索结构一起加载
+        self.embedder = None
+        self.vector_store = None
+        if VECTORS_AVAILABLE:
+            self.embedder = create_embedder(embedding, self.analyzer.analyze, self.analyzer.signature)
+        
+        # 近似重复检测：入库时计算全文的MinHash签名，在LSH索引中查找相似度不低于 duplicate_threshold 的已有文件。
+        # duplicate_policy 为 "link" 时照常入库并在元数据中记录 duplicate_of（所在重复组的第一个文件），
+        # 检索结果中同组文件只保留分数最高的一个；为 "skip" 时添加文件（刷新目录除外）不再入库
+        self.minhasher = MinHasher()
+        self.duplicate_threshold = 0.8
+        self.duplicate_policy = "link"
+        self.duplicate_index = None
+        
+        # 文件清单：记录文件大小、修改时间和内容哈希，用于增量刷新
+        self.manifest = FileManifest(self.manifest_file)
+        
+        # 按文件内容哈希缓存提取结果，相同内容的文件只提取一次
+        self.extraction_cache = ExtractionCache(self.extract_cache_dir, EXTRACTOR_VERSION)
+        
+        # 后台刷新与查询可能并发，修改和读取索引时需持有该锁
+        self._lock = threading.RLock()
+        # 刷新目录和批量入库时持有该锁（先于 _lock 获取），使提取文本可以在 _lock 之外进行
+        self._ingest_lock = threading.Lock()
+        self._refresh_thread = None
+        self._refresh_stop = threading.Event()
+        self.watcher = None
+        
+        # 待提取文件数达到该值时使用进程池并行提取文本
+        self.parallel_extract_threshold = 4
+        
+        # JSON后端的修改先追加到日志，日志记录数达到该值时压缩进索引快照
+        self.journal_compact_records = 1000
+        self.journal = IndexJournal(self.journal_file)
+        self._pending_journal = []
+        # 索引文件损坏且没有可用快照时，初始化后从知识库目录重新建立索引
+        self._rebuild_required = False
+        
+        # 检索结构（倒排索引、向量）是否已加载；加载完成后依次调用 _ready_callbacks
+        self._loaded = threading.Event()
+        self._loading = False
+        self._load_thread = None
+        self._ready_callbacks = []
+        # 只保护上面两项，加载期间界面线程注册回调不必等待 _lock
+        self._ready_lock = threading.Lock()
+        
+        # 启动时只加载文件元数据
+        self.backend = backend
+        self.sqlite_store = None
+        self.search_index = None
+        self._replayed_records = []
+        if backend == "sqlite":
+            # SQLite后端：元数据、分区和段落文本均保存在数据库中
+            self.index = None
+            self.sqlite_store = SQLiteKnowledgeStore(self.db_file, self.analyzer.analyze)
+        else:
+            # 加载快照后重放快照之后的修改日志
+            self.index = self.load_index()
+            self._replayed_records = self.journal.recover()
+            for record in self._replayed_records:
+                self._apply_index_record(self.index, record)
+        
+        if not lazy:
+            self.ensure_loaded()
+    
+    def is_loaded(self):
+        """检索结构是否已加载完成"""
+        return self._loaded.is_set()
+    
+    def ensure_loaded(self):
+        """确保检索结构已加载，尚未加载时在当前线程中加载（其他线程正在加载时等待其完成）"""
+        if not self._loaded.is_set():
+            with self._lock:
+                self._load_search_structures()
+    
+    def start_loading(self, on_ready=None):
+        """在后台线程中加载检索结构
+        
+        Args:
+            on_ready: 加载完成后的回调（在加载线程中调用）；已加载完成时立即调用
+        """
+        with self._ready_lock:
+            if not self._loaded.is_set():
+                if on_ready:
+                    self._ready_callbacks.append(on_ready)
+                if self._load_thread is None:
+                    self._load_thread = threading.Thread(target=self.ensure_loaded, daemon=True)
+                    self._load_thread.start()
+                return
+        if on_ready:
+            on_ready()
+    
+    def _load_search_structures(self):
+        """加载倒排索引和向量存储，并完成迁移、日志压缩等启动时的维护，需持有 _lock"""
+        if self._loaded.is_set() or self._loading:
+            return
+        self._loading = True
+        try:
+            if VECTORS_AVAILABLE:
+                self.vector_store = VectorStore(self.vectors_dir, self.embedder.signature)
+            self.duplicate_index = DuplicateIndex(self.dedup_dir, self.minhasher, self.analyzer.signature,
+                                                  self.duplicate_threshold)
+            
+            if self.sqlite_store is not None:
+                self._open_sqlite_backend()
+            else:
+                # 初始化倒排索引；日志中修改过的文件和旧版索引中尚未建立倒排记录的文件重新建立索引
+                records = self._replayed_records
+                self._replayed_records = []
+                self.search_index = ShardedIndex(self.search_index_dir, self.legacy_search_index_files,
+                                                 self.analyzer.signature)
+                for record in records:
+                    self.search_index.remove_document(record["file_id"])
+                self._migrate_inline_content()
+                self._migrate_paths()
+                changed = self._sync_search_index()
+                
+                # 重放过日志时将倒排索引和日志一起压缩进快照，下次启动不必再为日志中的文件重建倒排记录；
+                # 否则只在有其他变化时保存倒排索引
+                if records or self.journal.record_count >= self.journal_compact_records:
+                    self.save_index()
+                elif changed:
+                    self.search_index.save()
+            
+            # 补齐缺少向量和MinHash签名的文件
+            self._sync_vectors()
+            self._sync_duplicates()
+            
+            if self._rebuild_required:
+                self._rebuild_required = False
+                self.refresh_index(force=True)
+                self.save_index()
+        except Exception as e:
+            print(f"加载知识库检索索引时出错: {e}")
+            if self.sqlite_store is None and self.search_index is None:
+                self.search_index = ShardedIndex(self.search_index_dir, self.legacy_search_index_files,
+                                                 self.analyzer.signature)
+        finally:
+            self._loading = False
+            with self._ready_lock:
+                self._loaded.set()
+                callbacks, self._ready_callbacks = self._ready_callbacks, []
+        
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"索引加载完成回调出错: {e}")
     
     def load_index(self):
-        """加载知识库索引"""
-        if os.path.exists(self.index_file):
+        """加载知识库索引快照
+        
+        快照无法读取时改用上一份快照；都无法使用时保留损坏的文件，从空索引开始。
+        两种情况都会在初始化后与知识库目录核对并重新建立索引，不会以空索引覆盖原有数据。
+        """
+        for path in (self.index_file, self.index_file + ".bak"):
+            if not os.path.exists(path):
+                continue
             try:
-                with open(self.index_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
+                with open(path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+                if path != self.index_file:
+                    # 上一份快照之后压缩掉的修改已不在日志中，初始化后与知识库目录核对
+                    print(f"索引文件无法使用，已改用上一份快照 {path}")
+                    self._rebuild_required = True
+                return index
             except Exception as e:
-                print(f"加载索引时出错: {e}")
-                return self._create_default_index()
-        else:
-            return self._create_default_index()
+                print(f"加载索引 {path} 时出错: {e}")
+        
+        if os.path.exists(self.index_file):
+            corrupt_path = f"{self.index_file}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            os.replace(self.index_file, corrupt_path)
+            print(f"索引文件已损坏，已保留为 {corrupt_path}，将从知识库目录重新建立索引")
+            self._rebuild_required = True
+        return self._create_default_index()
     
     def _create_default_index(self):
         """创建默认索引结构"""
@@ -46,14 +361,583 @@ class KnowledgeManager:
         }
     
     def save_index(self):
-        """保存知识库索引"""
+        """保存知识库索引快照，并清空已压缩进快照的修改日志
+        
+        快照先写入临时文件再替换，上一份快照保留为 index.json.bak，写入中途崩溃不会损坏索引。
+        """
+        self.ensure_loaded()
         self.index["last_updated"] = datetime.now().isoformat()
         try:
-            with open(self.index_file, "w", encoding="utf-8") as f:
+            # 倒排索引先于文件索引保存，两者之间崩溃时重放日志即可恢复一致
+            self.search_index.save()
+            
+            tmp_path = self.index_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
                 json.dump(self.index, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self.index_file):
+                os.replace(self.index_file, self.index_file + ".bak")
+            os.replace(tmp_path, self.index_file)
+            
+            self.manifest.save()
+            self.journal.reset()
         except Exception as e:
             print(f"保存索引时出错: {e}")
     
+    def _apply_index_record(self, index, record):
+        """将一条修改记录应用到索引字典
+        
+        Args:
+            index: 索引字典（含 files 和 categories）
+            record: {"op": "put", "file_id": ..., "info": ...} 或 {"op": "delete", "file_id": ...}
+            
+        Returns:
+            dict: 被修改或删除的文件元数据，删除不存在的文件时返回None
+        """
+        file_id = record["file_id"]
+        if record["op"] == "put":
+            file_info = record["info"]
+            index["files"][file_id] = file_info
+            
+            # 更新分区文件列表
+            category_files = index["categories"].setdefault(file_info.get("category", "其他"), [])
+            if file_id not in category_files:
+                category_files.append(file_id)
+            return file_info
+        
+        file_info = index["files"].pop(file_id, None)
+        if file_info is not None:
+            # 从分区列表中移除
+            category_files = index["categories"].get(file_info.get("category", ""), [])
+            if file_id in category_files:
+                category_files.remove(file_id)
+        return file_info
+    
+    def _open_sqlite_backend(self):
+        """初始化SQLite后端，首次使用时从 index.json 一次性迁移"""
+        for category in self.categories:
+            self.sqlite_store.add_category(category)
+        
+        # 切分参数变化（或旧版按空行分段）时重新切分已有文件
+        chunker_signature = self.chunker.signature()
+        if self.sqlite_store.get_meta("chunker") != chunker_signature:
+            for file_id in self.sqlite_store.list_file_ids():
+                content = self.sqlite_store.get_content(file_id) or ""
+                self.sqlite_store.replace_chunks(file_id, self._chunk_content(content))
+                if self.vector_store is not None:
+                    self.vector_store.remove(file_id)
+            self.sqlite_store.set_meta("chunker", chunker_signature)
+        
+        # 分析方式变化时重建全文检索词表
+        self.sqlite_store.sync_terms(self.analyzer.signature)
+        
+        if not self.sqlite_store.get_meta("migrated_from_json") and os.path.exists(self.index_file):
+            # 迁移时包含尚未压缩进快照的日志
+            index = self.load_index()
+            for record in self.journal.recover():
+                self._apply_index_record(index, record)
+            count = self.sqlite_store.import_json_index(
+                index,
+                lambda file_id, file_info: self._read_stored_content(file_id, file_info),
+                self._search_title,
+                self._chunk_content
+            )
+            print(f"已将 {count} 个文件从 index.json 迁移到SQLite数据库")
+        else:
+            self.sqlite_store.set_meta("migrated_from_json", "1")
+        self.sqlite_store.commit()
+        self._migrate_paths()
+    
+    def _migrate_paths(self):
+        """将旧版索引中的文件路径（如 knowledge_base\\论文\\x.pdf）转换为相对知识库根目录的POSIX路径"""
+        if self.sqlite_store is not None:
+            migrated = 0
+            for file_id, file_info in self.sqlite_store.iter_files():
+                path = self.portable_path(file_info.get("path", ""))
+                if path != file_info.get("path", ""):
+                    file_info["path"] = path
+                    self.sqlite_store.update_file_info(file_id, file_info)
+                    migrated += 1
+            if migrated:
+                self.sqlite_store.commit()
+            return
+        
+        migrated = False
+        for file_info in self.index["files"].values():
+            path = self.portable_path(file_info.get("path", ""))
+            if path != file_info.get("path", ""):
+                file_info["path"] = path
+                migrated = True
+        
+        if migrated:
+            self.save_index()
+    
+    def portable_path(self, file_path):
+        """将文件路径转换为索引中保存的形式：相对知识库根目录的POSIX路径
+        
+        兼容旧版索引中保存的Windows路径和其他机器上的绝对路径，知识库之外的文件保留原路径。
+        
+        Args:
+            file_path: 本机路径或旧版索引中的路径
+            
+        Returns:
+            str: 如 "论文/xxx.pdf"
+        """
+        if not file_path:
+            return file_path
+        path = file_path.replace("\\", "/")
+        root = os.path.abspath(self.knowledge_base_dir).replace("\\", "/").rstrip("/")
+        
+        if os.path.isabs(file_path) or re.match(r"^[A-Za-z]:/", path):
+            if path.startswith(root + "/"):
+                return path[len(root) + 1:]
+            # 其他机器上的绝对路径：取知识库目录名之后的部分
+            marker = "/" + posixpath.basename(root) + "/"
+            if marker in path:
+                return posixpath.normpath(path.rsplit(marker, 1)[1])
+            return file_path
+        
+        path = posixpath.normpath(path)
+        prefix = posixpath.normpath(self.knowledge_base_dir.replace("\\", "/")) + "/"
+        if path.startswith(prefix):
+            return path[len(prefix):]
+        return path
+    
+    def resolve_path(self, stored_path):
+        """将索引中保存的相对路径解析为本机路径
+        
+        Args:
+            stored_path: 索引中保存的路径
+            
+        Returns:
+            str: 本机文件路径
+        """
+        if not stored_path:
+            return ""
+        if os.path.isabs(stored_path):
+            return stored_path
+        return os.path.join(self.knowledge_base_dir, *stored_path.split("/"))
+    
+    def _migrate_inline_content(self):
+        """将旧版索引中内嵌的文档全文迁移到全文存储"""
+        migrated = False
+        for file_id, file_info in self.index["files"].items():
+            if "content" in file_info:
+                self.content_store.put(file_id, file_info.pop("content"))
+                migrated = True
+        
+        if migrated:
+            self.save_index()
+    
+    def get_content(self, file_id):
+        """按需读取文档全文
+
+        Args:
+            file_id: 文件ID，格式为"分区/文件名"
+
+        Returns:
+            str: 文档全文，无法获取时返回空字符串
+        """
+        if self.sqlite_store is not None:
+            return self.sqlite_store.get_content(file_id) or ""
+        
+        file_info = self._get_file_entry(file_id)
+        if not file_info:
+            return ""
+        return self._read_stored_content(file_id, file_info)
+    
+    def _read_stored_content(self, file_id, file_info):
+        """从全文存储读取文档全文，没有时重新从文件提取"""
+        content = self.content_store.get(file_id)
+        if content is not None:
+            return content
+        
+        file_path = self.resolve_path(file_info.get("path", ""))
+        if not os.path.exists(file_path):
+            return ""
+        self.extract_to_store([(file_id, file_path, None)])
+        return self.content_store.get(file_id) or ""
+    
+    def _chunk_content(self, content):
+        """将全文切分为检索片段
+
+        Returns:
+            list: 按片段序号排列的片段文本
+        """
+        paragraphs = enumerate(content.split('\n\n') if content else [])
+        return [chunk for chunk, _ in self.chunker.chunks(paragraphs)]
+    
+    def _search_title(self, file_id, file_info):
+        """用于检索的标题，没有标题时使用文件名"""
+        filename = file_id.split("/", 1)[1] if "/" in file_id else file_id
+        return file_info.get("title", filename)
+    
+    def _get_file_entry(self, file_id):
+        """获取文件元数据，不存在时返回None"""
+        if self.sqlite_store is not None:
+            return self.sqlite_store.get_file(file_id)
+        return self.index["files"].get(file_id)
+    
+    def _has_files(self):
+        """知识库中是否有文件"""
+        if self.sqlite_store is not None:
+            return self.sqlite_store.count_files() > 0
+        return bool(self.index and self.index.get("files"))
+    
+    def _iter_files(self):
+        """获取所有文件的 (文件ID, 元数据) 列表"""
+        if self.sqlite_store is not None:
+            return self.sqlite_store.iter_files()
+        return list(self.index["files"].items())
+    
+    def _list_file_ids(self, categories=None):
+        """按分区顺序列出文件ID
+
+        Args:
+            categories: 分区名称列表，为None时列出全部分区
+        """
+        if self.sqlite_store is not None:
+            return self.sqlite_store.list_file_ids(categories)
+        
+        file_ids = []
+        if categories is None:
+            categories = list(self.index["categories"].keys())
+        for category in categories:
+            file_ids.extend(self.index["categories"].get(category, []))
+        return file_ids
+    
+    def _store_file(self, file_id, file_info, stat_result=None, sha256=None):
+        """写入文件元数据及检索索引，需调用 _commit 保存
+        
+        文件全文需已由 extract_to_store 写入全文存储。
+
+        Args:
+            file_id: 文件ID，格式为"分区/文件名"
+            file_info: 文件元数据（不含全文）
+            stat_result: 已获取的文件stat信息，用于更新文件清单
+            sha256: 已计算的文件内容哈希，用于更新文件清单
+        """
+        self.ensure_loaded()
+        self.index_generation += 1
+        file_path = self.resolve_path(file_info["path"])
+        if stat_result is None:
+            stat_result = os.stat(file_path)
+        if sha256 is None:
+            sha256 = file_sha256(file_path)
+        self.manifest.record(file_id, file_info["path"], stat_result, sha256)
+        previous_signature = self.duplicate_index.signatures.get(file_id)
+        
+        if self.sqlite_store is not None:
+            # 全文和检索片段转存到数据库后不再保留全文文件
+            content = self.content_store.get(file_id) or ""
+            chunks = self._chunk_content(content)
+            self._link_duplicate(file_id, file_info, self._tokenize(content, unique=False))
+            self.sqlite_store.put_file(file_id, file_info, self._search_title(file_id, file_info), content, chunks)
+            self.content_store.delete(file_id)
+            self._embed_chunks(file_id, chunks)
+        else:
+            # 建立倒排索引，再根据正文词元查找近似重复的文件
+            body_tokens = self._index_document(file_id, file_info)
+            self._link_duplicate(file_id, file_info, body_tokens)
+            
+            record = {"op": "put", "file_id": file_id, "info": file_info}
+            self._apply_index_record(self.index, record)
+            self._pending_journal.append(record)
+        
+        # 内容变化后，原先归入该文件重复组的文件可能已不再与之重复
+        if previous_signature is not None and previous_signature != self.duplicate_index.signatures.get(file_id):
+            self._relink_duplicates(file_id, previous_signature)
+    
+    def _update_file_info(self, file_id, file_info):
+        """只更新文件元数据，不重建检索索引，需调用 _commit 保存"""
+        self.index_generation += 1
+        if self.sqlite_store is not None:
+            self.sqlite_store.update_file_info(file_id, file_info)
+            return
+        record = {"op": "put", "file_id": file_id, "info": file_info}
+        self._apply_index_record(self.index, record)
+        self._pending_journal.append(record)
+    
+    def _drop_file(self, file_id):
+        """从索引中移除文件记录（不删除磁盘上的文件），需调用 _commit 保存
+
+        Returns:
+            bool: 文件是否存在于索引中
+        """
+        self.ensure_loaded()
+        self.index_generation += 1
+        self.manifest.remove(file_id)
+        if self.vector_store is not None:
+            self.vector_store.remove(file_id)
+        signature = self.duplicate_index.signatures.get(file_id)
+        self.duplicate_index.remove(file_id)
+        
+        if self.sqlite_store is not None:
+            removed = self.sqlite_store.delete_file(file_id)
+        else:
+            record = {"op": "delete", "file_id": file_id}
+            removed = self._apply_index_record(self.index, record) is not None
+            if removed:
+                self._pending_journal.append(record)
+                self.search_index.remove_document(file_id)
+                self.content_store.delete(file_id)
+        
+        # 原先归入该文件重复组的文件重新确定归属
+        if removed and signature is not None:
+            self._relink_duplicates(file_id, signature)
+        return removed
+    
+    def _commit(self):
+        """保存对索引的修改
+        
+        JSON后端只将本次修改追加到日志，写入量与修改量成正比；日志记录数达到 journal_compact_records 时
+        才将完整索引压缩为新的快照。向量先于日志保存，日志中记录的文件重放时不必重新生成向量。
+        """
+        if self.vector_store is not None:
+            self.vector_store.save()
+        if self.duplicate_index is not None:
+            self.duplicate_index.save()
+        if self.sqlite_store is not None:
+            self.sqlite_store.commit()
+            self.manifest.save()
+            return
+        
+        self.journal.append(self._pending_journal)
+        self._pending_journal = []
+        if self.journal.record_count >= self.journal_compact_records:
+            self.save_index()
+    
+    def get_categories(self):
+        """获取所有已知分区，包括运行中新建和索引中记录的分区"""
+        if self.sqlite_store is not None:
+            stored = self.sqlite_store.get_categories()
+        else:
+            stored = list(self.index["categories"].keys())
+        return list(dict.fromkeys(self.categories + stored))
+    
+    def _sync_search_index(self):
+        """使倒排索引与文件索引保持一致（不保存）
+
+        为缺少倒排记录的文件建立索引，并移除已不在文件索引中的倒排记录。
+
+        Returns:
+            set: 倒排记录发生变化的文件ID
+        """
+        changed = set()
+        
+        for file_id in self.search_index.document_ids():
+            if file_id not in self.index["files"]:
+                self.search_index.remove_document(file_id)
+                changed.add(file_id)
+        
+        for file_id, file_info in self.index["files"].items():
+            if not self.search_index.has_document(file_id):
+                # 已有的向量不必重新生成，缺少的由 _sync_vectors 补齐
+                body_tokens = self._index_document(file_id, file_info, embed=False)
+                if not self.duplicate_index.has_file(file_id):
+                    self._add_minhash(file_id, body_tokens)
+                changed.add(file_id)
+        return changed
+    
+    def _index_document(self, file_id, file_info, embed=True):
+        """切分检索片段并为文件建立倒排记录，段落从全文存储中逐个读取
+
+        Args:
+            file_id: 文件ID，格式为"分区/文件名"
+            file_info: 文件索引信息
+            embed: 是否同时生成片段向量
+            
+        Returns:
+            list: 正文的词元序列（片段重叠部分只计一次）
+        """
+        if not self.content_store.contains(file_id):
+            self._read_stored_content(file_id, file_info)
+        
+        body_tokens = []
+        chunk_tokens = []
+        chunks = []
+        
+        def chunk_texts():
+            paragraphs = self.content_store.iter_paragraphs(file_id)
+            for chunk, overlap_length in self.chunker.chunks(paragraphs):
+                chunks.append(chunk)
+                # 重叠部分已计入上一个片段，正文词频只统计新增部分
+                new_tokens = self._tokenize(chunk[overlap_length:], unique=False)
+                chunk_tokens.append(self._tokenize(chunk[:overlap_length], unique=False) + new_tokens)
+                body_tokens.extend(new_tokens)
+                yield chunk
+        
+        self.content_store.put_chunks(file_id, chunk_texts())
+        self.search_index.add_document(
+            file_id,
+            self._tokenize(self._search_title(file_id, file_info), unique=False),
+            self._tokenize(file_info.get("summary", ""), unique=False),
+            body_tokens,
+            chunk_tokens
+        )
+        if embed:
+            self._embed_chunks(file_id, chunks)
+        return body_tokens
+    
+    def _get_chunks(self, file_id, chunk_nos=None):
+        """读取文件的检索片段
+        
+        Args:
+            file_id: 文件ID
+            chunk_nos: 片段序号列表，为None时读取全部片段
+            
+        Returns:
+            dict: 片段序号 -> 片段文本
+        """
+        if self.sqlite_store is not None:
+            return self.sqlite_store.get_chunks(file_id, chunk_nos)
+        return self.content_store.get_chunks(file_id, chunk_nos)
+    
+    def _embed_chunks(self, file_id, chunks):
+        """将文件的检索片段向量化并保存，未启用向量检索时忽略
+        
+        Args:
+            file_id: 文件ID
+            chunks: 按片段序号排列的片段文本
+        """
+        if self.vector_store is None:
+            return
+        try:
+            self.vector_store.add(file_id, self.embedder.embed(chunks) if chunks else [])
+        except Exception as e:
+            # 向量接口不可用时保留文件的其他索引，下次启动时再补齐向量
+            self.vector_store.remove(file_id)
+            print(f"向量化检索片段时出错: {e}")
+    
+    def _sync_vectors(self):
+        """使向量存储与文件索引保持一致：为缺少向量的文件生成向量，并移除已删除文件的向量"""
+        if self.vector_store is None:
+            return
+        file_ids = self._list_file_ids()
+        known = set(file_ids)
+        
+        for file_id in self.vector_store.file_ids():
+            if file_id not in known:
+                self.vector_store.remove(file_id)
+        
+        for file_id in file_ids:
+            if not self.vector_store.has_file(file_id):
+                chunks = self._get_chunks(file_id)
+                self._embed_chunks(file_id, [chunks[chunk_no] for chunk_no in sorted(chunks)])
+        
+        self.vector_store.save()
+    
+    def _add_minhash(self, file_id, tokens):
+        """计算文件的MinHash签名并加入近似重复索引
+        
+        Returns:
+            array: 签名，没有词元时返回None（此时不加入索引）
+        """
+        signature = self.minhasher.minhash(tokens)
+        if signature is None:
+            self.duplicate_index.remove(file_id)
+        else:
+            self.duplicate_index.add(file_id, signature)
+        return signature
+    
+    def _find_duplicate(self, file_id, signature):
+        """查找与签名近似重复的已有文件
+        
+        Returns:
+            str: 最相似的文件所在重复组的第一个文件ID，没有时返回None
+        """
+        if signature is None:
+            return None
+        for match, _ in self.duplicate_index.query(signature, exclude=file_id):
+            file_info = self._get_file_entry(match)
+            if file_info is not None:
+                return file_info.get("duplicate_of", match)
+        return None
+    
+    def _link_duplicate(self, file_id, file_info, tokens):
+        """更新文件的MinHash签名，并在元数据中记录（或清除）其近似重复的已有文件"""
+        duplicate_of = self._find_duplicate(file_id, self._add_minhash(file_id, tokens))
+        if duplicate_of and duplicate_of != file_id:
+            file_info["duplicate_of"] = duplicate_of
+        else:
+            file_info.pop("duplicate_of", None)
+    
+    def _relink_duplicates(self, file_id, signature):
+        """文件被删除或内容变化后，重新确定 duplicate_of 指向该文件的其他文件的归属
+        
+        重复组内的文件由近似重复关系相连，从该文件原来的签名出发在LSH索引中逐层查找组内文件，
+        不必遍历全部文件。组内文件按彼此之间的近似重复关系重新分组：与组外文件近似重复的一组
+        归入该组外文件所在的重复组，否则以组中文件ID最小的文件为第一个文件。
+        
+        Args:
+            file_id: 被删除或内容变化的文件ID
+            signature: 该文件原来的MinHash签名
+        """
+        members = {}
+        seen = {file_id}
+        pending = [signature]
+        while pending:
+            for match, _ in self.duplicate_index.query(pending.pop()):
+                if match in seen:
+                    continue
+                seen.add(match)
+                file_info = self._get_file_entry(match)
+                if file_info is not None and file_info.get("duplicate_of") == file_id:
+                    members[match] = file_info
+                    pending.append(self.duplicate_index.signatures[match])
+        if not members:
+            return
+        
+        # 组内文件按近似重复关系合并（并查集），并记下每组最先找到的组外近似重复文件
+        parent = {member: member for member in members}
+        
+        def find(member):
+            while parent[member] != member:
+                parent[member] = parent[parent[member]]
+                member = parent[member]
+            return member
+        
+        external = {}
+        for member in sorted(members):
+            for match, _ in self.duplicate_index.query(self.duplicate_index.signatures[member], exclude=member):
+                if match in members:
+                    a, b = find(member), find(match)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+                        moved = external.pop(max(a, b), None)
+                        if moved is not None:
+                            external.setdefault(min(a, b), moved)
+                    continue
+                file_info = self._get_file_entry(match)
+                if file_info is not None:
+                    external.setdefault(find(member), file_info.get("duplicate_of", match))
+        
+        for member in sorted(members):
+            root = find(member)
+            leader = external.get(root) or root
+            file_info = members[member]
+            if leader == member:
+                file_info.pop("duplicate_of", None)
+            else:
+                file_info["duplicate_of"] = leader
+            self._update_file_info(member, file_info)
+    
+    def _sync_duplicates(self):
+        """使近似重复索引与文件索引保持一致：为缺少签名的文件计算签名，并移除已删除文件的签名"""
+        file_ids = self._list_file_ids()
+        known = set(file_ids)
+        
+        for file_id in self.duplicate_index.file_ids():
+            if file_id not in known:
+                self.duplicate_index.remove(file_id)
+        
+        for file_id in file_ids:
+            if not self.duplicate_index.has_file(file_id):
+                self._add_minhash(file_id, self._tokenize(self.get_content(file_id) or "", unique=False))
+        
+        self.duplicate_index.save()
+    
     def add_file(self, file_path, category="其他"):
         """添加文件到知识库指定分区
 
@@ -64,50 +948,30 @@ class KnowledgeManager:
         Returns:
             bool: 是否成功添加
         """
-        try:
-            # 验证分区是否存在
-            if category not in self.categories:
-                print(f"分区 '{category}' 不存在，将使用'其他'分区")
-                category = "其他"
-            
-            # 获取文件名和扩展名
-            filename = os.path.basename(file_path)
-            file_ext = os.path.splitext(filename)[1].lower()
-            
-            # 确保分区目录存在
-            category_dir = os.path.join(self.knowledge_base_dir, category)
-            os.makedirs(category_dir, exist_ok=True)
-            
-            # 复制文件到分区目录
-            dest_path = os.path.join(category_dir, filename)
-            shutil.copy2(file_path, dest_path)
-            
-            # 提取文本内容
-            content = self.extract_text(dest_path, file_ext)
-            
-            # 更新索引
-            file_id = f"{category}/{filename}"
-            self.index["files"][file_id] = {
-                "path": dest_path,
-                "category": category,
-                "added_time": datetime.now().isoformat(),
-                "type": file_ext[1:] if file_ext else "unknown",
-                "size": os.path.getsize(dest_path),
-                "tokens": len(content.split()),
-                "content": content,  # 保存内容到索引
-                "summary": self.generate_summary(content)
-            }
-            
-            # 更新分区文件列表
-            if file_id not in self.index["categories"][category]:
-                self.index["categories"][category].append(file_id)
+        return self.add_files([file_path], category)[0]["success"]
+    
+    def add_files(self, file_paths, category="其他", max_workers=None, progress_callback=None):
+        """批量添加文件到知识库指定分区
+        
+        文件先全部复制到分区目录，再并行提取文本，每个文件提取完成后立即写入索引，
+        全部处理完后只提交一次索引。单个文件失败不影响其他文件。
+        
+        Args:
+            file_paths: 文件路径列表
+            category: 分区名称，默认为"其他"
+            max_workers: 提取文本的最大进程数，默认为CPU核心数
+            progress_callback: 每个文件处理完成（成功或失败）后的回调，参数为 (已完成数, 总数, 结果)
             
-            # 保存索引
-            self.save_index()
-            return True
-        except Exception as e:
-            print(f"添加文件时出错: {e}")
-            return False
+        Returns:
+            list: 与 file_paths 顺序一致的结果，每项为
+                  {"source": 源路径, "success": 是否成功, "file_id": 文件ID, "filename": 文件名, "error": 错误信息,
+                   "duplicate_of": 近似重复的已有文件ID}
+        """
+        if category not in self.categories:
+            print(f"分区 '{category}' 不存在，将使用'其他'分区")
+            category = "其他"
+        entries = [(file_path, os.path.basename(file_path), None) for file_path in file_paths]
+        return self._add_batch(entries, category, False, max_workers, progress_callback)
     
     def add_paper_to_knowledge_base(self, paper_filepath, paper_data=None, category="论文"):
         """添加论文到知识库
@@ -120,117 +984,212 @@ class KnowledgeManager:
         Returns:
             tuple: (bool, str) 是否成功添加和新文件名
         """
-        try:
-            # 确保分类存在
-            if category not in self.categories:
-                # 如果分类不存在，添加到categories列表
-                self.categories.append(category)
-                # 更新索引中的categories
-                if category not in self.index["categories"]:
-                    self.index["categories"][category] = []
-            
-            # 确保分类目录存在
-            category_dir = os.path.join(self.knowledge_base_dir, category)
-            os.makedirs(category_dir, exist_ok=True)
-            
-            # 获取文件名和扩展名
-            filename = os.path.basename(paper_filepath)
-            file_ext = os.path.splitext(filename)[1].lower()
+        result = self.add_papers_to_knowledge_base([(paper_filepath, paper_data)], category)[0]
+        return result["success"], result["filename"]
+    
+    def add_papers_to_knowledge_base(self, papers, category="论文", max_workers=None, progress_callback=None):
+        """批量添加论文到知识库，全部处理完后只提交一次索引
+        
+        有论文元数据时以"标题_第一作者_年份"命名文件，并将元数据写入索引；同名文件已存在时添加序号。
+
+        Args:
+            papers: [(论文文件路径, 论文元数据), ...]，元数据可为None
+            category: 添加到的分类，默认为"论文"，不存在时自动创建
+            max_workers: 提取文本的最大进程数，默认为CPU核心数
+            progress_callback: 每篇论文处理完成后的回调，参数为 (已完成数, 总数, 结果)
+
+        Returns:
+            list: 与 papers 顺序一致的结果，格式同 add_files
+        """
+        # 确保分类存在
+        if category not in self.categories:
+            # 如果分类不存在，添加到categories列表
+            self.categories.append(category)
+        
+        entries = []
+        for paper_filepath, paper_data in papers:
+            if not isinstance(paper_data, dict):
+                paper_data = None
+            entries.append((paper_filepath, self._paper_filename(paper_filepath, paper_data), paper_data))
+        return self._add_batch(entries, category, True, max_workers, progress_callback)
+    
+    def _paper_filename(self, paper_filepath, paper_data):
+        """根据论文元数据生成有意义的文件名，没有标题时使用原文件名"""
+        # 获取文件名和扩展名
+        filename = os.path.basename(paper_filepath)
+        file_ext = os.path.splitext(filename)[1].lower()
+        if not paper_data:
+            return filename
+        
+        # 提取标题和作者
+        title = paper_data.get('title', '').strip()
+        authors = paper_data.get('authors', '').strip()
+        year = paper_data.get('year', '')
+        if not title:
+            return filename
+        
+        # 清理标题，去除不合法的文件名字符
+        clean_title = re.sub(r'[\\/*?:"<>|]', "", title)
+        clean_title = clean_title.strip()
+        
+        # 截断过长的标题
+        if len(clean_title) > 100:
+            clean_title = clean_title[:100]
+        
+        # 添加作者和年份信息
+        if authors:
+            # 提取第一作者姓氏
+            first_author = authors.split(',')[0].strip().split()[-1]
+            new_filename = f"{clean_title}_{first_author}"
+        else:
+            new_filename = clean_title
+        if year:
+            new_filename += f"_{year}"
+        
+        # 添加扩展名
+        new_filename += file_ext
+        
+        # 检查文件名长度，如果太长则缩短
+        if len(new_filename) > 200:
+            new_filename = new_filename[:195] + file_ext
+        return new_filename
+    
+    def _add_batch(self, entries, category, rename_existing, max_workers=None, progress_callback=None):
+        """复制、提取并索引一批文件，最后只提交一次索引
+        
+        Args:
+            entries: [(源文件路径, 目标文件名, 附加元数据), ...]，附加元数据可为None
+            category: 分区名称
+            rename_existing: 目标文件已存在时是否添加序号，否则覆盖
+            max_workers: 提取文本的最大进程数，默认为CPU核心数
+            progress_callback: 每个文件处理完成后的回调，参数为 (已完成数, 总数, 结果)
             
-            # 如果有论文元数据，使用更有意义的文件名
-            if paper_data and isinstance(paper_data, dict):
-                # 提取标题和作者
-                title = paper_data.get('title', '').strip()
-                authors = paper_data.get('authors', '').strip()
-                year = paper_data.get('year', '')
-                
-                # 构建有意义的文件名
-                if title:
-                    # 清理标题，去除不合法的文件名字符
-                    clean_title = re.sub(r'[\\/*?:"<>|]', "", title)
-                    clean_title = clean_title.strip()
-                    
-                    # 截断过长的标题
-                    if len(clean_title) > 100:
-                        clean_title = clean_title[:100]
-                    
-                    # 添加作者和年份信息
-                    if authors:
-                        # 提取第一作者姓氏
-                        first_author = authors.split(',')[0].strip().split()[-1]
-                        new_filename = f"{clean_title}_{first_author}"
-                        if year:
-                            new_filename += f"_{year}"
-                    else:
-                        new_filename = clean_title
-                        if year:
-                            new_filename += f"_{year}"
+        Returns:
+            list: 与 entries 顺序一致的结果
+        """
+        results = [
+            {"source": source_path, "success": False, "file_id": None, "filename": None, "error": None,
+             "duplicate_of": None}
+            for source_path, _, _ in entries
+        ]
+        total = len(entries)
+        done = [0]
+        
+        def finish(result, error=None):
+            result["success"] = error is None
+            result["error"] = error
+            done[0] += 1
+            if progress_callback:
+                try:
+                    progress_callback(done[0], total, result)
+                except Exception as e:
+                    print(f"进度回调出错: {e}")
+        
+        # 确保分类目录存在
+        category_dir = os.path.join(self.knowledge_base_dir, category)
+        os.makedirs(category_dir, exist_ok=True)
+        
+        # 整批处理期间持有 _ingest_lock：目录监视和后台刷新看到复制的文件后会等待本批完成，
+        # 届时文件清单已记录这些文件，不会再次提取，也不会与本批同时写入同一全文文件
+        self.ensure_loaded()
+        with self._ingest_lock:
+            # 复制文件到分区目录
+            copied = []
+            # 文件ID -> (结果序号, 目标路径, 内容哈希, 附加元数据)
+            targets = {}
+            for position, (source_path, filename, metadata) in enumerate(entries):
+                result = results[position]
+                try:
+                    dest_path = os.path.join(category_dir, filename)
+                    # 如果文件已存在（或与本批中前面的文件重名），添加序号
+                    if rename_existing and os.path.exists(dest_path):
+                        name_base, ext = os.path.splitext(filename)
+                        counter = 1
+                        while os.path.exists(dest_path):
+                            dest_path = os.path.join(category_dir, f"{name_base}_{counter}{ext}")
+                            counter += 1
+                        filename = os.path.basename(dest_path)
                     
-                    # 添加扩展名
-                    new_filename += file_ext
+                    # 不重命名时，本批中同名的后一个文件会覆盖前一个的副本和提取结果，直接判为失败
+                    file_id = f"{category}/{filename}"
+                    if file_id in targets:
+                        duplicate_source = entries[targets[file_id][0]][0]
+                        finish(result, f"与本批中的 {duplicate_source} 重名")
+                        continue
                     
-                    # 检查文件名长度，如果太长则缩短
-                    if len(new_filename) > 200:
-                        new_filename = new_filename[:195] + file_ext
-                else:
-                    new_filename = filename
-            else:
-                new_filename = filename
-            
-            # 目标路径
-            dest_path = os.path.join(category_dir, new_filename)
-            
-            # 如果文件已存在，添加序号
-            if os.path.exists(dest_path):
-                name_base, ext = os.path.splitext(new_filename)
-                counter = 1
-                while os.path.exists(dest_path):
-                    dest_path = os.path.join(category_dir, f"{name_base}_{counter}{ext}")
-                    counter += 1
-                new_filename = os.path.basename(dest_path)
-            
-            # 复制文件到指定分类
-            shutil.copy2(paper_filepath, dest_path)
-            
-            # 提取文本内容
-            content = self.extract_text(dest_path, file_ext)
-            
-            # 更新索引
-            file_id = f"{category}/{new_filename}"
-            
-            # 基本索引信息
-            file_info = {
-                "path": dest_path,
-                "category": category,
-                "added_time": datetime.now().isoformat(),
-                "type": file_ext[1:] if file_ext else "unknown",
-                "size": os.path.getsize(dest_path),
-                "tokens": len(content.split()),
-                "content": content,  # 保存内容到索引
-                "summary": self.generate_summary(content)
-            }
-            
-            # 如果有论文元数据，添加到索引
-            if paper_data and isinstance(paper_data, dict):
-                # 添加元数据字段
-                for key, value in paper_data.items():
-                    if key not in file_info and value:
-                        file_info[key] = value
-            
-            # 更新索引
-            self.index["files"][file_id] = file_info
-            
-            # 更新分区文件列表
-            if file_id not in self.index["categories"][category]:
-                self.index["categories"][category].append(file_id)
+                    shutil.copy2(source_path, dest_path)
+                    sha256 = file_sha256(dest_path)
+                    result["file_id"] = file_id
+                    result["filename"] = filename
+                    copied.append((file_id, dest_path, sha256))
+                    targets[file_id] = (position, dest_path, sha256, metadata)
+                except Exception as e:
+                    print(f"复制文件 {source_path} 时出错: {e}")
+                    finish(result, f"复制文件时出错: {e}")
             
-            # 保存索引
-            self.save_index()
+            def store(file_id, stats):
+                position, dest_path, sha256, metadata = targets[file_id]
+                try:
+                    file_info = self._build_file_info(dest_path, category, stats)
+                    # 如果有论文元数据，添加到索引
+                    if metadata:
+                        for key, value in metadata.items():
+                            if key not in file_info and value:
+                                file_info[key] = value
+                    with self._lock:
+                        if self.duplicate_policy == "skip":
+                            duplicate_of = self._skip_duplicate(file_id, dest_path)
+                            if duplicate_of:
+                                results[position]["duplicate_of"] = duplicate_of
+                                finish(results[position], f"与知识库中的 {duplicate_of} 近似重复，已跳过")
+                                return
+                        self._store_file(file_id, file_info, sha256=sha256)
+                        results[position]["duplicate_of"] = file_info.get("duplicate_of")
+                    finish(results[position])
+                except Exception as e:
+                    print(f"添加文件 {file_id} 时出错: {e}")
+                    finish(results[position], f"更新索引时出错: {e}")
             
-            return True, new_filename
-        except Exception as e:
-            print(f"添加论文到知识库时出错: {e}")
-            return False, None
+            if copied:
+                # 并行提取文本，每个文件提取完成后立即写入索引
+                try:
+                    stats = self.extract_to_store(copied, max_workers, on_extracted=store)
+                except Exception as e:
+                    print(f"提取文本时出错: {e}")
+                    stats = {}
+                for file_id, (position, _, _, _) in targets.items():
+                    if file_id not in stats:
+                        finish(results[position], "提取文本时出错")
+                
+                # 一次性提交索引
+                try:
+                    with self._lock:
+                        self._commit()
+                except Exception as e:
+                    print(f"保存索引时出错: {e}")
+                    for result in results:
+                        if result["success"]:
+                            result["success"] = False
+                            result["error"] = f"保存索引时出错: {e}"
+            return results
+    
+    def _skip_duplicate(self, file_id, dest_path):
+        """检查刚提取的文件是否与已有文件近似重复，重复时删除复制的文件和提取的全文，需持有 _lock
+        
+        Returns:
+            str: 近似重复的已有文件ID，不重复时返回None
+        """
+        self.ensure_loaded()
+        tokens = self._tokenize(self.content_store.get(file_id) or "", unique=False)
+        duplicate_of = self._find_duplicate(file_id, self.minhasher.minhash(tokens))
+        if duplicate_of and duplicate_of != file_id and self._get_file_entry(file_id) is None:
+            self.content_store.delete(file_id)
+            try:
+                os.remove(dest_path)
+            except OSError as e:
+                print(f"删除重复文件 {dest_path} 时出错: {e}")
+            return duplicate_of
+        return None
     
     def remove_file(self, file_id):
         """从知识库中删除文件
@@ -243,70 +1202,154 @@ class KnowledgeManager:
         """
         try:
             # 检查文件是否存在于索引中
-            if file_id not in self.index["files"]:
+            file_info = self._get_file_entry(file_id)
+            if file_info is None:
                 return False
             
-            # 获取文件信息
-            file_info = self.index["files"][file_id]
-            file_path = file_info["path"]
-            category = file_info["category"]
-            
             # 删除文件
+            file_path = self.resolve_path(file_info["path"])
             if os.path.exists(file_path):
                 os.remove(file_path)
             
             # 从索引中移除
-            del self.index["files"][file_id]
-            
-            # 从分区列表中移除
-            if category in self.index["categories"] and file_id in self.index["categories"][category]:
-                self.index["categories"][category].remove(file_id)
-            
-            # 保存索引
-            self.save_index()
+            with self._lock:
+                self._drop_file(file_id)
+                
+                # 保存索引
+                self._commit()
             return True
         except Exception as e:
             print(f"删除文件时出错: {e}")
             return False
     
-    def extract_text(self, file_path, file_ext):
-        """从不同类型的文件中提取文本"""
-        try:
-            # 纯文本文件
-            if file_ext in [".txt", ".md", ".csv"]:
-                with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                    return f.read()
+    def extract_text(self, file_path, file_ext):
+        """从不同类型的文件中提取文本"""
+        return extract_file_text(file_path, file_ext)
+    
+    def extract_to_store(self, items, max_workers=None, on_extracted=None):
+        """提取多个文件的文本并逐页写入全文存储
+        
+        先按文件内容哈希查找提取缓存，命中时直接复用；内容相同的多个文件只提取一次。
+        PyPDF2的解析是纯Python的CPU密集型操作，需要提取的文件较多时使用进程池按CPU核心数并行提取。
+        文本在写入时逐段处理，只返回词数和开头部分，不在内存中保留整篇文档。
+        
+        Args:
+            items: [(文件ID, 文件路径, 内容哈希), ...]，哈希为None时重新计算
+            max_workers: 最大进程数，默认为CPU核心数
+            on_extracted: 每个文件提取完成后的回调，参数为 (文件ID, (词数, 开头文本))，不应抛出异常
+            
+        Returns:
+            dict: 文件ID -> (词数, 开头文本)
+        """
+        stats = {}
+        
+        def finish(file_id, result):
+            stats[file_id] = result
+            if on_extracted:
+                on_extracted(file_id, result)
+        
+        # 内容哈希 -> (文件路径, [文件ID, ...])
+        pending = {}
+        for file_id, file_path, sha256 in items:
+            if sha256 is None:
+                sha256 = file_sha256(file_path)
+            cached = self.extraction_cache.get(sha256)
+            if cached is not None:
+                self.extraction_cache.copy_to(sha256, self.content_store.path_for(file_id))
+                finish(file_id, cached)
+            else:
+                pending.setdefault(sha256, (file_path, []))[1].append(file_id)
+        
+        if not pending:
+            return stats
+        
+        def store_result(sha256, result):
+            file_ids = pending[sha256][1]
+            text_path = self.content_store.path_for(file_ids[0])
+            if not result[1].startswith(EXTRACT_ERROR_PREFIXES):
+                self.extraction_cache.put(sha256, text_path, result)
+            for file_id in file_ids[1:]:
+                link_or_copy(text_path, self.content_store.path_for(file_id))
+            for file_id in file_ids:
+                finish(file_id, result)
+        
+        # 每种内容只提取一次，写入第一个文件ID的全文存储
+        jobs = [
+            (sha256, file_path, os.path.splitext(file_path)[1].lower(), self.content_store.path_for(file_ids[0]))
+            for sha256, (file_path, file_ids) in pending.items()
+        ]
+        self._run_extract_jobs(jobs, max_workers, store_result)
+        return stats
+    
+    def _run_extract_jobs(self, jobs, max_workers=None, on_result=None):
+        """执行文本提取任务，任务较多时使用进程池
+        
+        Args:
+            jobs: [(任务键, 文件路径, 扩展名, 全文写入路径), ...]
+            max_workers: 最大进程数，默认为CPU核心数
+            on_result: 每个任务完成后的回调，参数为 (任务键, (词数, 开头文本))
             
-            # PDF文件
-            elif file_ext == ".pdf":
-                try:
-                    import PyPDF2
-                    with open(file_path, "rb") as f:
-                        reader = PyPDF2.PdfReader(f)
-                        text = ""
-                        for page in reader.pages:
-                            text += page.extract_text() + "\n"
-                        return text
-                except ImportError:
-                    return "无法提取PDF文本，请安装PyPDF2库"
-            
-            # Word文档
-            elif file_ext in [".docx", ".doc"]:
-                try:
-                    import docx
-                    doc = docx.Document(file_path)
-                    text = ""
-                    for para in doc.paragraphs:
-                        text += para.text + "\n"
-                    return text
-                except ImportError:
-                    return "无法提取Word文档文本，请安装python-docx库"
-            
-            # 其他文件类型
-            else:
-                return f"不支持的文件类型: {file_ext}"
+        Returns:
+            dict: 任务键 -> (词数, 开头文本)
+        """
+        results = {}
+        
+        def finish(key, result):
+            results[key] = result
+            if on_result:
+                on_result(key, result)
+        
+        if len(jobs) < self.parallel_extract_threshold:
+            for key, file_path, file_ext, dest_path in jobs:
+                finish(key, extract_to_file(file_path, file_ext, dest_path))
+            return results
+        
+        workers = min(max_workers or os.cpu_count() or 1, len(jobs))
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(extract_to_file, file_path, file_ext, dest_path): key
+                    for key, file_path, file_ext, dest_path in jobs
+                }
+                for future in as_completed(futures):
+                    finish(futures[future], future.result())
         except Exception as e:
-            return f"提取文本时出错: {str(e)}"
+            # 进程池不可用时（如受限环境）退回逐个提取
+            print(f"并行提取文本失败，改为逐个提取: {e}")
+            for key, file_path, file_ext, dest_path in jobs:
+                if key not in results:
+                    finish(key, extract_to_file(file_path, file_ext, dest_path))
+        return results
+    
+    def _build_file_info(self, file_path, category, stats, file_info=None):
+        """根据提取结果生成文件元数据
+        
+        Args:
+            file_path: 知识库中的文件路径
+            category: 分区名称
+            stats: extract_to_store 返回的 (词数, 开头文本)
+            file_info: 已有的元数据，更新时保留其中的其他字段
+            
+        Returns:
+            dict: 文件元数据
+        """
+        token_count, head = stats
+        if file_info is None:
+            file_ext = os.path.splitext(file_path)[1].lower()
+            file_info = {
+                "category": category,
+                "added_time": datetime.now().isoformat(),
+                "type": file_ext[1:] if file_ext else "unknown"
+            }
+        else:
+            file_info = dict(file_info)
+        file_info.update({
+            "path": self.portable_path(file_path),
+            "size": os.path.getsize(file_path),
+            "tokens": token_count,
+            "summary": self.generate_summary(head)
+        })
+        return file_info
     
     def generate_summary(self, text, max_length=200):
         """生成文本摘要（简单实现）"""
@@ -316,212 +1359,804 @@ class KnowledgeManager:
         # 简单实现：取开头部分文本
         return text[:max_length] + "..."
     
-    def _tokenize(self, text):
-        """将文本分词为列表
+    def _tokenize(self, text, unique=True):
+        """使用文本分析器将文本分词为列表
         
         Args:
             text: 要分词的文本
+            unique: 是否去重，建立倒排索引时需保留重复词以统计词频
             
         Returns:
             list: 分词后的标记列表
         """
         if not text:
             return []
+        tokens = self.analyzer.analyze(text)
+        
+        # 去重（保留首次出现的顺序）
+        if unique:
+            return list(dict.fromkeys(tokens))
+        return tokens
+    
+    def _token_spans(self, text):
+        """文本中各标记的字符范围，与 _tokenize(text, unique=False) 的结果一一对应
+        
+        Returns:
+            list: [(起始位置, 结束位置), ...]
+        """
+        return [(start, end) for _, start, end in self.analyzer.analyze_spans(text)]
+    
+    def _parse_query(self, query):
+        """解析查询，引号（"..." 或 “...”）中的内容作为短语，要求按顺序连续出现
         
-        # 转换为小写
-        text = text.lower()
+        Returns:
+            tuple: (去重后的查询标记列表, 短语列表)，每个短语为至少两个标记的标记列表
+        """
+        phrases = []
+        for match in re.finditer(r'"([^"]+)"|“([^”]+)”', query or ""):
+            tokens = self._tokenize(match.group(1) or match.group(2), unique=False)
+            if len(tokens) > 1 and tokens not in phrases:
+                phrases.append(tokens)
+        return self._tokenize(query), phrases
+    
+    def _contains_phrases(self, text, phrases):
+        """检查文本是否包含全部短语"""
+        if not phrases:
+            return True
+        joined = " " + " ".join(self._tokenize(text, unique=False)) + " "
+        return all(" " + " ".join(phrase) + " " in joined for phrase in phrases)
+    
+    def _snippet(self, text, positions):
+        """按查询词在片段中的位置截取摘要
         
-        # 移除标点符号，替换为空格
-        text = re.sub(r'[^\w\s]', ' ', text)
+        位置为入库时记录的查询词在片段标记序列中的序号，取查询词最密集的一段，
+        前后扩展到 snippet_length 个字符，不必再在段落中查找查询词。
         
-        # 按空格分词
-        tokens = text.split()
+        Args:
+            text: 片段文本
+            positions: 查询词在片段中的位置（升序）
+            
+        Returns:
+            str: 摘要，截断处以省略号标出
+        """
+        length = self.snippet_length
+        if len(text) <= length:
+            return text
         
-        # 移除过短的词
-        tokens = [token for token in tokens if len(token) > 1]
+        spans = self._token_spans(text)
+        offsets = [spans[position] for position in positions if position < len(spans)]
+        begin = 0
+        if offsets:
+            # 滑动窗口找出 length 个字符内命中最多的一段
+            best = (0, 0)
+            first = 0
+            for last in range(len(offsets)):
+                while offsets[last][1] - offsets[first][0] > length:
+                    first += 1
+                if last - first > best[1] - best[0]:
+                    best = (first, last)
+            center = (offsets[best[0]][0] + offsets[best[1]][1]) // 2
+            begin = max(0, min(center - length // 2, len(text) - length))
+        end = begin + length
         
-        # 去重
-        return list(set(tokens))
+        snippet = text[begin:end].strip()
+        if begin > 0:
+            snippet = "…" + snippet
+        if end < len(text):
+            snippet += "…"
+        return snippet
     
-    def _calculate_similarity(self, query_tokens, text_tokens):
-        """计算查询与文本之间的相似度
+    def _score_shards(self, query_tokens, categories, select):
+        """在相关的分区分片上打分，每个分片只返回自己的前若干个结果
+        
+        先由各分片统计查询词的文档频率并合并，再按这组统一的统计量为各分片打分，
+        不同分片的分数可以直接比较。检索多个分片时在线程池中并行进行。
+        调用方需持有 self._lock。
         
         Args:
-            query_tokens: 查询关键词的标记列表
-            text_tokens: 文本的标记列表
+            query_tokens: 去重后的查询标记列表
+            categories: 限定的分区名称列表，为None时检索全部分片
+            select: 在工作线程中调用，参数为分片的 BM25FScorer，返回该分片的候选结果列表
             
         Returns:
-            float: 相似度分数，取值范围 0~1
+            list: 各分片候选结果合并后的列表
         """
-        if not query_tokens or not text_tokens:
-            return 0
+        shards = [index for _, index in self.search_index.shards_for(categories)]
+        if not shards:
+            return []
+        
+        def frequencies(index):
+            return {token: index.document_frequency(token) for token in query_tokens}
+        
+        def score(index, stats):
+            scorer = BM25FScorer(index, self.field_weights, self.bm25_k1, self.bm25_b, stats,
+                                 self.proximity_weight, self.proximity_window)
+            return select(scorer)
         
-        # 计算共有词数量
-        common_tokens = set(query_tokens) & set(text_tokens)
+        if len(shards) == 1:
+            stats = CollectionStats(shards, [frequencies(shards[0])])
+            return score(shards[0], stats)
         
-        # 简单的相似度计算：共有词数量除以查询词数量
-        similarity = len(common_tokens) / len(query_tokens)
-        return similarity
+        if self._shard_executor is None:
+            self._shard_executor = ThreadPoolExecutor(max_workers=self.shard_search_workers)
+        stats = CollectionStats(shards, list(self._shard_executor.map(frequencies, shards)))
+        candidates = []
+        for shard_candidates in self._shard_executor.map(lambda index: score(index, stats), shards):
+            candidates.extend(shard_candidates)
+        return candidates
     
-    def refresh_index(self):
-        """刷新索引，确保所有文件都在索引中，并移除不存在的文件"""
-        try:
-            # 检查索引中的文件是否都存在，移除不存在的文件
-            files_to_remove = []
-            
-            for file_id, file_info in self.index["files"].items():
-                file_path = file_info.get("path", "")
-                if not file_path or not os.path.exists(file_path):
-                    files_to_remove.append(file_id)
+    def refresh_index(self, force=False):
+        """刷新索引，使索引与知识库目录保持一致
+        
+        只扫描修改时间发生变化的分区目录，并根据文件清单中的大小、修改时间和内容哈希
+        判断文件是否变化，只有新增或内容变化的文件才会重新提取文本，没有变化时不写盘。
+        提取文本时不持有 _lock，刷新期间查询不会被阻塞。
+        
+        Args:
+            force: 是否强制扫描所有分区目录并检查所有已索引文件
             
-            # 从索引中移除不存在的文件
-            for file_id in files_to_remove:
-                category = self.index["files"][file_id].get("category", "")
-                
-                # 从文件索引中移除
-                del self.index["files"][file_id]
+        Returns:
+            bool: 是否刷新成功
+        """
+        self.ensure_loaded()
+        with self._ingest_lock:
+            try:
+                changed = False
                 
-                # 从分区列表中移除
-                if category and category in self.index["categories"] and file_id in self.index["categories"][category]:
-                    self.index["categories"][category].remove(file_id)
-            
-            # 扫描知识库目录，添加新文件
-            for category in self.categories:
-                category_dir = os.path.join(self.knowledge_base_dir, category)
+                with self._lock:
+                    if force:
+                        # 检查索引中的文件是否都存在，移除不存在的文件
+                        for file_id, file_info in list(self._iter_files()):
+                            file_path = self.resolve_path(file_info.get("path", ""))
+                            if not file_path or not os.path.exists(file_path):
+                                self._drop_file(file_id)
+                                changed = True
+                    categories = self.get_categories()
                 
-                if os.path.exists(category_dir) and os.path.isdir(category_dir):
-                    for filename in os.listdir(category_dir):
-                        file_path = os.path.join(category_dir, filename)
-                        
-                        # 跳过目录
-                        if os.path.isdir(file_path):
+                # 扫描有变化的分区目录
+                for category in categories:
+                    category_dir = os.path.join(self.knowledge_base_dir, category)
+                    if not os.path.isdir(category_dir):
+                        continue
+                    
+                    dir_mtime = os.stat(category_dir).st_mtime
+                    with self._lock:
+                        if not force and not self.manifest.dir_changed(category, dir_mtime):
                             continue
-                        
-                        # 检查文件是否已在索引中
-                        file_id = f"{category}/{filename}"
-                        if file_id not in self.index["files"]:
-                            # 添加到索引
-                            file_ext = os.path.splitext(filename)[1].lower()
-                            content = self.extract_text(file_path, file_ext)
-                            
-                            self.index["files"][file_id] = {
-                                "path": file_path,
-                                "category": category,
-                                "added_time": datetime.now().isoformat(),
-                                "type": file_ext[1:] if file_ext else "unknown",
-                                "size": os.path.getsize(file_path),
-                                "tokens": len(content.split()),
-                                "content": content,  # 添加内容字段用于搜索
-                                "summary": self.generate_summary(content)
-                            }
-                            
-                            # 更新分区文件列表
-                            if file_id not in self.index["categories"][category]:
-                                self.index["categories"][category].append(file_id)
-            
-            # 保存更新后的索引
-            self.save_index()
-            return True
+                    
+                    if self._scan_category(category, category_dir):
+                        changed = True
+                    with self._lock:
+                        self.manifest.record_dir(category, dir_mtime)
+                
+                with self._lock:
+                    # 强制刷新时清理已没有对应文件的提取缓存
+                    if force:
+                        self.extraction_cache.prune(
+                            {entry.get("sha256") for entry in self.manifest.files.values()}
+                        )
+                    
+                    # 保存更新后的索引
+                    if changed:
+                        self._commit()
+                    else:
+                        self.manifest.save()
+                return True
+            except Exception as e:
+                print(f"刷新索引时出错: {e}")
+                return False
+    
+    def _scan_category(self, category, category_dir):
+        """扫描分区目录，索引新增和内容变化的文件，并移除已删除的文件
+        
+        Args:
+            category: 分区名称
+            category_dir: 分区目录
+            
+        Returns:
+            bool: 索引是否有变化
+        """
+        seen = set()
+        items = []
+        
+        for filename in os.listdir(category_dir):
+            file_path = os.path.join(category_dir, filename)
+            
+            # 跳过目录
+            if os.path.isdir(file_path):
+                continue
+            
+            file_id = f"{category}/{filename}"
+            seen.add(file_id)
+            items.append((file_id, category, file_path))
+        
+        changed = self._sync_files(items) > 0
+        
+        # 移除目录中已不存在的文件
+        with self._lock:
+            for file_id in self._list_file_ids([category]):
+                if file_id not in seen:
+                    self._drop_file(file_id)
+                    changed = True
+        
+        return changed
+    
+    def _sync_files(self, items):
+        """根据文件清单同步一批文件，只有新增或内容变化的文件才重新提取文本
+        
+        需要提取的文件会一起交给 extract_to_store 并行处理。只在读取清单和写入索引时持有 _lock，
+        计算哈希和提取文本时不持有。调用方需持有 _ingest_lock，以免两次同步同时提取同一文件。
+        
+        Args:
+            items: [(文件ID, 分区名称, 文件路径), ...]
+            
+        Returns:
+            int: 索引发生变化的文件数
+        """
+        candidates = []
+        with self._lock:
+            for file_id, category, file_path in items:
+                # 大小和修改时间都未变化，跳过
+                stat_result = os.stat(file_path)
+                file_info = self._get_file_entry(file_id)
+                if file_info is not None and self.manifest.is_unchanged(file_id, stat_result):
+                    continue
+                candidates.append((file_id, category, file_path, stat_result, file_info))
+        
+        hashed = [candidate + (file_sha256(candidate[2]),) for candidate in candidates]
+        
+        pending = {}
+        with self._lock:
+            for file_id, category, file_path, stat_result, file_info, sha256 in hashed:
+                # 内容哈希未变化（或旧版索引尚无清单记录）时只更新清单
+                entry = self.manifest.get(file_id)
+                if file_info is not None and (entry is None or entry.get("sha256") == sha256):
+                    self.manifest.record(file_id, self.portable_path(file_path), stat_result, sha256)
+                    continue
+                pending[file_id] = (category, file_path, stat_result, sha256, file_info)
+        
+        if not pending:
+            return 0
+        
+        stored = [0]
+        
+        def store(file_id, stats):
+            category, file_path, stat_result, sha256, file_info = pending[file_id]
+            try:
+                file_info = self._build_file_info(file_path, category, stats, file_info)
+                with self._lock:
+                    self._store_file(file_id, file_info, stat_result, sha256)
+                stored[0] += 1
+            except Exception as e:
+                print(f"更新文件 {file_id} 的索引时出错: {e}")
+        
+        # 新文件或内容已变化，重新提取文本，每个文件提取完成后立即写入索引
+        self.extract_to_store(
+            [(file_id, item[1], item[3]) for file_id, item in pending.items()], on_extracted=store
+        )
+        return stored[0]
+    
+    def ingest_changes(self, file_ids):
+        """批量处理文件变化（新增、修改或删除），全部处理完后只提交一次索引
+        
+        Args:
+            file_ids: 发生变化的文件ID列表，格式为"分区/文件名"
+            
+        Returns:
+            int: 索引发生变化的文件数
+        """
+        self.ensure_loaded()
+        with self._ingest_lock:
+            changed = 0
+            items = []
+            for file_id in file_ids:
+                if "/" not in file_id:
+                    continue
+                category, filename = file_id.split("/", 1)
+                file_path = os.path.join(self.knowledge_base_dir, category, filename)
+                if os.path.isfile(file_path):
+                    items.append((file_id, category, file_path))
+                else:
+                    with self._lock:
+                        if self._drop_file(file_id):
+                            changed += 1
+            
+            try:
+                changed += self._sync_files(items)
+            except Exception as e:
+                print(f"更新知识库索引时出错: {e}")
+            
+            with self._lock:
+                if changed:
+                    self._commit()
+                else:
+                    self.manifest.save()
+            return changed
+    
+    def import_folder(self, folder_path, category="其他", max_workers=None, progress_callback=None):
+        """批量导入文件夹中的文件
+        
+        文件先全部复制到分区目录，再使用进程池并行提取文本，最后一次性提交索引。
+        
+        Args:
+            folder_path: 要导入的文件夹
+            category: 分区名称，默认为"其他"
+            max_workers: 提取文本的最大进程数，默认为CPU核心数
+            progress_callback: 每个文件处理完成后的回调，参数同 add_files
+            
+        Returns:
+            int: 成功导入的文件数
+        """
+        try:
+            file_paths = [
+                os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path))
+                if os.path.isfile(os.path.join(folder_path, filename))
+            ]
         except Exception as e:
-            print(f"刷新索引时出错: {e}")
-            return False
+            print(f"批量导入文件夹时出错: {e}")
+            return 0
+        results = self.add_files(file_paths, category, max_workers, progress_callback)
+        return sum(1 for result in results if result["success"])
+    
+    def start_watcher(self, on_batch=None):
+        """启动知识库目录监视，文件变化由后台线程批量入库
+        
+        Args:
+            on_batch: 每批处理完成后的回调，参数为处理的文件ID列表
+        """
+        if self.watcher is None:
+            self.watcher = KnowledgeWatcher(self, on_batch=on_batch)
+            self.watcher.start()
     
-    def search(self, query, categories=None, max_results=5):
+    def stop_watcher(self):
+        """停止知识库目录监视"""
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+    
+    def start_auto_refresh(self, interval=30):
+        """启动后台定期刷新，查询时不再需要扫描文件系统
+        
+        Args:
+            interval: 刷新间隔（秒）
+        """
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return
+        
+        self._refresh_stop.clear()
+        
+        def refresh_loop():
+            while True:
+                self.refresh_index()
+                if self._refresh_stop.wait(interval):
+                    break
+        
+        self._refresh_thread = threading.Thread(target=refresh_loop, daemon=True)
+        self._refresh_thread.start()
+    
+    def stop_auto_refresh(self):
+        """停止后台定期刷新"""
+        self._refresh_stop.set()
+        if self._refresh_thread:
+            self._refresh_thread.join(timeout=5)
+            self._refresh_thread = None
+    
+    def search(self, query, categories=None, max_results=5, min_score_ratio=None):
         """搜索知识库内的内容
         
         Args:
             query: 查询关键词
             categories: 要搜索的知识库分区，默认为全部
             max_results: 最大结果数量
+            min_score_ratio: 分数低于最高分该比例的结果将被舍弃，默认使用 self.min_score_ratio
             
         Returns:
-            list: 含有匹配结果的列表
+            list: 含有匹配结果的列表；近似重复的文件只保留分数最高的一个，其余文件ID列在该结果的 duplicates 中
         """
-        if not self.index or not self.index.get("files"):
+        self.ensure_loaded()
+        if not self._has_files():
             return []
         
-        # 确保索引是最新的
-        self.refresh_index()
+        if min_score_ratio is None:
+            min_score_ratio = self.min_score_ratio
         
         # 处理分区筛选
-        file_ids_to_search = []
         if categories:
             if isinstance(categories, str):
                 categories = [categories]
-            # 只获取指定分区的文件ID列表
-            for category in categories:
-                if category in self.index["categories"]:
-                    file_ids_to_search.extend(self.index["categories"][category])
         else:
-            # 获取所有文件ID
-            for category_files in self.index["categories"].values():
-                file_ids_to_search.extend(category_files)
+            categories = None
         
-        # 执行搜索
-        results = []
-        query_tokens = self._tokenize(query)
+        query_tokens, phrases = self._parse_query(query)
+        if not query_tokens:
+            return []
         
-        for file_id in file_ids_to_search:
-            if file_id not in self.index["files"]:
+        # 执行搜索，得到 (文件ID, 分数, 上下文段落) 列表；索引由后台刷新维护，查询时不扫描文件系统
+        def retrieve(depth):
+            if self.sqlite_store is not None:
+                return self.sqlite_store.search(query_tokens, categories, depth, self.field_weights, phrases=phrases)
+            return self._search_inverted_index(query_tokens, categories, depth, phrases)
+        
+        with self._lock:
+            ranked, entries, leaders = self._retrieve_collapsed(retrieve, max_results)
+        
+        results = []
+        # 同一重复组的文件只保留分数最高的一个，其余记入该结果的 duplicates
+        clusters = {}
+        for (file_id, score, matches), leader in zip(ranked, leaders):
+            file_info = entries.get(file_id)
+            if file_info is None:
+                continue
+            if leader != file_id:
+                clusters[leader]["duplicates"].append(file_id)
                 continue
-                
-            file_info = self.index["files"][file_id]
             filename = file_id.split("/", 1)[1] if "/" in file_id else file_id
             
-            # 获取文件内容或摘要
-            content = file_info.get('content', '')
-            if not content and os.path.exists(file_info.get('path', '')):
-                # 如果索引中没有内容，尝试读取文件
-                file_ext = os.path.splitext(filename)[1].lower()
-                content = self.extract_text(file_info['path'], file_ext)
-            
-            title = file_info.get('title', filename)
-            abstract = file_info.get('summary', '')
-            
-            # 计算相关度分数
-            score = 0
-            matches = []
-            
-            # 分段搜索
-            if content:
-                paragraphs = content.split('\n\n')
-                for para in paragraphs:
-                    if not para.strip():
-                        continue
-                    para_score = self._calculate_similarity(query_tokens, self._tokenize(para))
-                    if para_score > 0.2:  # 相关度阈值
-                        score += para_score
-                        matches.append(para)
-            
-            # 标题和摘要匹配加权
-            if title:
-                title_score = self._calculate_similarity(query_tokens, self._tokenize(title)) * 2
-                score += title_score
-            
-            if abstract:
-                abstract_score = self._calculate_similarity(query_tokens, self._tokenize(abstract)) * 1.5
-                score += abstract_score
-            
-            if score > 0:
-                result = {
-                    "file_id": file_id,
-                    "filename": filename,
-                    "path": file_info.get("path", ""),
-                    "category": file_info.get("category", "其他"),
-                    "score": score,
-                    "contexts": matches[:3],  # 最多返回3个匹配段落
-                    "summary": abstract
-                }
-                
-                # 添加其他有用的元数据
-                for key in ["title", "authors", "year", "source", "added_time"]:
-                    if key in file_info:
-                        result[key] = file_info[key]
-                        
-                results.append(result)
+            result = {
+                "file_id": file_id,
+                "filename": filename,
+                "path": self.resolve_path(file_info.get("path", "")),
+                "category": file_info.get("category", "其他"),
+                "score": score,
+                "contexts": matches,  # 最多返回3个匹配段落的摘要
+                "summary": file_info.get('summary', ''),
+                "duplicates": []
+            }
+            clusters[file_id] = result
+            
+            # 添加其他有用的元数据
+            for key in ["title", "authors", "year", "source", "added_time"]:
+                if key in file_info:
+                    result[key] = file_info[key]
+                    
+            results.append(result)
         
         # 按相关度排序并限制结果数
         results = sorted(results, key=lambda x: x['score'], reverse=True)[:max_results]
+        
+        # 舍弃与最佳结果相差过大的结果；最佳结果也没有有效得分时（只命中常见词）不筛选
+        if results and min_score_ratio > 0 and results[0]['score'] > 0:
+            threshold = results[0]['score'] * min_score_ratio
+            results = [r for r in results if r['score'] >= threshold]
+        return results
+    
+    def _search_inverted_index(self, query_tokens, categories=None, max_results=5, phrases=None):
+        """使用分区倒排索引和BM25F检索文件
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            categories: 限定的分区名称列表，为None时不限制
+            max_results: 最多返回的文件数
+            phrases: 文件必须包含的短语列表，每个短语为标记列表
+
+        Returns:
+            list: [(文件ID, 分数, [段落摘要, ...]), ...]，按分数从高到低排列
+        """
+        # 同分时按分区文件顺序排列
+        order = {file_id: i for i, file_id in enumerate(self._list_file_ids(categories))}
+        
+        def select(scorer):
+            return [
+                (-score, order.get(file_id, len(order)), file_id, chunk_scores)
+                for file_id, score, chunk_scores in scorer.top_documents(query_tokens, max_results, order,
+                                                                         phrases=phrases)
+            ]
+        
+        ranked = []
+        for neg_score, _, file_id, chunk_scores in heapq.nsmallest(
+                max_results, self._score_shards(query_tokens, categories, select)):
+            # 只为命中的文件读取最相关的片段原文，按索引中的词项位置截取摘要
+            chunk_nos = [chunk_no for chunk_no, _ in chunk_scores[:3]]
+            chunks = self.content_store.get_chunks(file_id, chunk_nos)
+            positions = self.search_index.chunk_positions(file_id, query_tokens, chunk_nos)
+            matches = [
+                self._snippet(chunks[chunk_no], positions.get(chunk_no, []))
+                for chunk_no in chunk_nos if chunk_no in chunks
+            ]
+            ranked.append((file_id, -neg_score, matches))
+        return ranked
+    
+    def search_chunks(self, query, categories=None, max_results=5, min_score_ratio=None, mode="lexical"):
+        """在所有文件的检索片段中搜索，返回最相关的若干片段
+        
+        Args:
+            query: 查询关键词
+            categories: 要搜索的知识库分区，默认为全部
+            max_results: 最多返回的片段数
+            min_score_ratio: 分数低于最高分该比例的片段将被舍弃，默认使用 self.min_score_ratio
+            mode: "lexical" 使用BM25关键词检索，"vector" 使用向量相似度检索，
+                  "hybrid" 同时进行两种检索并按倒数排名融合
+            
+        Returns:
+            list: 片段列表，每项包含 chunk_id、file_id、chunk_no、text、score 及所属文件的元数据
+        """
+        self.ensure_loaded()
+        if not self._has_files():
+            return []
+        
+        if min_score_ratio is None:
+            min_score_ratio = self.min_score_ratio
+        
+        if categories:
+            if isinstance(categories, str):
+                categories = [categories]
+        else:
+            categories = None
+        
+        query_tokens, phrases = self._parse_query(query)
+        if not query_tokens:
+            return []
+        
+        start_time = time.perf_counter()
+        timings = {}
+        
+        # 相同（或只有大小写、标点、空白差异）的查询直接使用缓存结果
+        cache_key = (
+            " ".join(self._tokenize(query, unique=False)),
+            tuple(" ".join(phrase) for phrase in phrases),
+            tuple(categories) if categories else None,
+            max_results, min_score_ratio, mode
+        )
+        cached = self._get_cached_passages(cache_key)
+        if cached is not None:
+            elapsed = (time.perf_counter() - start_time) * 1000
+            self.last_search_timings = {"cache": elapsed, "total": elapsed}
+            return cached
+        
+        if mode in ("vector", "hybrid"):
+            if self.vector_store is None:
+                # 未安装NumPy时混合检索只使用关键词检索
+                if mode == "vector":
+                    print("向量检索需要安装NumPy，改用关键词检索")
+                mode = "lexical"
+            else:
+                # 查询向量化可能需要请求远程接口，不在锁内进行
+                stage_start = time.perf_counter()
+                query_vector = self.embedder.embed([query])[0]
+                timings["embed"] = (time.perf_counter() - stage_start) * 1000
+        
+        def retrieve(depth):
+            stage_start = time.perf_counter()
+            if mode == "hybrid":
+                return self._search_hybrid_chunks(query_tokens, query_vector, categories, depth, timings,
+                                                  phrases, min_score_ratio)
+            if mode == "vector":
+                ranked = self._search_vector_chunks(query_vector, categories, depth, query_tokens)
+            else:
+                ranked = self._search_lexical_chunks(query_tokens, categories, depth, phrases)
+            timings[mode] = (time.perf_counter() - stage_start) * 1000
+            return ranked
+        
+        with self._lock:
+            generation = self.index_generation
+            ranked, entries, leaders = self._retrieve_collapsed(retrieve, max_results)
+        
+        timings["total"] = (time.perf_counter() - start_time) * 1000
+        self.last_search_timings = timings
+        
+        passages = []
+        # 同一重复组中只保留最先出现（分数最高）的文件的片段
+        for (file_id, chunk_no, score, text), leader in zip(ranked, leaders):
+            file_info = entries.get(file_id)
+            if file_info is None or leader != file_id:
+                continue
+            filename = file_id.split("/", 1)[1] if "/" in file_id else file_id
+            
+            passage = {
+                "chunk_id": f"{file_id}#{chunk_no}",
+                "file_id": file_id,
+                "chunk_no": chunk_no,
+                "filename": filename,
+                "path": self.resolve_path(file_info.get("path", "")),
+                "category": file_info.get("category", "其他"),
+                "score": score,
+                "text": text
+            }
+            for key in ["title", "authors", "year", "source"]:
+                if key in file_info:
+                    passage[key] = file_info[key]
+            passages.append(passage)
+        passages = passages[:max_results]
+        
+        # 舍弃与最佳片段相差过大的片段；最佳片段也没有有效得分时（只命中常见词）不筛选。
+        # 混合检索的融合分数只反映排名，已在融合前按各检索的原始分数筛选
+        if passages and min_score_ratio > 0 and passages[0]['score'] > 0 and mode != "hybrid":
+            threshold = passages[0]['score'] * min_score_ratio
+            passages = [p for p in passages if p['score'] >= threshold]
+        
+        self._cache_passages(cache_key, passages, generation)
+        return passages
+    
+    def _retrieve_collapsed(self, retrieve, max_results):
+        """取检索结果，同一重复组只计一次；合并后不足 max_results 个时加深检索，需持有 _lock
+        
+        Args:
+            retrieve: 检索函数，参数为结果数，返回按分数从高到低排列、首项为文件ID的结果列表
+            max_results: 合并重复组后需要的结果数
+            
+        Returns:
+            tuple: (结果列表, 文件ID -> 元数据, 每个结果所在重复组中第一个出现的文件ID列表)
+        """
+        depth = max_results
+        while True:
+            ranked = retrieve(depth)
+            entries = {hit[0]: self._get_file_entry(hit[0]) for hit in ranked}
+            leaders = []
+            first = {}
+            for hit in ranked:
+                file_info = entries.get(hit[0])
+                if file_info is None:
+                    leaders.append(None)
+                    continue
+                leaders.append(first.setdefault(file_info.get("duplicate_of", hit[0]), hit[0]))
+            kept = sum(1 for hit, leader in zip(ranked, leaders) if leader == hit[0])
+            collapsed = sum(1 for hit, leader in zip(ranked, leaders) if leader is not None and leader != hit[0])
+            # 没有被合并的结果，或检索结果已经取尽时不再加深
+            if kept >= max_results or not collapsed or len(ranked) < depth:
+                return ranked, entries, leaders
+            depth = len(ranked) + collapsed
+    
+    def _get_cached_passages(self, cache_key):
+        """读取缓存的检索结果，索引变化后缓存全部失效
+        
+        Returns:
+            list: 结果的副本，没有缓存时返回None
+        """
+        with self._lock:
+            if self._query_cache_generation != self.index_generation:
+                self._query_cache.clear()
+                self._query_cache_generation = self.index_generation
+                return None
+            passages = self._query_cache.get(cache_key)
+            if passages is None:
+                return None
+            self._query_cache.move_to_end(cache_key)
+            return [dict(passage) for passage in passages]
+    
+    def _cache_passages(self, cache_key, passages, generation):
+        """缓存检索结果，检索期间索引已变化时不缓存
+        
+        Args:
+            cache_key: 缓存键
+            passages: 检索结果
+            generation: 开始检索时的索引代数
+        """
+        with self._lock:
+            if generation != self.index_generation or self.query_cache_size <= 0:
+                return
+            if self._query_cache_generation != generation:
+                self._query_cache.clear()
+                self._query_cache_generation = generation
+            self._query_cache[cache_key] = [dict(passage) for passage in passages]
+            self._query_cache.move_to_end(cache_key)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+    
+    def _search_lexical_chunks(self, query_tokens, categories=None, max_results=5, phrases=None):
+        """使用当前后端的BM25检索片段，返回 [(文件ID, 片段序号, 分数, 片段文本), ...]"""
+        if self.sqlite_store is not None:
+            return self.sqlite_store.search_chunks(query_tokens, categories, max_results, phrases)
+        return self._search_inverted_chunks(query_tokens, categories, max_results, phrases)
+    
+    def _search_hybrid_chunks(self, query_tokens, query_vector, categories, max_results, timings, phrases=None,
+                              min_score_ratio=0.0):
+        """并行进行关键词检索和向量检索，按倒数排名融合（RRF）两组结果
+        
+        融合分数至少为 1/(rrf_k + 排名)，不能说明片段是否相关，因此在融合前按各检索的原始分数筛选：
+        舍弃没有有效得分（只命中常见词、相似度不高于 vector_min_similarity）的片段，
+        以及低于该检索最高分 min_score_ratio 倍的片段；两种检索都没有结果时返回空列表。
+        调用方需持有 self._lock，两个检索在工作线程中执行时索引不会被修改。
+        
+        Args:
+            query_tokens: 去重后的查询标记列表
+            query_vector: 归一化后的查询向量
+            categories: 限定的分区名称列表，为None时不限制
+            max_results: 最多返回的片段数
+            timings: 用于记录各阶段耗时（毫秒）的字典
+            phrases: 片段必须包含的短语列表，向量检索的结果中不含短语的片段被舍弃
+            min_score_ratio: 各检索结果中分数低于其最高分该比例的片段被舍弃
+            
+        Returns:
+            list: [(文件ID, 片段序号, 融合分数, 片段文本), ...]，按融合分数从高到低排列
+        """
+        depth = max(max_results, self.hybrid_candidates)
+        
+        def timed(stage, func, *args):
+            stage_start = time.perf_counter()
+            result = func(*args)
+            timings[stage] = (time.perf_counter() - stage_start) * 1000
+            return result
+        
+        if self._search_executor is None:
+            self._search_executor = ThreadPoolExecutor(max_workers=2)
+        lexical = self._search_executor.submit(
+            timed, "lexical", self._search_lexical_chunks, query_tokens, categories, depth, phrases
+        )
+        vector = self._search_executor.submit(
+            timed, "vector", self._search_vector_chunks, query_vector, categories, depth, query_tokens
+        )
+        rankings = {"lexical": lexical.result(), "vector": vector.result()}
+        if phrases:
+            rankings["vector"] = [hit for hit in rankings["vector"] if self._contains_phrases(hit[3], phrases)]
+        for name, ranked in rankings.items():
+            ranked = [hit for hit in ranked if hit[2] > 0]
+            if ranked and min_score_ratio > 0:
+                threshold = ranked[0][2] * min_score_ratio
+                ranked = [hit for hit in ranked if hit[2] >= threshold]
+            rankings[name] = ranked
+        
+        stage_start = time.perf_counter()
+        fused = {}
+        for name, ranked in rankings.items():
+            weight = self.hybrid_weights.get(name, 1.0)
+            for rank, (file_id, chunk_no, _, text) in enumerate(ranked, 1):
+                entry = fused.setdefault((file_id, chunk_no), [0.0, text])
+                entry[0] += weight / (self.rrf_k + rank)
+        
+        ordered = sorted(fused.items(), key=lambda item: -item[1][0])[:max_results]
+        timings["fusion"] = (time.perf_counter() - stage_start) * 1000
+        return [(file_id, chunk_no, score, text) for (file_id, chunk_no), (score, text) in ordered]
+    
+    def _search_inverted_chunks(self, query_tokens, categories=None, max_results=5, phrases=None):
+        """使用倒排索引对片段打分，取分数最高的若干片段
+        
+        Args:
+            query_tokens: 去重后的查询标记列表
+            categories: 限定的分区名称列表，为None时不限制
+            max_results: 最多返回的片段数
+            phrases: 片段必须包含的短语列表，每个短语为标记列表
+            
+        Returns:
+            list: [(文件ID, 片段序号, 分数, 片段文本), ...]，按分数从高到低排列
+        """
+        # 同分时按分区文件顺序和片段序号排列
+        order = {file_id: i for i, file_id in enumerate(self._list_file_ids(categories))}
+        
+        def select(scorer):
+            return [
+                (-chunk_score, order.get(file_id, len(order)), chunk_no, file_id)
+                for file_id, chunk_no, chunk_score in scorer.top_chunks(query_tokens, max_results, order,
+                                                                        phrases=phrases)
+            ]
+        
+        top = heapq.nsmallest(max_results, self._score_shards(query_tokens, categories, select))
+        
+        # 按文件分组读取片段原文
+        wanted = {}
+        for _, _, chunk_no, file_id in top:
+            wanted.setdefault(file_id, []).append(chunk_no)
+        texts = {file_id: self.content_store.get_chunks(file_id, chunk_nos) for file_id, chunk_nos in wanted.items()}
+        
+        return [
+            (file_id, chunk_no, -neg_score, texts[file_id].get(chunk_no, ""))
+            for neg_score, _, chunk_no, file_id in top
+        ]
+    
+    def _search_vector_chunks(self, query_vector, categories=None, max_results=5, query_tokens=None):
+        """使用向量相似度检索片段
+        
+        Args:
+            query_vector: 归一化后的查询向量
+            categories: 限定的分区名称列表，为None时不限制
+            max_results: 最多返回的片段数
+            query_tokens: 查询标记；使用本地哈希向量化时，不含任何查询标记的片段（相似度来自哈希冲突）被舍弃
+            
+        Returns:
+            list: [(文件ID, 片段序号, 相似度, 片段文本), ...]，按相似度从高到低排列
+        """
+        file_ids = None if categories is None else set(self._list_file_ids(categories))
+        hits = self.vector_store.search(query_vector, max_results, file_ids, self.vector_min_similarity)
+        
+        # 按文件分组读取片段原文
+        wanted = {}
+        for file_id, chunk_no, _ in hits:
+            wanted.setdefault(file_id, []).append(chunk_no)
+        texts = {file_id: self._get_chunks(file_id, chunk_nos) for file_id, chunk_nos in wanted.items()}
+        
+        results = [(file_id, chunk_no, score, texts[file_id].get(chunk_no, "")) for file_id, chunk_no, score in hits]
+        if query_tokens and getattr(self.embedder, "lexical", False):
+            wanted_tokens = set(query_tokens)
+            results = [hit for hit in results if wanted_tokens.intersection(self._tokenize(hit[3]))]
         return results
     
     def get_files_by_category(self, category=None):
@@ -538,17 +2173,15 @@ class KnowledgeManager:
         try:
             if category and category in self.categories:
                 # 获取特定分区的文件
-                file_ids = self.index["categories"].get(category, [])
+                file_ids = self._list_file_ids([category])
             else:
                 # 获取所有文件
-                file_ids = []
-                for cat_files in self.index["categories"].values():
-                    file_ids.extend(cat_files)
+                file_ids = self._list_file_ids()
             
             # 收集文件信息
             for file_id in file_ids:
-                if file_id in self.index["files"]:
-                    file_info = self.index["files"][file_id]
+                file_info = self._get_file_entry(file_id)
+                if file_info is not None:
                     filename = file_id.split("/", 1)[1] if "/" in file_id else file_id
                     
                     # 基本信息
@@ -559,7 +2192,7 @@ class KnowledgeManager:
                         "type": file_info.get("type", "unknown"),
                         "size": file_info.get("size", 0),
                         "added_time": file_info.get("added_time", ""),
-                        "path": file_info.get("path", ""),
+                        "path": self.resolve_path(file_info.get("path", "")),
                         "summary": file_info.get("summary", "")
                     }
                     
@@ -579,7 +2212,7 @@ class KnowledgeManager:
     def get_all_files(self):
         """获取知识库中的所有文件信息"""
         files = []
-        for filename, info in self.index["files"].items():
+        for filename, info in self._iter_files():
             file_path = os.path.join(self.knowledge_base_dir, filename)
             if os.path.exists(file_path):
                 files.append({
@@ -591,55 +2224,139 @@ class KnowledgeManager:
                 })
         return files
     
-    def get_knowledge_context(self, query, categories=None, max_results=3):
+    def get_knowledge_context(self, query, categories=None, max_results=None, mode=None, token_budget=None):
         """获取与查询相关的知识库上下文，用于增强AI回答
         
+        以检索片段为单位检索，候选片段先按最大边际相关（MMR）重新排序，避免同一篇长文的相似段落占满上下文，
+        再在token预算内按该顺序放入片段：内容重复的片段只放一次，
+        放不下的片段跳过并继续尝试分数较低但较短的片段，最相关的片段本身超出预算时截断后放入。
+        同一文件的片段放在一起，相邻片段的重叠部分只保留一次。各阶段耗时见 self.last_search_timings。
+        
         Args:
             query: 查询关键词
             categories: 要搜索的知识库分区，默认为全部
-            max_results: 最大结果数量
+            max_results: 最多使用的片段数，默认只受token预算限制
+            mode: 检索方式（"lexical"、"vector" 或 "hybrid"），默认使用 self.context_search_mode
+            token_budget: 上下文的token预算（按 estimate_tokens 估计），默认使用 self.context_token_budget
             
         Returns:
             str: 格式化后的知识库上下文
         """
-        # 从指定分区或所有分区搜索
-        search_results = self.search(query, categories=categories, max_results=max_results)
+        token_budget = token_budget or self.context_token_budget
+        candidates = max(self.context_candidates, max_results or 0)
+        passages = self.search_chunks(query, categories=categories, max_results=candidates,
+                                      min_score_ratio=self.context_min_score_ratio,
+                                      mode=mode or self.context_search_mode)
         
-        if not search_results:
+        if not passages:
             return ""
         
+        passages = self._diversify(passages)
         context = "以下是来自知识库的相关信息：\n\n"
+        remaining = token_budget - estimate_tokens(context)
         
-        for i, result in enumerate(search_results, 1):
-            # 显示分区信息
-            category = result.get('category', '未分类')
-            context += f"{i}. 【{category}】{result.get('filename', '')}\n"
-            
-            # 添加标题和作者信息（如果有）
-            if 'title' in result:
-                context += f"标题: {result['title']}\n"
-            if 'authors' in result:
-                context += f"作者: {result['authors']}\n"
-            if 'year' in result:
-                context += f"年份: {result['year']}\n"
-            
-            # 相关内容片段
-            if result.get('contexts') and len(result['contexts']) > 0:
-                context += "相关内容：\n"
-                for ctx in result['contexts']:
-                    # 截断过长的内容
-                    if len(ctx) > 300:
-                        ctx = ctx[:300] + "..."
-                    context += f"  {ctx}\n"
-            elif 'abstract' in result:
-                context += f"摘要: {result['abstract']}\n"
-            elif 'summary' in result:
-                context += f"摘要: {result['summary']}\n"
-            
+        # 按重新排序后的顺序挑选片段，文件的标题等信息在放入该文件的第一个片段时计入预算
+        grouped = {}
+        seen = set()
+        count = 0
+        for passage in passages:
+            if max_results and count >= max_results:
+                break
+            key = " ".join(self._tokenize(passage["text"], unique=False))
+            if not key or key in seen:
+                continue
+            cost = estimate_tokens(passage["text"]) + 1
+            if passage["file_id"] not in grouped:
+                cost += estimate_tokens(self._context_header(len(grouped) + 1, passage))
+            if cost > remaining:
+                if grouped:
+                    continue
+                # 最相关的片段超出预算时截断
+                text = self._truncate_to_tokens(passage["text"], remaining - (cost - estimate_tokens(passage["text"])))
+                if not text:
+                    break
+                passage = dict(passage, text=text)
+                cost = remaining
+            seen.add(key)
+            grouped.setdefault(passage["file_id"], []).append(passage)
+            remaining -= cost
+            count += 1
+        
+        for i, file_passages in enumerate(grouped.values(), 1):
+            context += self._context_header(i, file_passages[0])
+            previous = None
+            for passage in sorted(file_passages, key=lambda p: p["chunk_no"]):
+                text = passage["text"]
+                if previous is not None and previous["chunk_no"] + 1 == passage["chunk_no"]:
+                    # 相邻片段开头与上一片段末尾重叠，去掉重叠部分
+                    text = text[self._overlap_length(previous["text"], text):].strip()
+                if text:
+                    context += f"  {text}\n"
+                previous = passage
             context += "\n"
         
         return context
     
+    def _diversify(self, passages):
+        """按最大边际相关（MMR）重新排列候选片段
+        
+        每次选出 mmr_lambda × 相对分数 - (1 - mmr_lambda) × 与已选片段的最大相似度 最高的片段，
+        相似度为相邻两个词元组成的片段集合的Jaccard相似度。候选片段数不超过 context_candidates，
+        每选出一个片段只需将其与其余候选比较一次，耗时与候选数的平方成正比。
+        
+        Args:
+            passages: search_chunks 返回的片段列表，按分数从高到低排列
+            
+        Returns:
+            list: 重新排列后的片段列表
+        """
+        if self.mmr_lambda >= 1 or len(passages) <= 2:
+            return passages
+        top_score = passages[0]["score"] or 1.0
+        relevance = [passage["score"] / top_score for passage in passages]
+        shingle_sets = [shingles(self._tokenize(passage["text"], unique=False)) for passage in passages]
+        redundancy = [0.0] * len(passages)
+        remaining = list(range(len(passages)))
+        ordered = []
+        while remaining:
+            best = max(remaining, key=lambda i: (self.mmr_lambda * relevance[i]
+                                                 - (1 - self.mmr_lambda) * redundancy[i], -i))
+            remaining.remove(best)
+            ordered.append(passages[best])
+            for i in remaining:
+                redundancy[i] = max(redundancy[i], jaccard(shingle_sets[best], shingle_sets[i]))
+        return ordered
+    
+    @staticmethod
+    def _context_header(number, passage):
+        """对话上下文中文件的标题信息"""
+        header = f"{number}. 【{passage.get('category', '未分类')}】{passage.get('filename', '')}\n"
+        # 添加标题和作者信息（如果有）
+        if 'title' in passage:
+            header += f"标题: {passage['title']}\n"
+        if 'authors' in passage:
+            header += f"作者: {passage['authors']}\n"
+        if 'year' in passage:
+            header += f"年份: {passage['year']}\n"
+        return header + "相关内容：\n"
+    
+    @staticmethod
+    def _truncate_to_tokens(text, max_tokens):
+        """截取文本开头不超过 max_tokens 个token的部分，不足一个token时返回空字符串"""
+        if max_tokens <= 1:
+            return ""
+        end = len(text)
+        while end > 0 and estimate_tokens(text[:end]) + 1 > max_tokens:
+            end = end * max_tokens // (estimate_tokens(text[:end]) + 1)
+        return text[:end] + "…" if end else ""
+    
+    def _overlap_length(self, previous, text):
+        """计算 text 开头与 previous 末尾重叠的字符数（不超过切分时的重叠长度）"""
+        for length in range(min(self.chunker.overlap, len(previous), len(text)), 0, -1):
+            if previous.endswith(text[:length]):
+                return length
+        return 0
+    
     def get_file_info(self, file_id):
         """获取指定文件的详细信息
         
@@ -650,9 +2367,12 @@ class KnowledgeManager:
             dict: 文件信息字典或None（如果文件不存在）
         """
         try:
-            if file_id in self.index["files"]:
-                return self.index["files"][file_id]
-            return None
+            file_info = self._get_file_entry(file_id)
+            if file_info is not None:
+                # 索引中保存的是相对路径，返回本机路径
+                file_info = dict(file_info)
+                file_info["path"] = self.resolve_path(file_info.get("path", ""))
+            return file_info
         except Exception as e:
             print(f"获取文件信息时出错: {str(e)}")
             return None 
\ No newline at end of file
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+
+class SQLiteKnowledgeStore:
+    """基于SQLite的知识库存储后端
+
+    文件元数据、分区和分段文本保存在本地SQLite数据库中，全文检索使用FTS5：
+        docs_fts     每个文件一行（标题、摘要、正文），保存原文
+        chunks_fts   每个检索片段一行，保存片段原文
+        docs_terms   与 docs_fts 行号相同，保存分析后的词元（以空格分隔），用于文件级BM25排序
+        chunks_terms 与 chunks_fts 行号相同，保存分析后的词元，用于片段级检索和挑选命中文件中最相关的上下文
+        doc_rows / chunk_rows  普通表，记录每个文件在 docs_fts / chunks_fts 中的行号；
+                     FTS5表的 file_id 列不能建索引，按文件读取和删除时先在这两张表中查出行号再按行号访问
+    FTS5自带的分词器不能切分中文，检索使用的词表由知识库的文本分析器预先分词，入库和查询的分词方式一致。
+    适合文档数量较多、不便将整个索引读入内存的知识库。
+    """
+
+    # FTS5的bm25()将出现在一半以上文档中的词的IDF截断为1e-6，只命中这类常见词的结果得分在此以下，
+    # 按0分处理，避免按最高分比例筛选时常见词的微小得分被当作有效的相关度
+    MIN_SCORE = 1e-3
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS categories (
+            name TEXT PRIMARY KEY,
+            position INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            file_id TEXT PRIMARY KEY,
+            category TEXT NOT NULL,
+            position INTEGER,
+            info TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_category ON files (category, position);
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5 (
+            file_id UNINDEXED, title, summary, body
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5 (
+            file_id UNINDEXED, chunk_no UNINDEXED, text
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs_terms USING fts5 (
+            title, summary, body
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS chunks_terms USING fts5 (
+            text
+        );
+        CREATE TABLE IF NOT EXISTS doc_rows (
+            file_id TEXT PRIMARY KEY,
+            fts_rowid INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS chunk_rows (
+            file_id TEXT NOT NULL,
+            chunk_no INTEGER NOT NULL,
+            fts_rowid INTEGER NOT NULL,
+            PRIMARY KEY (file_id, chunk_no)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path, analyze=None):
+        """初始化SQLite存储
+
+        Args:
+            db_path: 数据库文件路径
+            analyze: 文本分析函数，返回词元列表；为None时词表直接使用原文，由FTS5分词
+        """
+        self.db_path = db_path
+        self.analyze = analyze
+        # 搜索在后台线程中执行，连接需跨线程使用，由锁保证串行访问
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(self.SCHEMA)
+        self._sync_row_maps()
+        self.conn.commit()
+
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            self.conn.close()
+
+    def commit(self):
+        """提交未保存的修改"""
+        with self.lock:
+            self.conn.commit()
+
+    def _sync_row_maps(self):
+        """旧版数据库没有行号表，首次打开时根据FTS5表中的 file_id 补齐"""
+        if self.get_meta("row_maps") == "1":
+            return
+        with self.lock:
+            self.conn.execute("DELETE FROM doc_rows")
+            self.conn.execute("DELETE FROM chunk_rows")
+            self.conn.execute(
+                "INSERT OR REPLACE INTO doc_rows (file_id, fts_rowid) SELECT file_id, rowid FROM docs_fts"
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chunk_rows (file_id, chunk_no, fts_rowid) "
+                "SELECT file_id, CAST(chunk_no AS INTEGER), rowid FROM chunks_fts"
+            )
+            self.set_meta("row_maps", "1")
+
+    def get_meta(self, key, default=None):
+        """读取元信息"""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        """写入元信息"""
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def add_category(self, category):
+        """添加分区，已存在时忽略"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO categories (name, position) "
+                "VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM categories))",
+                (category,)
+            )
+
+    def get_categories(self):
+        """按添加顺序获取所有分区"""
+        with self.lock:
+            rows = self.conn.execute("SELECT name FROM categories ORDER BY position").fetchall()
+        return [row[0] for row in rows]
+
+    def _terms(self, text):
+        """将文本转换为词表中保存的词元序列"""
+        if self.analyze is None:
+            return text or ""
+        return " ".join(self.analyze(text or ""))
+
+    def _insert_doc(self, file_id, title, summary, body):
+        """写入文件的原文和词表"""
+        cursor = self.conn.execute(
+            "INSERT INTO docs_fts (file_id, title, summary, body) VALUES (?, ?, ?, ?)",
+            (file_id, title, summary, body)
+        )
+        self.conn.execute(
+            "INSERT INTO docs_terms (rowid, title, summary, body) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, self._terms(title), self._terms(summary), self._terms(body))
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO doc_rows (file_id, fts_rowid) VALUES (?, ?)", (file_id, cursor.lastrowid)
+        )
+
+    def sync_terms(self, signature):
+        """分析方式变化（或首次使用词表）时，根据已保存的原文重建词表
+
+        Args:
+            signature: 分析方式的标识
+        """
+        if self.get_meta("analyzer") == signature:
+            return
+        with self.lock:
+            self.conn.execute("DELETE FROM docs_terms")
+            self.conn.execute("DELETE FROM chunks_terms")
+            rows = self.conn.execute("SELECT rowid, title, summary, body FROM docs_fts").fetchall()
+            for rowid, title, summary, body in rows:
+                self.conn.execute(
+                    "INSERT INTO docs_terms (rowid, title, summary, body) VALUES (?, ?, ?, ?)",
+                    (rowid, self._terms(title), self._terms(summary), self._terms(body))
+                )
+            cursor = self.conn.execute("SELECT rowid, text FROM chunks_fts")
+            while True:
+                rows = cursor.fetchmany(1000)
+                if not rows:
+                    break
+                self.conn.executemany(
+                    "INSERT INTO chunks_terms (rowid, text) VALUES (?, ?)",
+                    [(rowid, self._terms(text)) for rowid, text in rows]
+                )
+            self.set_meta("analyzer", signature)
+
+    def put_file(self, file_id, file_info, title, body, chunks):
+        """写入文件元数据及全文检索内容，已存在的记录会被替换
+
+        Args:
+            file_id: 文件ID，格式为"分区/文件名"
+            file_info: 文件元数据字典（不含全文）
+            title: 用于检索的标题
+            body: 文档全文
+            chunks: 按片段序号排列的检索片段文本列表
+        """
+        category = file_info.get("category", "其他")
+        with self.lock:
+            self.add_category(category)
+            row = self.conn.execute("SELECT position FROM files WHERE file_id = ?", (file_id,)).fetchone()
+            if row is None:
+                position = self.conn.execute(
+                    "SELECT COALESCE(MAX(position), -1) + 1 FROM files WHERE category = ?", (category,)
+                ).fetchone()[0]
+            else:
+                position = row[0]
+            self._delete_fts(file_id)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (file_id, category, position, info) VALUES (?, ?, ?, ?)",
+                (file_id, category, position, json.dumps(file_info, ensure_ascii=False))
+            )
+            self._insert_doc(file_id, title, file_info.get("summary", ""), body)
+            self._insert_chunks(file_id, chunks)
+
+    def _insert_chunks(self, file_id, chunks):
+        """写入文件的检索片段及其词表"""
+        for chunk_no, text in enumerate(chunks):
+            cursor = self.conn.execute(
+                "INSERT INTO chunks_fts (file_id, chunk_no, text) VALUES (?, ?, ?)", (file_id, chunk_no, text)
+            )
+            self.conn.execute(
+                "INSERT INTO chunks_terms (rowid, text) VALUES (?, ?)", (cursor.lastrowid, self._terms(text))
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chunk_rows (file_id, chunk_no, fts_rowid) VALUES (?, ?, ?)",
+                (file_id, chunk_no, cursor.lastrowid)
+            )
+
+    def replace_chunks(self, file_id, chunks):
+        """替换文件的检索片段（切分参数变化后重新切分时使用）"""
+        with self.lock:
+            self._delete_chunks(file_id)
+            self._insert_chunks(file_id, chunks)
+
+    def update_file_info(self, file_id, file_info):
+        """只更新文件元数据，不改动全文检索内容"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE files SET info = ? WHERE file_id = ?",
+                (json.dumps(file_info, ensure_ascii=False), file_id)
+            )
+
+    def _delete_fts(self, file_id):
+        """删除文件的全文检索记录"""
+        rows = self.conn.execute("SELECT fts_rowid FROM doc_rows WHERE file_id = ?", (file_id,)).fetchall()
+        self.conn.executemany("DELETE FROM docs_terms WHERE rowid = ?", rows)
+        self.conn.executemany("DELETE FROM docs_fts WHERE rowid = ?", rows)
+        self.conn.execute("DELETE FROM doc_rows WHERE file_id = ?", (file_id,))
+        self._delete_chunks(file_id)
+
+    def _delete_chunks(self, file_id):
+        """删除文件的检索片段及其词表"""
+        rows = self.conn.execute("SELECT fts_rowid FROM chunk_rows WHERE file_id = ?", (file_id,)).fetchall()
+        self.conn.executemany("DELETE FROM chunks_terms WHERE rowid = ?", rows)
+        self.conn.executemany("DELETE FROM chunks_fts WHERE rowid = ?", rows)
+        self.conn.execute("DELETE FROM chunk_rows WHERE file_id = ?", (file_id,))
+
+    def delete_file(self, file_id):
+        """删除文件记录
+
+        Returns:
+            bool: 文件是否存在
+        """
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+            self._delete_fts(file_id)
+        return cursor.rowcount > 0
+
+    def get_file(self, file_id):
+        """获取文件元数据，不存在时返回None"""
+        with self.lock:
+            row = self.conn.execute("SELECT info FROM files WHERE file_id = ?", (file_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def has_file(self, file_id):
+        """检查文件是否存在"""
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM files WHERE file_id = ?", (file_id,)).fetchone()
+        return row is not None
+
+    def count_files(self):
+        """文件总数"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def list_file_ids(self, categories=None):
+        """按分区顺序列出文件ID
+
+        Args:
+            categories: 分区名称列表，为None时列出全部分区
+        """
+        with self.lock:
+            if categories is None:
+                rows = self.conn.execute(
+                    "SELECT f.file_id FROM files f LEFT JOIN categories c ON c.name = f.category "
+                    "ORDER BY c.position, f.position"
+                ).fetchall()
+                return [row[0] for row in rows]
+            file_ids = []
+            for category in categories:
+                rows = self.conn.execute(
+                    "SELECT file_id FROM files WHERE category = ? ORDER BY position", (category,)
+                ).fetchall()
+                file_ids.extend(row[0] for row in rows)
+            return file_ids
+
+    def iter_files(self):
+        """遍历所有文件，返回 (文件ID, 元数据) 列表"""
+        with self.lock:
+            rows = self.conn.execute("SELECT file_id, info FROM files").fetchall()
+        return [(file_id, json.loads(info)) for file_id, info in rows]
+
+    def get_content(self, file_id):
+        """获取文件全文，不存在时返回None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT d.body FROM doc_rows r JOIN docs_fts d ON d.rowid = r.fts_rowid WHERE r.file_id = ?",
+                (file_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_chunks(self, file_id, chunk_nos=None):
+        """读取文件的检索片段
+
+        Args:
+            file_id: 文件ID
+            chunk_nos: 片段序号列表，为None时读取全部片段
+
+        Returns:
+            dict: 片段序号 -> 片段文本
+        """
+        sql = (
+            "SELECT r.chunk_no, c.text FROM chunk_rows r JOIN chunks_fts c ON c.rowid = r.fts_rowid "
+            "WHERE r.file_id = ?"
+        )
+        params = [file_id]
+        if chunk_nos is not None:
+            chunk_nos = sorted(set(int(chunk_no) for chunk_no in chunk_nos))
+            if not chunk_nos:
+                return {}
+            sql += " AND r.chunk_no IN (%s)" % ",".join("?" * len(chunk_nos))
+            params.extend(chunk_nos)
+        sql += " ORDER BY r.chunk_no"
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return {chunk_no: text for chunk_no, text in rows}
+
+    @staticmethod
+    def build_match_query(query_tokens, phrases=None):
+        """将查询标记转换为FTS5查询表达式（任一词命中即可，短语须全部按顺序出现）"""
+        match = " OR ".join('"' + token.replace('"', '""') + '"' for token in query_tokens)
+        for phrase in phrases or []:
+            match = f'({match}) AND "' + " ".join(phrase).replace('"', '""') + '"'
+        return match
+
+    def search(self, query_tokens, categories=None, limit=5, field_weights=None, max_contexts=3, phrases=None):
+        """使用FTS5的BM25对文件排序，并取出每个命中文件中最相关的段落
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            categories: 限定的分区名称列表，为None时不限制
+            limit: 最多返回的文件数
+            field_weights: 字段权重 {"title": ..., "summary": ..., "body": ...}
+            max_contexts: 每个文件最多返回的段落数
+            phrases: 文件必须包含的短语列表，每个短语为标记列表
+
+        Returns:
+            list: [(文件ID, 分数, [段落文本, ...]), ...]，按分数从高到低排列
+        """
+        if not query_tokens:
+            return []
+        weights = field_weights or {"title": 2.0, "summary": 1.5, "body": 1.0}
+        match = self.build_match_query(query_tokens, phrases)
+
+        sql = (
+            "SELECT d.file_id, -bm25(docs_terms, ?, ?, ?) AS score "
+            "FROM docs_terms t JOIN docs_fts d ON d.rowid = t.rowid JOIN files f ON f.file_id = d.file_id "
+            "WHERE docs_terms MATCH ?"
+        )
+        params = [weights.get("title", 1.0), weights.get("summary", 1.0), weights.get("body", 1.0), match]
+        if categories is not None:
+            if not categories:
+                return []
+            sql += " AND f.category IN (%s)" % ",".join("?" * len(categories))
+            params.extend(categories)
+        sql += " ORDER BY score DESC LIMIT ?"
+        params.append(limit)
+
+        results = []
+        with self.lock:
+            try:
+                rows = self.conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"全文检索出错: {e}")
+                return []
+            for file_id, score in rows:
+                score = score if score >= self.MIN_SCORE else 0.0
+                contexts = self.conn.execute(
+                    "SELECT c.text FROM chunks_terms t JOIN chunks_fts c ON c.rowid = t.rowid "
+                    "WHERE chunks_terms MATCH ? AND t.rowid IN (SELECT fts_rowid FROM chunk_rows WHERE file_id = ?) "
+                    "ORDER BY bm25(chunks_terms) LIMIT ?",
+                    (match, file_id, max_contexts)
+                ).fetchall()
+                results.append((file_id, score, [row[0] for row in contexts]))
+        return results
+
+    def search_chunks(self, query_tokens, categories=None, limit=5, phrases=None):
+        """使用FTS5的BM25在所有文件的检索片段中排序
+
+        Args:
+            query_tokens: 去重后的查询标记列表
+            categories: 限定的分区名称列表，为None时不限制
+            limit: 最多返回的片段数
+            phrases: 片段必须包含的短语列表，每个短语为标记列表
+
+        Returns:
+            list: [(文件ID, 片段序号, 分数, 片段文本), ...]，按分数从高到低排列
+        """
+        if not query_tokens:
+            return []
+
+        sql = (
+            "SELECT c.file_id, c.chunk_no, -bm25(chunks_terms) AS score, c.text "
+            "FROM chunks_terms t JOIN chunks_fts c ON c.rowid = t.rowid JOIN files f ON f.file_id = c.file_id "
+            "WHERE chunks_terms MATCH ?"
+        )
+        params = [self.build_match_query(query_tokens, phrases)]
+        if categories is not None:
+            if not categories:
+                return []
+            sql += " AND f.category IN (%s)" % ",".join("?" * len(categories))
+            params.extend(categories)
+        sql += " ORDER BY score DESC LIMIT ?"
+        params.append(limit)
+
+        with self.lock:
+            try:
+                rows = self.conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                print(f"全文检索出错: {e}")
+                return []
+        return [
+            (file_id, int(chunk_no), score if score >= self.MIN_SCORE else 0.0, text)
+            for file_id, chunk_no, score, text in rows
+        ]
+
+    def import_json_index(self, index, get_content, get_title, chunk_content):
+        """从旧版 index.json 一次性迁移文件元数据、分区和全文
+
+        Args:
+            index: index.json 解析后的字典
+            get_content: 根据 (文件ID, 元数据) 获取全文的函数
+            get_title: 根据 (文件ID, 元数据) 获取检索标题的函数
+            chunk_content: 将全文切分为检索片段列表的函数
+
+        Returns:
+            int: 迁移的文件数
+        """
+        count = 0
+        with self.lock:
+            for category in index.get("categories", {}):
+                self.add_category(category)
+            for file_id, file_info in index.get("files", {}).items():
+                file_info = dict(file_info)
+                content = file_info.pop("content", None)
+                if content is None:
+                    content = get_content(file_id, file_info)
+                self.put_file(file_id, file_info, get_title(file_id, file_info), content, chunk_content(content))
+                count += 1
+            self.set_meta("migrated_from_json", "1")
+            self.conn.commit()
+        return count
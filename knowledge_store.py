@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import hashlib
+
+def write_text_stream(pieces, dest_path, head_length=201):
+    """将文本片段逐段写入文件，同时统计词数并保留开头部分用于生成摘要
+
+    先写入临时文件再替换目标文件，读取方不会看到写了一半的内容。
+
+    Args:
+        pieces: 文本片段的可迭代对象（如按页产生的PDF文本）
+        dest_path: 目标文件路径
+        head_length: 保留的开头字符数
+
+    Returns:
+        tuple: (词数, 开头文本)，词数与 len(全文.split()) 一致
+    """
+    tmp_path = dest_path + ".tmp"
+    token_count = 0
+    head_parts = []
+    head_size = 0
+    # 上一片段是否以非空白字符结尾，用于处理被片段边界切开的词
+    in_word = False
+
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for piece in pieces:
+            if not piece:
+                continue
+            f.write(piece)
+
+            count = len(piece.split())
+            if count and in_word and not piece[0].isspace():
+                count -= 1
+            token_count += count
+            in_word = not piece[-1].isspace()
+
+            if head_size < head_length:
+                head_parts.append(piece[:head_length - head_size])
+                head_size += len(head_parts[-1])
+
+    os.replace(tmp_path, dest_path)
+    return token_count, "".join(head_parts)
+
+
+def write_json_atomic(path, data, **kwargs):
+    """先写入临时文件并刷新到磁盘，再替换目标文件，写入中途崩溃不会损坏原文件"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ContentStore:
+    """知识库文档全文存储
+
+    每个文档的全文单独保存为一个文件，索引中只保留元数据。
+    入库时切分好的检索片段另存为一个文件，搜索命中时只读取需要的片段。
+    全文仅在建立索引或预览时按需读取，启动和写索引都不必处理全文。
+    """
+
+    def __init__(self, store_dir):
+        """初始化全文存储
+
+        Args:
+            store_dir: 全文存储目录
+        """
+        self.store_dir = store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def path_for(self, file_id):
+        """根据文件ID计算全文文件路径，文件ID中可能含有不宜直接用作文件名的字符"""
+        digest = hashlib.sha1(file_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.store_dir, digest + ".txt")
+
+    def put(self, file_id, content):
+        """保存文档全文
+
+        Args:
+            file_id: 文件ID，格式为"分区/文件名"
+            content: 文档全文
+        """
+        write_text_stream([content or ""], self.path_for(file_id))
+    
+    def put_stream(self, file_id, pieces, head_length=201):
+        """逐段写入文档全文，不在内存中拼接整篇文本
+
+        Args:
+            file_id: 文件ID
+            pieces: 文本片段的可迭代对象
+            head_length: 保留的开头字符数
+
+        Returns:
+            tuple: (词数, 开头文本)
+        """
+        return write_text_stream(pieces, self.path_for(file_id), head_length)
+
+    def get(self, file_id):
+        """读取文档全文
+
+        Args:
+            file_id: 文件ID
+
+        Returns:
+            str: 文档全文，不存在时返回None
+        """
+        path = self.path_for(file_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except Exception as e:
+            print(f"读取文档内容时出错: {e}")
+            return None
+
+    def iter_paragraphs(self, file_id, block_size=64 * 1024):
+        """按块读取全文并逐个产生段落，结果与 content.split('\\n\\n') 一致
+
+        Args:
+            file_id: 文件ID
+            block_size: 每次读取的字符数
+
+        Yields:
+            tuple: (段落序号, 段落文本)
+        """
+        path = self.path_for(file_id)
+        if not os.path.exists(path):
+            return
+        para_no = 0
+        # 当前段落已读取的部分，只在遇到段落分隔时拼接，避免超长段落反复复制
+        pending = []
+        with open(path, "r", encoding="utf-8") as f:
+            for block in iter(lambda: f.read(block_size), ""):
+                # 分隔符被块边界切开的情况
+                if pending and pending[-1].endswith("\n") and block.startswith("\n"):
+                    pending[-1] = pending[-1][:-1]
+                    yield para_no, "".join(pending)
+                    para_no += 1
+                    pending = []
+                    block = block[1:]
+                start = 0
+                while True:
+                    end = block.find("\n\n", start)
+                    if end < 0:
+                        break
+                    pending.append(block[start:end])
+                    yield para_no, "".join(pending)
+                    para_no += 1
+                    pending = []
+                    start = end + 2
+                if start < len(block):
+                    pending.append(block[start:])
+        yield para_no, "".join(pending)
+
+    def chunks_path_for(self, file_id):
+        """检索片段文件路径"""
+        return os.path.splitext(self.path_for(file_id))[0] + ".chunks"
+
+    def put_chunks(self, file_id, chunks):
+        """逐个写入检索片段，每行一个JSON字符串
+
+        Args:
+            file_id: 文件ID
+            chunks: 片段文本的可迭代对象
+        """
+        path = self.chunks_path_for(file_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(json.dumps(chunk, ensure_ascii=False))
+                f.write("\n")
+        os.replace(tmp_path, path)
+
+    def get_chunks(self, file_id, chunk_nos=None):
+        """读取指定序号的检索片段，读到最大序号后即停止
+
+        Args:
+            file_id: 文件ID
+            chunk_nos: 片段序号列表，为None时读取全部片段
+
+        Returns:
+            dict: 片段序号 -> 片段文本
+        """
+        wanted = None if chunk_nos is None else set(chunk_nos)
+        path = self.chunks_path_for(file_id)
+        if wanted == set() or not os.path.exists(path):
+            return {}
+        last = max(wanted) if wanted else None
+        chunks = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for chunk_no, line in enumerate(f):
+                if wanted is None or chunk_no in wanted:
+                    chunks[chunk_no] = json.loads(line)
+                if last is not None and chunk_no >= last:
+                    break
+        return chunks
+
+    def delete(self, file_id):
+        """删除文档全文
+
+        Args:
+            file_id: 文件ID
+
+        Returns:
+            bool: 是否删除了已存在的全文
+        """
+        path = self.path_for(file_id)
+        chunks_path = self.chunks_path_for(file_id)
+        if os.path.exists(chunks_path):
+            os.remove(chunks_path)
+        if os.path.exists(path):
+            os.remove(path)
+            return True
+        return False
+
+    def contains(self, file_id):
+        """检查是否保存了文档全文"""
+        return os.path.exists(self.path_for(file_id))
+
+
+def file_sha256(file_path, block_size=1024 * 1024):
+    """分块计算文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def link_or_copy(src_path, dest_path):
+    """将文件以硬链接（不支持时复制）的方式放到目标路径，并原子地替换目标文件"""
+    tmp_path = dest_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+class ExtractionCache:
+    """按文件内容SHA-256缓存的文本提取结果
+
+    缓存内容与文件名和分区无关，重复下载、改名、在分区间移动或删除后重新添加的文件
+    都可以直接复用已提取的文本和词数统计，不必重新解析PDF。
+    每个哈希对应一个文本文件和一个记录统计信息的JSON文件。
+    """
+
+    def __init__(self, cache_dir, version=1):
+        """初始化提取缓存
+
+        Args:
+            cache_dir: 缓存目录
+            version: 提取逻辑的版本，版本不同的缓存视为无效
+        """
+        self.cache_dir = cache_dir
+        self.version = version
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _paths(self, sha256):
+        """哈希对应的 (文本文件, 统计文件) 路径"""
+        base = os.path.join(self.cache_dir, sha256)
+        return base + ".txt", base + ".json"
+
+    def get(self, sha256):
+        """读取缓存的统计信息
+
+        Args:
+            sha256: 文件内容哈希
+
+        Returns:
+            tuple: (词数, 开头文本)，没有有效缓存时返回None
+        """
+        text_path, meta_path = self._paths(sha256)
+        if not os.path.exists(text_path) or not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception:
+            return None
+        if meta.get("version") != self.version:
+            return None
+        return meta["tokens"], meta["head"]
+
+    def put(self, sha256, text_path, stats):
+        """保存提取结果
+
+        Args:
+            sha256: 文件内容哈希
+            text_path: 已写好的全文文件
+            stats: (词数, 开头文本)
+        """
+        cache_text_path, meta_path = self._paths(sha256)
+        try:
+            link_or_copy(text_path, cache_text_path)
+            tmp_path = meta_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": self.version, "tokens": stats[0], "head": stats[1]}, f, ensure_ascii=False)
+            os.replace(tmp_path, meta_path)
+        except Exception as e:
+            print(f"写入提取缓存时出错: {e}")
+
+    def copy_to(self, sha256, dest_path):
+        """将缓存的全文放到目标路径"""
+        link_or_copy(self._paths(sha256)[0], dest_path)
+
+    def prune(self, keep):
+        """删除不在 keep 中的缓存
+
+        Args:
+            keep: 需要保留的哈希集合
+
+        Returns:
+            int: 删除的缓存数
+        """
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            sha256, ext = os.path.splitext(name)
+            if ext == ".json" and sha256 not in keep:
+                removed += 1
+            if sha256 not in keep:
+                os.remove(os.path.join(self.cache_dir, name))
+        return removed
+
+
+class FileManifest:
+    """知识库文件清单
+
+    记录每个已索引文件的 (路径, 大小, 修改时间, 内容哈希) 以及各分区目录的修改时间。
+    刷新索引时只需比较目录和文件的stat信息，只有真正变化的文件才会重新提取文本。
+    """
+
+    VERSION = 1
+
+    def __init__(self, manifest_file):
+        """初始化文件清单
+
+        Args:
+            manifest_file: 清单文件路径
+        """
+        self.manifest_file = manifest_file
+        # 文件ID -> {"path": 相对路径, "size": 大小, "mtime": 修改时间, "sha256": 内容哈希}
+        self.files = {}
+        # 分区名称 -> 目录修改时间
+        self.dirs = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """从磁盘加载清单"""
+        self.files = {}
+        self.dirs = {}
+        if not os.path.exists(self.manifest_file):
+            return
+        try:
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != self.VERSION:
+                return
+            self.files = data.get("files", {})
+            self.dirs = data.get("dirs", {})
+        except Exception as e:
+            print(f"加载文件清单时出错: {e}")
+            self.files = {}
+            self.dirs = {}
+
+    def save(self):
+        """保存清单，没有修改时不写盘"""
+        if not self.dirty:
+            return
+        data = {"version": self.VERSION, "files": self.files, "dirs": self.dirs}
+        try:
+            write_json_atomic(self.manifest_file, data, separators=(",", ":"))
+            self.dirty = False
+        except Exception as e:
+            print(f"保存文件清单时出错: {e}")
+
+    def get(self, file_id):
+        """获取文件的清单记录，不存在时返回None"""
+        return self.files.get(file_id)
+
+    def is_unchanged(self, file_id, stat_result):
+        """根据大小和修改时间判断文件是否未变化"""
+        entry = self.files.get(file_id)
+        return (entry is not None
+                and entry.get("size") == stat_result.st_size
+                and entry.get("mtime") == stat_result.st_mtime)
+
+    def record(self, file_id, file_path, stat_result, sha256):
+        """记录文件当前的stat信息和内容哈希
+
+        Args:
+            file_id: 文件ID
+            file_path: 索引中保存的文件路径（相对知识库根目录）
+            stat_result: 文件的 os.stat 结果
+            sha256: 文件内容哈希
+
+        Returns:
+            dict: 清单记录
+        """
+        entry = {
+            "path": file_path,
+            "size": stat_result.st_size,
+            "mtime": stat_result.st_mtime,
+            "sha256": sha256
+        }
+        self.files[file_id] = entry
+        self.dirty = True
+        return entry
+
+    def remove(self, file_id):
+        """删除文件的清单记录"""
+        if self.files.pop(file_id, None) is not None:
+            self.dirty = True
+
+    def dir_changed(self, category, dir_mtime):
+        """判断分区目录自上次扫描后是否有变化"""
+        return self.dirs.get(category) != dir_mtime
+
+    def record_dir(self, category, dir_mtime):
+        """记录分区目录的修改时间"""
+        if self.dirs.get(category) != dir_mtime:
+            self.dirs[category] = dir_mtime
+            self.dirty = True
+
+
+class IndexJournal:
+    """索引修改的追加式日志（预写日志）
+
+    每次提交只把本次修改的记录追加到日志末尾并刷新到磁盘，写入量与修改量成正比，
+    不必每次都重写整个索引。日志定期压缩进索引快照后清空。
+    每次提交的记录以一条 {"op": "commit"} 结束，恢复时只重放完整提交的记录，
+    写了一半的提交（如写入过程中程序崩溃）会被丢弃并从文件中截掉。
+    """
+
+    def __init__(self, journal_file):
+        """初始化日志
+
+        Args:
+            journal_file: 日志文件路径
+        """
+        self.journal_file = journal_file
+        # 日志中已提交的记录数，用于判断何时压缩
+        self.record_count = 0
+
+    def recover(self):
+        """读取所有完整提交的记录，并截掉末尾不完整的部分
+
+        Returns:
+            list: 按写入顺序排列的修改记录
+        """
+        records = []
+        if not os.path.exists(self.journal_file):
+            self.record_count = 0
+            return records
+
+        pending = []
+        valid_length = 0
+        offset = 0
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                offset += len(line)
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("不完整的记录")
+                    record = json.loads(line.decode("utf-8"))
+                except Exception:
+                    break
+                if record.get("op") == "commit":
+                    records.extend(pending)
+                    pending = []
+                    valid_length = offset
+                else:
+                    pending.append(record)
+
+        if valid_length < os.path.getsize(self.journal_file):
+            print("索引日志末尾有未完成的提交，已丢弃")
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(valid_length)
+
+        self.record_count = len(records)
+        return records
+
+    def append(self, records):
+        """追加一次提交的记录并刷新到磁盘
+
+        Args:
+            records: 修改记录列表
+        """
+        if not records:
+            return
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        data += json.dumps({"op": "commit"}) + "\n"
+        with open(self.journal_file, "ab") as f:
+            f.write(data.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        self.record_count += len(records)
+
+    def reset(self):
+        """清空日志（内容已压缩进快照后调用）"""
+        tmp_path = self.journal_file + ".tmp"
+        open(tmp_path, "wb").close()
+        os.replace(tmp_path, self.journal_file)
+        self.record_count = 0
+
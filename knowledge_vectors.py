@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import math
+import zlib
+
+try:
+    import numpy as np
+    VECTORS_AVAILABLE = True
+except ImportError:
+    np = None
+    VECTORS_AVAILABLE = False
+
+
+def _default_tokenize(text):
+    """简单分词：转小写、去标点、按空白切分并去掉过短的词（未指定分词函数时使用）"""
+    text = re.sub(r'[^\w\s]', ' ', (text or "").lower())
+    return [token for token in text.split() if len(token) > 1]
+
+
+def _normalize_rows(matrix):
+    """将矩阵每一行归一化为单位向量，使点积即为余弦相似度"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+class HashingEmbedder:
+    """本地特征哈希向量化
+
+    将词和相邻词对哈希到固定维度（带符号，减少冲突的影响），按次线性词频加权后做L2归一化。
+    不需要训练和联网，向量只取决于文本本身，新增文档不会改变已有向量。
+    相似度只反映共同的词项，与查询没有共同词项的片段的相似度全部来自哈希冲突。
+    """
+
+    # 向量只编码词项，检索结果可按是否含有查询词过滤
+    lexical = True
+
+    def __init__(self, dim=512, tokenize=None, tokenize_signature=None):
+        """初始化向量化器
+
+        Args:
+            dim: 向量维度
+            tokenize: 分词函数，默认为按空白切分的简单分词
+            tokenize_signature: 分词方式的标识，分词方式变化后向量需要重新生成
+        """
+        self.dim = dim
+        self.tokenize = tokenize or _default_tokenize
+        self.tokenize_signature = tokenize_signature
+
+    @property
+    def signature(self):
+        """向量化方式的标识，变化后已保存的向量需要重新生成"""
+        if self.tokenize_signature:
+            return f"hashing-{self.dim}-v1/{self.tokenize_signature}"
+        return f"hashing-{self.dim}-v1"
+
+    def embed(self, texts):
+        """将文本列表转换为 (len(texts), dim) 的float32矩阵"""
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = self.tokenize(text)
+            features = tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+            counts = {}
+            for feature in features:
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = -1.0 if h & 0x80000000 else 1.0
+                index = h % self.dim
+                counts[index] = counts.get(index, 0.0) + sign
+            for index, value in counts.items():
+                if value:
+                    matrix[row, index] = math.copysign(1.0 + math.log(abs(value)), value)
+        return _normalize_rows(matrix)
+
+
+class OpenAIEmbedder:
+    """调用OpenAI兼容的 /embeddings 接口（OpenAI、DeepSeek或本地推理服务）生成向量"""
+
+    lexical = False
+
+    def __init__(self, base_url, api_key="", model="text-embedding-3-small", batch_size=64, timeout=60):
+        """初始化向量化器
+
+        Args:
+            base_url: 接口地址，如 https://api.openai.com/v1
+            api_key: API密钥，本地服务可为空
+            model: 向量模型名称
+            batch_size: 每次请求的文本数
+            timeout: 请求超时（秒）
+        """
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.batch_size = batch_size
+        self.timeout = timeout
+
+    @property
+    def signature(self):
+        """向量化方式的标识，变化后已保存的向量需要重新生成"""
+        return f"openai-{self.model}@{self.base_url}"
+
+    def embed(self, texts):
+        """将文本列表转换为 (len(texts), 维度) 的float32矩阵"""
+        import requests
+
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [text or " " for text in texts[start:start + self.batch_size]]
+            response = requests.post(
+                f"{self.base_url}/embeddings",
+                headers=headers,
+                json={"model": self.model, "input": batch},
+                timeout=self.timeout
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"向量接口请求失败，状态码: {response.status_code}, 错误: {response.text}")
+            data = sorted(response.json()["data"], key=lambda item: item["index"])
+            vectors.extend(item["embedding"] for item in data)
+
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return _normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+def create_embedder(config=None, tokenize=None, tokenize_signature=None):
+    """根据配置创建向量化器
+
+    Args:
+        config: 如 {"type": "hashing", "dim": 512} 或
+                {"type": "openai", "base_url": ..., "api_key": ..., "model": ...}，默认为本地哈希
+        tokenize: 本地哈希向量化使用的分词函数
+        tokenize_signature: 分词方式的标识
+
+    Returns:
+        向量化器实例
+    """
+    config = config or {}
+    if config.get("type") == "openai":
+        return OpenAIEmbedder(
+            config.get("base_url", "https://api.openai.com/v1"),
+            config.get("api_key", ""),
+            config.get("model", "text-embedding-3-small")
+        )
+    return HashingEmbedder(config.get("dim", 512), tokenize, tokenize_signature)
+
+
+class VectorStore:
+    """检索片段向量存储
+
+    所有向量按行连续保存在一个float32文件中，查询时以只读memmap映射为矩阵，
+    一次矩阵-向量乘积得到全部片段的相似度，再用argpartition取前k个，不必排序全部结果。
+    每个文件的片段向量占连续的若干行，元数据中只记录起始行和行数；
+    删除文件只标记其所在行失效，失效行较多时在保存时压缩文件。
+    """
+
+    VERSION = 1
+
+    def __init__(self, store_dir, signature):
+        """初始化向量存储
+
+        Args:
+            store_dir: 存储目录
+            signature: 向量化方式的标识，与已保存的不一致时清空重建
+        """
+        self.store_dir = store_dir
+        self.vectors_file = os.path.join(store_dir, "vectors.f32")
+        self.meta_file = os.path.join(store_dir, "vectors.json")
+        self.signature = signature
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        self.dim = 0
+        self.rows = 0
+        # 文件ID -> [起始行, 行数]
+        self.files = {}
+        self.dead_rows = 0
+        self.dirty = False
+        self._matrix = None
+        self._row_doc = None
+        self._doc_ids = None
+        self.load()
+
+    def load(self):
+        """加载元数据，版本、向量化方式不符或向量文件不完整时从空存储开始"""
+        self.clear()
+        self.dirty = False
+        if not os.path.exists(self.meta_file):
+            return
+        try:
+            with open(self.meta_file, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != self.VERSION or meta.get("signature") != self.signature:
+                self.dirty = True
+                return
+            dim, rows = meta["dim"], meta["rows"]
+            size = os.path.getsize(self.vectors_file) if os.path.exists(self.vectors_file) else 0
+            if size < rows * dim * 4:
+                print("向量文件不完整，将重新生成向量")
+                self.dirty = True
+                return
+            self.dim = dim
+            self.rows = rows
+            self.files = meta.get("files", {})
+            self.dead_rows = rows - sum(count for _, count in self.files.values())
+        except Exception as e:
+            print(f"加载向量索引时出错: {e}")
+            self.clear()
+
+    def save(self):
+        """保存元数据，失效行超过四分之一时先压缩向量文件"""
+        if not self.dirty:
+            return
+        try:
+            if self.rows and self.dead_rows * 4 > self.rows:
+                self._compact()
+            meta = {
+                "version": self.VERSION,
+                "signature": self.signature,
+                "dim": self.dim,
+                "rows": self.rows,
+                "files": self.files
+            }
+            tmp_path = self.meta_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, self.meta_file)
+            self.dirty = False
+        except Exception as e:
+            print(f"保存向量索引时出错: {e}")
+
+    def clear(self):
+        """清空向量存储"""
+        self._release()
+        self.dim = 0
+        self.rows = 0
+        self.files = {}
+        self.dead_rows = 0
+        self.dirty = True
+
+    def _release(self):
+        """释放内存映射（Windows上被映射的文件不能被替换）"""
+        self._matrix = None
+        self._row_doc = None
+        self._doc_ids = None
+
+    def has_file(self, file_id):
+        """检查文件是否已有向量"""
+        return file_id in self.files
+
+    def file_ids(self):
+        """获取已有向量的所有文件ID"""
+        return list(self.files.keys())
+
+    def add(self, file_id, vectors):
+        """追加文件的片段向量，已存在的向量会被替换
+
+        Args:
+            file_id: 文件ID
+            vectors: (片段数, 维度) 的矩阵，第i行对应片段序号i
+        """
+        self.remove(file_id)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors):
+            if not self.dim:
+                self.dim = vectors.shape[1]
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"向量维度不一致: {vectors.shape[1]} != {self.dim}")
+            self._release()
+            mode = "r+b" if os.path.exists(self.vectors_file) else "wb"
+            with open(self.vectors_file, mode) as f:
+                # 从有效行末尾写入，覆盖上次未保存元数据时残留的数据
+                f.seek(self.rows * self.dim * 4)
+                f.write(vectors.tobytes())
+                f.truncate()
+        self.files[file_id] = [self.rows, len(vectors)]
+        self.rows += len(vectors)
+        self.dirty = True
+
+    def remove(self, file_id):
+        """将文件的向量标记为失效
+
+        Returns:
+            bool: 文件是否有向量
+        """
+        span = self.files.pop(file_id, None)
+        if span is None:
+            return False
+        self.dead_rows += span[1]
+        self._row_doc = None
+        self._doc_ids = None
+        self.dirty = True
+        return True
+
+    def _compact(self):
+        """只保留有效行，重写向量文件"""
+        matrix = self._get_matrix()
+        tmp_path = self.vectors_file + ".tmp"
+        files = {}
+        row = 0
+        with open(tmp_path, "wb") as f:
+            for file_id, (start, count) in self.files.items():
+                if count:
+                    f.write(np.ascontiguousarray(matrix[start:start + count]).tobytes())
+                files[file_id] = [row, count]
+                row += count
+        del matrix
+        self._release()
+        os.replace(tmp_path, self.vectors_file)
+        self.files = files
+        self.rows = row
+        self.dead_rows = 0
+
+    def _get_matrix(self):
+        """以只读memmap映射向量矩阵"""
+        if self._matrix is None and self.rows:
+            self._matrix = np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(self.rows, self.dim))
+        return self._matrix
+
+    def _get_row_docs(self):
+        """每一行所属文件的序号（失效行为-1），用于过滤"""
+        if self._row_doc is None:
+            self._doc_ids = list(self.files.keys())
+            self._row_doc = np.full(self.rows, -1, dtype=np.int32)
+            for slot, file_id in enumerate(self._doc_ids):
+                start, count = self.files[file_id]
+                self._row_doc[start:start + count] = slot
+        return self._row_doc, self._doc_ids
+
+    def search(self, query_vector, k, file_ids=None, min_similarity=0.0):
+        """取与查询向量最相似的k个片段
+
+        Args:
+            query_vector: 归一化后的查询向量
+            k: 返回的片段数
+            file_ids: 限定的文件ID集合，为None时不限制
+            min_similarity: 相似度不高于该值的片段不返回，相似的片段不足k个时返回的结果少于k个
+
+        Returns:
+            list: [(文件ID, 片段序号, 相似度), ...]，按相似度从高到低排列
+        """
+        matrix = self._get_matrix()
+        if matrix is None or k <= 0:
+            return []
+        row_doc, doc_ids = self._get_row_docs()
+
+        scores = matrix @ np.asarray(query_vector, dtype=np.float32)
+        if file_ids is None:
+            valid = row_doc >= 0
+        else:
+            allowed = [slot for slot, file_id in enumerate(doc_ids) if file_id in file_ids]
+            valid = np.isin(row_doc, np.asarray(allowed, dtype=np.int32))
+        valid &= scores > min_similarity
+        k = min(k, int(valid.sum()))
+        if k <= 0:
+            return []
+        scores = np.where(valid, scores, -np.inf)
+
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        results = []
+        for row in top:
+            file_id = doc_ids[row_doc[row]]
+            results.append((file_id, int(row - self.files[file_id][0]), float(scores[row])))
+        return results
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import queue
+import select
+import struct
+import threading
+
+class InotifyBackend:
+    """基于Linux inotify的目录监视（通过ctypes调用libc，无需第三方库）"""
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        """初始化inotify，不可用时抛出OSError"""
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify仅在Linux上可用")
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        # 监视描述符 -> 分区名称
+        self.watches = {}
+
+    def watch(self, category, directory):
+        """开始监视分区目录"""
+        if category in self.watches.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = category
+
+    def read_events(self, timeout):
+        """等待并读取事件
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            list: [(事件类型, 分区名称, 文件名), ...]，事件类型为 "changed" 或 "deleted"
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+
+            if mask & self.IN_IGNORED:
+                # 目录被删除或移走，监视已失效
+                self.watches.pop(wd, None)
+                continue
+            if mask & self.IN_ISDIR or not name or wd not in self.watches:
+                continue
+
+            event_type = "deleted" if mask & (self.IN_DELETE | self.IN_MOVED_FROM) else "changed"
+            events.append((event_type, self.watches[wd], os.fsdecode(name)))
+        return events
+
+    def close(self):
+        """关闭inotify"""
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+class PollingBackend:
+    """轮询方式的目录监视，在没有inotify的平台上使用"""
+
+    def __init__(self, interval=2.0):
+        """初始化轮询监视
+
+        Args:
+            interval: 轮询间隔（秒）
+        """
+        self.interval = interval
+        # 分区名称 -> 目录
+        self.directories = {}
+        # 分区名称 -> {文件名: (大小, 修改时间)}
+        self.snapshots = {}
+
+    def _snapshot(self, directory):
+        """获取目录中所有文件的大小和修改时间"""
+        snapshot = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat_result = entry.stat()
+                        snapshot[entry.name] = (stat_result.st_size, stat_result.st_mtime)
+        except OSError:
+            pass
+        return snapshot
+
+    def watch(self, category, directory):
+        """开始监视分区目录"""
+        if category in self.directories:
+            return
+        self.directories[category] = directory
+        self.snapshots[category] = self._snapshot(directory)
+
+    def read_events(self, timeout):
+        """等待一个轮询间隔后比较目录快照
+
+        Args:
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            list: [(事件类型, 分区名称, 文件名), ...]
+        """
+        time.sleep(min(timeout, self.interval))
+        events = []
+        for category, directory in self.directories.items():
+            old = self.snapshots.get(category, {})
+            new = self._snapshot(directory)
+            for name, stat_info in new.items():
+                if old.get(name) != stat_info:
+                    events.append(("changed", category, name))
+            for name in old:
+                if name not in new:
+                    events.append(("deleted", category, name))
+            self.snapshots[category] = new
+        return events
+
+    def close(self):
+        """关闭轮询监视"""
+        self.directories = {}
+        self.snapshots = {}
+
+
+class KnowledgeWatcher:
+    """知识库目录监视器
+
+    监视 knowledge_base/<分区>/ 目录，将新增、修改、删除事件放入入库队列，
+    由后台工作线程合并后批量更新索引，不阻塞查询和界面主循环。
+    一段时间内的连续事件（例如一次复制数百个PDF）会被合并为一批，只提交一次索引。
+    """
+
+    def __init__(self, knowledge_manager, debounce=1.0, max_delay=10.0, poll_interval=2.0, on_batch=None):
+        """初始化监视器
+
+        Args:
+            knowledge_manager: KnowledgeManager 实例
+            debounce: 事件静默多久后开始处理一批（秒）
+            max_delay: 持续有事件时，一批最多等待多久（秒）
+            poll_interval: 不支持inotify时的轮询间隔（秒）
+            on_batch: 每批处理完成后的回调，参数为处理的文件ID列表
+        """
+        self.knowledge_manager = knowledge_manager
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.on_batch = on_batch
+
+        self.events = queue.Queue()
+        self.stop_event = threading.Event()
+        self.backend = None
+        self.threads = []
+
+    def _create_backend(self):
+        """优先使用inotify，不可用时退回轮询"""
+        try:
+            return InotifyBackend()
+        except Exception:
+            return PollingBackend(self.poll_interval)
+
+    def _watch_categories(self):
+        """为所有分区目录添加监视，新建的分区也会被补充监视"""
+        # 分区列表在锁内复制，避免与后台刷新同时修改索引
+        with self.knowledge_manager._lock:
+            categories = self.knowledge_manager.get_categories()
+        for category in categories:
+            directory = os.path.join(self.knowledge_manager.knowledge_base_dir, category)
+            if os.path.isdir(directory):
+                self.backend.watch(category, directory)
+
+    def start(self):
+        """启动监视线程和入库工作线程"""
+        if self.threads:
+            return
+        self.stop_event.clear()
+        self.backend = self._create_backend()
+        self._watch_categories()
+
+        self.threads = [
+            threading.Thread(target=self._watch_loop, daemon=True),
+            threading.Thread(target=self._ingest_loop, daemon=True)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """停止监视"""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=5)
+        self.threads = []
+        if self.backend:
+            self.backend.close()
+            self.backend = None
+
+    def _watch_loop(self):
+        """读取文件系统事件并放入入库队列"""
+        while not self.stop_event.is_set():
+            try:
+                for event in self.backend.read_events(1.0):
+                    self.events.put(event)
+                self._watch_categories()
+            except Exception as e:
+                print(f"监视知识库目录时出错: {e}")
+                self.stop_event.wait(1.0)
+
+    def _ingest_loop(self):
+        """合并一段时间内的事件后批量更新索引"""
+        # 启动时先做一次完整刷新，补上监视开始前发生的变化（包括目录修改时间未变的原地修改）
+        self.knowledge_manager.refresh_index(force=True)
+
+        while not self.stop_event.is_set():
+            try:
+                event = self.events.get(timeout=1.0)
+            except queue.Empty:
+                continue
+
+            pending = {}
+            batch_start = time.time()
+            while event is not None:
+                _, category, filename = event
+                pending[f"{category}/{filename}"] = event
+                if time.time() - batch_start >= self.max_delay:
+                    break
+                try:
+                    event = self.events.get(timeout=self.debounce)
+                except queue.Empty:
+                    event = None
+
+            file_ids = list(pending.keys())
+            try:
+                self.knowledge_manager.ingest_changes(file_ids)
+                if self.on_batch:
+                    self.on_batch(file_ids)
+            except Exception as e:
+                print(f"批量更新知识库索引时出错: {e}")
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""知识库索引格式的往返测试
+
+修改倒排索引的二进制格式、MaxScore剪枝或索引日志后运行：
+    python -m pytest -q test_knowledge_index.py
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from knowledge_index import FIELDS, InvertedIndex, ShardedIndex, BM25FScorer
+from knowledge_store import IndexJournal
+
+
+def random_corpus(rng, vocab, count, category="c"):
+    """生成随机文档：[(文件ID, 标题标记, 摘要标记, 正文标记, 各片段标记), ...]"""
+    weights = [rng.random() ** 3 for _ in vocab]
+    documents = []
+    for number in range(count):
+        chunks = [rng.choices(vocab, weights, k=rng.randint(1, 20)) for _ in range(rng.randint(1, 4))]
+        documents.append((
+            f"{category}/d{number:03d}",
+            rng.choices(vocab, weights, k=rng.randint(0, 3)),
+            rng.choices(vocab, weights, k=rng.randint(0, 6)),
+            [token for chunk in chunks for token in chunk],
+            chunks
+        ))
+    return documents
+
+
+def index_snapshot(index, vocab):
+    """倒排记录、词项位置和长度统计，用于比较两个索引的内容"""
+    postings = {}
+    for term in vocab:
+        postings[term] = {
+            file_id: (entry.get("t", 0), entry.get("s", 0), entry.get("b", 0),
+                      [tuple(chunk) for chunk in entry.get("c", [])],
+                      [list(positions) for positions in index.get_positions(entry)])
+            for file_id, entry in index.term_postings(term).items()
+        }
+    lengths = {
+        file_id: (index.get_doc_lengths(file_id), index.get_chunk_lengths(file_id))
+        for file_id in index.document_ids()
+    }
+    averages = [index.average_length(field) for field in FIELDS] + [index.average_chunk_length()]
+    return postings, lengths, index.document_count, averages
+
+
+class TempDirTestCase(unittest.TestCase):
+    """在临时目录中运行的测试"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+class BinaryFormatTest(TempDirTestCase):
+    """倒排索引二进制文件的保存和加载"""
+
+    vocab = [f"w{i}" for i in range(40)] + ["图神", "神经", "网络"]
+
+    def test_inverted_index_round_trip(self):
+        rng = random.Random(7)
+        path = os.path.join(self.temp_dir, "index.bin")
+        index = InvertedIndex(path)
+        for document in random_corpus(rng, self.vocab, 30):
+            index.add_document(*document)
+
+        for step in range(3):
+            expected = index_snapshot(index, self.vocab)
+            index.save()
+            self.assertEqual(index_snapshot(index, self.vocab), expected)
+            reloaded = InvertedIndex(path)
+            self.assertEqual(index_snapshot(reloaded, self.vocab), expected)
+
+            # 在已保存的基础上删除和替换文件，下一轮保存时合并
+            for file_id in rng.sample(sorted(index.document_ids()), 5):
+                index.remove_document(file_id)
+            for document in random_corpus(rng, self.vocab, 5, category=f"n{step}"):
+                index.add_document(*document)
+
+    def test_sharded_index_round_trip(self):
+        rng = random.Random(11)
+        shard_dir = os.path.join(self.temp_dir, "shards")
+        index = ShardedIndex(shard_dir, signature="test-v1")
+        for category in ("a", "b"):
+            for document in random_corpus(rng, self.vocab, 10, category):
+                index.add_document(*document)
+        expected = {category: index_snapshot(shard, self.vocab) for category, shard in index.shards_for()}
+        index.save()
+
+        reloaded = ShardedIndex(shard_dir, signature="test-v1")
+        self.assertEqual(sorted(reloaded.document_ids()), sorted(index.document_ids()))
+        self.assertEqual(
+            {category: index_snapshot(shard, self.vocab) for category, shard in reloaded.shards_for()}, expected
+        )
+
+        # 分词方式变化后旧分片被丢弃，由调用方重建
+        self.assertEqual(ShardedIndex(shard_dir, signature="test-v2").document_count, 0)
+
+
+class MaxScoreTest(TempDirTestCase):
+    """MaxScore剪枝的结果与对全部文件打分后排序一致"""
+
+    def check_corpus(self, rng, saved):
+        path = os.path.join(self.temp_dir, "maxscore.bin")
+        if os.path.exists(path):
+            os.remove(path)
+        index = InvertedIndex(path)
+        vocab = [f"w{i}" for i in range(rng.randint(5, 30))]
+        documents = random_corpus(rng, vocab, rng.randint(1, 60))
+        for document in documents:
+            index.add_document(*document)
+        if saved:
+            index.save()
+        order = {document[0]: number for number, document in enumerate(documents)}
+        scorer = BM25FScorer(index, proximity_weight=rng.choice([0.0, 0.5, 2.0]), proximity_window=5)
+
+        for _ in range(5):
+            query_tokens = list(dict.fromkeys(rng.sample(vocab, rng.randint(1, 4))))
+            k = rng.randint(1, 6)
+            scores = scorer.score(query_tokens)
+
+            ranked = sorted(scores.items(), key=lambda item: (-item[1]["score"], order[item[0]]))[:k]
+            expected = [(file_id, round(result["score"], 9)) for file_id, result in ranked]
+            actual = [(file_id, round(score, 9)) for file_id, score, _ in scorer.top_documents(query_tokens, k, order)]
+            self.assertEqual(actual, expected, query_tokens)
+
+            chunks = sorted(
+                (-chunk_score, order[file_id], chunk_no, file_id)
+                for file_id, result in scores.items() for chunk_no, chunk_score in result["chunks"]
+            )[:k]
+            expected = [(file_id, chunk_no, round(-score, 9)) for score, _, chunk_no, file_id in chunks]
+            actual = [
+                (file_id, chunk_no, round(score, 9))
+                for file_id, chunk_no, score in scorer.top_chunks(query_tokens, k, order)
+            ]
+            self.assertEqual(actual, expected, query_tokens)
+
+    def test_top_k_matches_exhaustive_scoring(self):
+        rng = random.Random(3)
+        for trial in range(40):
+            self.check_corpus(rng, saved=trial % 2 == 0)
+
+
+class JournalReplayTest(TempDirTestCase):
+    """索引日志在崩溃后的恢复"""
+
+    def test_recover_drops_incomplete_commit(self):
+        journal_file = os.path.join(self.temp_dir, "index.journal")
+        journal = IndexJournal(journal_file)
+        journal.append([{"op": "put", "file_id": "c/a", "info": {"n": 1}}])
+        journal.append([{"op": "put", "file_id": "c/b", "info": {"n": 2}}, {"op": "delete", "file_id": "c/a"}])
+        complete_size = os.path.getsize(journal_file)
+
+        # 模拟写入一次提交的过程中崩溃：提交标记没有写入，最后一行也不完整
+        with open(journal_file, "ab") as f:
+            f.write(b'{"op": "put", "file_id": "c/c", "info": {}}\n{"op": "put", "file_')
+
+        recovered = IndexJournal(journal_file)
+        records = recovered.recover()
+        self.assertEqual([(record["op"], record["file_id"]) for record in records],
+                         [("put", "c/a"), ("put", "c/b"), ("delete", "c/a")])
+        self.assertEqual(recovered.record_count, 3)
+        self.assertEqual(os.path.getsize(journal_file), complete_size)
+
+        # 截断后可以继续追加
+        recovered.append([{"op": "put", "file_id": "c/d", "info": {}}])
+        self.assertEqual([record["file_id"] for record in IndexJournal(journal_file).recover()],
+                         ["c/a", "c/b", "c/a", "c/d"])
+
+    def test_manager_replays_journal_after_crash(self):
+        from knowledge_manager import KnowledgeManager
+
+        source_dir = os.path.join(self.temp_dir, "source")
+        os.makedirs(source_dir)
+        paths = []
+        for name, text in (("a.txt", "graph neural networks and message passing"),
+                           ("b.txt", "transformer attention heads")):
+            paths.append(os.path.join(source_dir, name))
+            with open(paths[-1], "w", encoding="utf-8") as f:
+                f.write(text)
+
+        cwd = os.getcwd()
+        os.chdir(self.temp_dir)
+        try:
+            manager = KnowledgeManager()
+            category = manager.categories[0]
+            self.assertTrue(all(result["success"] for result in manager.add_files(paths, category)))
+            self.assertGreater(manager.journal.record_count, 0)
+            file_ids = sorted(info["file_id"] for info in manager.get_files_by_category(category))
+            with open(manager.journal_file, "ab") as f:
+                f.write(b'{"op": "put", "file_id": "' + category.encode("utf-8") + b'/lost.txt"')
+            del manager
+
+            reopened = KnowledgeManager()
+            self.assertEqual(sorted(info["file_id"] for info in reopened.get_files_by_category(category)), file_ids)
+            self.assertEqual([result["file_id"] for result in reopened.search("attention")], [f"{category}/b.txt"])
+            self.assertEqual([result["file_id"] for result in reopened.search("message passing")],
+                             [f"{category}/a.txt"])
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    unittest.main()